@@ -0,0 +1,222 @@
+from SSH_Core.Recording import MAGIC, HEADER, HEADER_SIZE, INBOUND, OUTBOUND
+from SSH_Core.Metrics import message_names, percentiles
+from SSH_Core.Numbers import TransportMessage
+from SSH_Core.Transport.Packets import MAX_PACKET_LENGTH
+
+from array import array
+from mmap import mmap, ACCESS_READ
+from struct import unpack_from
+
+try:
+    import numpy
+except ImportError:
+    numpy = None
+
+
+class _Stream(object):
+    __slots__ = ('version', 'header', 'skip', 'mac_len', 'offset', 'start', 'fields')
+
+    def __init__(self):
+        self.version = False
+        # the start of the current line until the version is found, then the first 6 bytes of the current packet
+        self.header = bytearray()
+        self.skip = 0
+        # MAC bytes after each packet, set once the direction sent SSH_MSG_NEWKEYS
+        self.mac_len = 0
+        # bytes of the direction consumed so far and the offset the current packet started at
+        self.offset = 0
+        self.start = 0
+        # packet_len, padding_len and message number of the current packet
+        self.fields = None
+
+
+class Columns(object):
+    """
+    One row per framed packet, stored in typed arrays rather than Python objects.
+    offset is the position of the packet in the byte stream of its direction.
+    timestamp is the nanoseconds since the start of the capture at which the packet was complete.
+    """
+    layout = (
+        ('direction', 'B'),
+        ('offset', 'Q'),
+        ('length', 'L'),
+        ('padding', 'B'),
+        ('message', 'B'),
+        ('timestamp', 'Q'),
+    )
+
+    def __init__(self):
+        for key, typecode in self.layout:
+            setattr(self, key, array(typecode))
+
+    def append(self, direction: int, offset: int, length: int, padding: int, message: int, timestamp: int):
+        self.direction.append(direction)
+        self.offset.append(offset)
+        self.length.append(length)
+        self.padding.append(padding)
+        self.message.append(message)
+        self.timestamp.append(timestamp)
+
+    def to_numpy(self) -> dict:
+        """
+        Return every column as a NumPy array that shares memory with its typed array
+        :return: dict of column name to numpy.ndarray
+        """
+        if numpy is None:
+            raise ImportError('NumPy is required for columnar analysis')
+        return {
+            key: numpy.frombuffer(getattr(self, key), f'=u{getattr(self, key).itemsize}')
+            for key, _ in self.layout
+        }
+
+    def __len__(self):
+        return len(self.length)
+
+    def __repr__(self):
+        return f'{self.__class__.__name__}(packets={len(self)})'
+
+
+def frame_capture(path: str, mac_len: int = 0) -> Columns:
+    """
+    Frame every packet of a capture made by SSH_Core.Recording in a single streaming pass.
+    The file is memory mapped and only the first 6 bytes of each packet are copied,
+    so a packet spanning several records never has to be reassembled.
+    Lines before the version line, IE: a server banner, are skipped.
+    Packet lengths are read in the clear, so the capture must be of unencrypted traffic,
+    a packet length that is not plain raises a ValueError.
+    :param path: str
+    :param mac_len: int bytes of MAC after every packet that follows SSH_MSG_NEWKEYS in its direction
+    :return: Columns
+    """
+    newkeys = TransportMessage.SSH_MSG_NEWKEYS.value
+    columns = Columns()
+    streams = {INBOUND: _Stream(), OUTBOUND: _Stream()}
+
+    with open(path, 'rb') as file, mmap(file.fileno(), 0, access=ACCESS_READ) as data:
+        if data[:len(MAGIC)] != MAGIC:
+            raise ValueError(f'{path} is not a capture file')
+        position = len(MAGIC)
+        while position < len(data):
+            if position+HEADER_SIZE > len(data):
+                raise ValueError(f'record header at {position} is truncated')
+            direction, timestamp, size = unpack_from(HEADER, data, position)
+            position += HEADER_SIZE
+            end = position+size
+            if end > len(data):
+                raise ValueError(f'record at {position-HEADER_SIZE} is truncated')
+            stream = streams[direction]
+
+            while position < end:
+                if not stream.version:
+                    newline = data.find(b'\n', position, end)
+                    line_end = end if newline == -1 else newline+1
+                    if len(stream.header) < 4:
+                        stream.header += data[position:min(line_end, position+4-len(stream.header))]
+                    if newline != -1:
+                        # a server may send other lines before its version, RFC 4253 section 4.2
+                        stream.version = stream.header[:4] == b'SSH-'
+                        stream.header.clear()
+                    consumed = line_end-position
+                elif stream.fields is None:
+                    if not stream.header:
+                        stream.start = stream.offset
+                    consumed = min(6-len(stream.header), end-position)
+                    stream.header += data[position:position+consumed]
+                    if len(stream.header) == 6:
+                        stream.fields = unpack_from('!IBB', stream.header)
+                        if not 2 <= stream.fields[0] <= MAX_PACKET_LENGTH or stream.fields[1] >= stream.fields[0]:
+                            raise ValueError(
+                                f'packet at offset {stream.start} has packet_len {stream.fields[0]} and padding_len '
+                                f'{stream.fields[1]}, the capture is encrypted or mac_len is wrong'
+                            )
+                        stream.skip = stream.fields[0]-2+stream.mac_len
+                        if stream.fields[2] == newkeys:
+                            stream.mac_len = mac_len
+                        stream.header.clear()
+                else:
+                    consumed = min(stream.skip, end-position)
+                    stream.skip -= consumed
+
+                position += consumed
+                stream.offset += consumed
+                if stream.fields is not None and not stream.skip:
+                    columns.append(direction, stream.start, *stream.fields, timestamp)
+                    stream.fields = None
+    return columns
+
+
+def summarize(columns: Columns) -> dict:
+    """
+    Aggregate framed packets with vectorized NumPy operations, or over the typed arrays when NumPy is not installed.
+    Percentiles are interpolated with NumPy and nearest rank without it.
+    :param columns: Columns
+    :return: dict with packet sizes, padding overhead, message mix and inter-arrival times per direction
+    """
+    if numpy is None:
+        return _summarize_arrays(columns)
+    table = columns.to_numpy()
+    output = dict()
+    for direction, name in ((INBOUND, 'inbound'), (OUTBOUND, 'outbound')):
+        selected = table['direction'] == direction
+        length = table['length'][selected].astype('u8')
+        if not length.size:
+            continue
+        padding = table['padding'][selected].astype('u8')
+        message = table['message'][selected]
+        timestamp = table['timestamp'][selected].astype('i8')
+        wire = length+4
+        inter_arrival = numpy.diff(timestamp)
+
+        counts = numpy.bincount(message, minlength=256)
+        output[name] = {
+            'packets': int(length.size),
+            'bytes': int(wire.sum()),
+            'packet_size': {
+                'mean': float(wire.mean()),
+                **{f'p{point}': float(value) for point, value in zip((50, 90, 99), numpy.percentile(wire, (50, 90, 99)))},
+                'max': int(wire.max()),
+            },
+            'padding_overhead': float(padding.sum()/wire.sum()),
+            'messages': {
+                message_names.get(number, str(number)): int(counts[number]) for number in numpy.nonzero(counts)[0]
+            },
+            'inter_arrival_ns': {
+                f'p{point}': float(value) for point, value in zip((50, 90, 99), numpy.percentile(inter_arrival, (50, 90, 99)))
+            } if inter_arrival.size else {},
+        }
+    return output
+
+
+def _summarize_arrays(columns: Columns) -> dict:
+    """
+    summarize without NumPy, one pass over the typed arrays per direction
+    :param columns: Columns
+    :return: dict in the format of summarize
+    """
+    output = dict()
+    for direction, name in ((INBOUND, 'inbound'), (OUTBOUND, 'outbound')):
+        rows = [index for index, value in enumerate(columns.direction) if value == direction]
+        if not rows:
+            continue
+        wire = [columns.length[index]+4 for index in rows]
+        timestamps = [columns.timestamp[index] for index in rows]
+        inter_arrival = [later-earlier for earlier, later in zip(timestamps, timestamps[1:])]
+
+        counts = dict()
+        for index in rows:
+            counts[columns.message[index]] = counts.get(columns.message[index], 0)+1
+        output[name] = {
+            'packets': len(rows),
+            'bytes': sum(wire),
+            'packet_size': {
+                'mean': sum(wire)/len(wire),
+                **{key: float(value) for key, value in percentiles(wire, 50, 90, 99).items()},
+                'max': max(wire),
+            },
+            'padding_overhead': sum(columns.padding[index] for index in rows)/sum(wire),
+            'messages': {message_names.get(number, str(number)): counts[number] for number in sorted(counts)},
+            'inter_arrival_ns': {
+                key: float(value) for key, value in percentiles(inter_arrival, 50, 90, 99).items()
+            } if inter_arrival else {},
+        }
+    return output
@@ -0,0 +1,16 @@
+from SSH_Core.Analysis import frame_capture, summarize
+
+from argparse import ArgumentParser
+from json import dumps
+
+
+parser = ArgumentParser(prog='python -m SSH_Core.Analysis', description='Summarize captured SSH transport streams')
+parser.add_argument('captures', nargs='+', help='capture files written by SSH_Core.Recording.Recorder')
+parser.add_argument('--mac-len', type=int, default=0, help='bytes of MAC after every packet that follows SSH_MSG_NEWKEYS')
+args = parser.parse_args()
+
+try:
+    summaries = {path: summarize(frame_capture(path, args.mac_len)) for path in args.captures}
+except (OSError, ValueError) as exc:
+    parser.exit(1, f'{parser.prog}: error: {exc}\n')
+print(dumps(summaries, indent=2))
@@ -0,0 +1,428 @@
+from SSH_Core import String, NameList
+from SSH_Core.Server import Server, default_algorithms, kexinit
+from SSH_Core.Transport import TransportHandler, RekeyScheduler
+from SSH_Core.Transport.Packets import Packet
+from SSH_Core.Transport.Crypto import Mac, CryptoOffload
+from SSH_Core.Transport.Pipeline import InboundPipeline
+from SSH_Core.Transport.Cipher import CTRCipher, ciphers, backends, xor
+from SSH_Core.LoadTest import SimulatedClient, echo_server
+from SSH_Core.Connection import serve
+from SSH_Core.Connection.SFTP import SFTPServer, SFTPClient
+from SSH_Core.Connection.Forwarding import Relay, DirectTCPIP, LocalForward
+
+from selectors import DefaultSelector, EVENT_READ
+from socket import socketpair, create_connection, SHUT_WR
+from os import urandom, path
+from functools import partial
+from tempfile import TemporaryDirectory
+from zlib import compressobj, Z_SYNC_FLUSH
+from threading import Thread
+from time import perf_counter_ns
+from timeit import Timer
+import random
+
+
+benchmarks = dict()
+
+
+def benchmark(function):
+    """
+    Register a benchmark. It is called without arguments and returns a dict of results.
+    """
+    benchmarks[function.__name__] = function
+    return function
+
+
+def per_call(function, repeat: int = 5) -> float:
+    """
+    Time a callable and return the best nanoseconds per call over repeat runs
+    :param function: callable without arguments
+    :param repeat: int
+    :return: float
+    """
+    timer = Timer(function)
+    number, _ = timer.autorange()
+    return min(timer.repeat(repeat, number))/number*1_000_000_000
+
+
+def run(names=None) -> dict:
+    """
+    Run the named benchmarks, or all of them
+    :param names: iterable of str
+    :return: dict of benchmark name to results
+    """
+    return {name: benchmarks[name]() for name in (names or benchmarks)}
+
+
+def _client_lists(count: int, rng: random.Random) -> list:
+    names = [name for names in default_algorithms.values() for name in names]
+    names += [f'extension-{index}@ssh_core' for index in range(50)]
+    return [NameList(*rng.sample(names, rng.randint(3, 20))) for _ in range(count)]
+
+
+@benchmark
+def negotiation_cache():
+    """
+    Look up client algorithm lists in a negotiation cache keyed by NameList, as a server would
+    for clients that keep sending the same KEXINIT.
+    legacy_key_ns is the cost of the previous hash, which encoded the value into an int.
+    """
+    rng = random.Random(0)
+    lists = _client_lists(200, rng)
+    cache = {name_list: name_list.data[0] for name_list in lists}
+    probes = [NameList(*rng.choice(lists).data) for _ in range(1000)]
+
+    def lookup():
+        for probe in probes:
+            cache[probe]
+
+    def fresh_lookup():
+        for probe in probes:
+            cache[NameList(*probe.data)]
+
+    def legacy_key():
+        for probe in probes:
+            int.from_bytes(probe.encode(), 'big')
+
+    return {
+        'cached_lookup_ns': per_call(lookup)/len(probes),
+        'fresh_lookup_ns': per_call(fresh_lookup)/len(probes),
+        'legacy_key_ns': per_call(legacy_key)/len(probes),
+    }
+
+
+@benchmark
+def algorithm_membership():
+    """
+    Check negotiated String algorithm names against a set of supported algorithms
+    """
+    supported = {String(name) for names in default_algorithms.values() for name in names}
+    names = [String(name) for name_list in _client_lists(100, random.Random(1)) for name in name_list.data]
+
+    def membership():
+        for name in names:
+            name in supported
+
+    return {'membership_ns': per_call(membership)/len(names)}
+
+
+def _bulk_transfer(rekey: RekeyScheduler, size: int, packet_size: int) -> dict:
+    server = Server()
+    client_side, server_side = socketpair()
+    with server, client_side, server_side:
+        client = SimulatedClient(client_side)
+        client_side.sendall(b'SSH-2.0-Benchmark\r\n'+Packet.create(kexinit(default_algorithms).encode()).encode())
+        handler = TransportHandler(server, server_side, rekey=rekey)
+        handler.exchange_protocols()
+        client.read_line()
+        client.read_packet()
+
+        def read():
+            try:
+                while True:
+                    handler.get_packet()
+            except ConnectionError:
+                pass
+
+        arrivals = list()
+
+        def receive():
+            while True:
+                try:
+                    payload = client.receive(1)[0]
+                except ConnectionError:
+                    return
+                if payload[:1] == b'\x5e':
+                    arrivals.append(perf_counter_ns())
+
+        threads = [Thread(target=read), Thread(target=receive)]
+        for thread in threads:
+            thread.start()
+        payload = b'\x5e'+bytes(packet_size)
+        start = perf_counter_ns()
+        for _ in range(size//packet_size):
+            packet = Packet.create(payload)
+            try:
+                handler.send_packet(packet)
+            except BufferError:
+                handler.keys_ready.wait()
+                handler.send_packet(packet)
+        handler.keys_ready.wait()
+        server_side.shutdown(SHUT_WR)
+        threads[1].join()
+        client_side.shutdown(SHUT_WR)
+        threads[0].join()
+        handler.close()
+
+    gaps = [after-before for before, after in zip([start]+arrivals, arrivals)]
+    seconds = (arrivals[-1]-start)/1_000_000_000
+    return {
+        'mb_per_second': size/1_000_000/seconds,
+        'rekeys': handler.metrics.rekeys,
+        'max_gap_ms': max(gaps)/1_000_000,
+    }
+
+
+@benchmark
+def rekey_bulk_transfer():
+    """
+    Send 64 MB of channel sized packets over a socketpair without re-exchanging keys and with a
+    re-exchange every 4 MB, best of 3 runs each. Packets keep being produced during the exchange,
+    so the throughput and the longest gap between two data packets should stay about the same.
+    """
+    size, packet_size = 64 << 20, 32 << 10
+    best = lambda runs: max(runs, key=lambda run: run['mb_per_second'])
+    return {
+        'no_rekey': best([_bulk_transfer(None, size, packet_size) for _ in range(3)]),
+        'rekey_every_4mb': best([_bulk_transfer(RekeyScheduler(bytes_limit=4 << 20), size, packet_size) for _ in range(3)]),
+    }
+
+
+def _mac_transfer(offload: CryptoOffload, size: int, packet_size: int) -> float:
+    server = Server()
+    client_side, server_side = socketpair()
+    with server, client_side, server_side:
+        client = SimulatedClient(client_side)
+        client_side.sendall(b'SSH-2.0-Benchmark\r\n'+Packet.create(kexinit(default_algorithms).encode()).encode())
+        handler = TransportHandler(server, server_side, offload=offload)
+        handler.exchange_protocols()
+        client.read_line()
+        client.read_packet()
+        handler.set_mac(outbound=Mac('hmac-sha2-512', urandom(64)))
+
+        def drain():
+            while client_side.recv(1 << 20):
+                pass
+
+        drainer = Thread(target=drain)
+        drainer.start()
+        payload = b'\x5e'+bytes(packet_size)
+        start = perf_counter_ns()
+        for _ in range(size//packet_size):
+            handler.send_packet(handler.create_packet(payload))
+        handler.flush(block=True)
+        server_side.shutdown(SHUT_WR)
+        drainer.join()
+        seconds = (perf_counter_ns()-start)/1_000_000_000
+        handler.close()
+    return size/1_000_000/seconds
+
+
+@benchmark
+def crypto_offload():
+    """
+    Send 64 MB of packets with hmac-sha2-512 over a socketpair, computing MACs inline and on a CryptoOffload,
+    best of 3 runs each. Small packets are always computed inline.
+    """
+    size = 64 << 20
+    output = dict()
+    for packet_size in (1 << 10, 32 << 10, 256 << 10):
+        offload = CryptoOffload()
+        output[f'{packet_size >> 10}kb'] = {
+            'inline_mb_per_second': max(_mac_transfer(None, size, packet_size) for _ in range(3)),
+            'offload_mb_per_second': max(_mac_transfer(offload, size, packet_size) for _ in range(3)),
+            'workers': offload.workers,
+        }
+        offload.shutdown()
+    return output
+
+
+@benchmark
+def inbound_pipeline():
+    """
+    Take 16 MB of synthetic packets through the inbound pipeline with hmac-sha2-256, with and without zlib,
+    and report the counters of every stage
+    """
+    size = 16 << 20
+    mac = Mac('hmac-sha2-256', urandom(32))
+    output = dict()
+    for compression in ('none', 'zlib'):
+        for packet_size in (1 << 10, 32 << 10):
+            compressor = compressobj()
+            payload = b'\x5e'+bytes(range(256))*(packet_size >> 8)
+            compress = lambda data: compressor.compress(data)+compressor.flush(Z_SYNC_FLUSH)
+            if compression == 'none':
+                compress = lambda data: data
+            data = b''.join(
+                mac.sign(sequence, Packet.create(compress(payload)).encode()) for sequence in range(size//packet_size)
+            )
+            pipeline = InboundPipeline(mac=mac, compression=compression)
+            start = perf_counter_ns()
+            for position in range(0, len(data), 1 << 16):
+                pipeline.run(data[position:position+(1 << 16)])
+            seconds = (perf_counter_ns()-start)/1_000_000_000
+            output[f'{compression}_{packet_size >> 10}kb'] = {
+                'packets_per_second': size//packet_size/seconds,
+                'wire_mb_per_second': len(data)/1_000_000/seconds,
+                'stages': pipeline.stats(),
+            }
+    return output
+
+
+def _sftp_session(root: str, mmap_threshold: int):
+    server = Server(subsystems={'sftp': partial(SFTPServer, root=root, mmap_threshold=mmap_threshold)})
+    client_side, server_side = socketpair()
+
+    def run():
+        handler = TransportHandler(server, server_side)
+        handler.exchange_protocols()
+        serve(handler)
+        handler.close()
+
+    thread = Thread(target=run)
+    thread.start()
+    client = SimulatedClient(client_side)
+    client.handshake()
+    sftp = SFTPClient.start(client.connection())
+
+    def close():
+        sftp.channel.close()
+        client_side.shutdown(SHUT_WR)
+        thread.join()
+        client_side.close()
+        server_side.close()
+        server.close()
+
+    return sftp, close
+
+
+@benchmark
+def sftp_transfer():
+    """
+    Get and put local files of several sizes over one SFTP session on a socketpair, best of 3 runs.
+    Gets use 32 KB and 256 KB reads with 64 outstanding, served from a memory map and with os.pread.
+    """
+    output = dict()
+    with TemporaryDirectory() as root:
+        for size in (64 << 10, 4 << 20, 64 << 20):
+            name = f'/file-{size >> 10}kb'
+            data = urandom(size)
+            with open(path.join(root, name[1:]), 'wb') as file:
+                file.write(data)
+            results = output[f'{size >> 10}kb'] = dict()
+            for reader, mmap_threshold in (('mmap', 0), ('pread', 1 << 62)):
+                sftp, close = _sftp_session(root, mmap_threshold)
+                for block in (32 << 10, 256 << 10):
+                    runs = list()
+                    for _ in range(3):
+                        start = perf_counter_ns()
+                        sftp.get(name, block=block)
+                        runs.append(size/1_000_000/((perf_counter_ns()-start)/1_000_000_000))
+                    results[f'get_{reader}_{block >> 10}kb_mb_per_second'] = max(runs)
+                close()
+            sftp, close = _sftp_session(root, 0)
+            runs = list()
+            for _ in range(3):
+                start = perf_counter_ns()
+                sftp.put('/upload', data)
+                runs.append(size/1_000_000/((perf_counter_ns()-start)/1_000_000_000))
+            results['put_32kb_mb_per_second'] = max(runs)
+            close()
+    return output
+
+
+def _echo_many(address: tuple, count: int, size: int):
+    """
+    Open count connections at once, send size bytes on each and wait for all of them to be echoed back
+    """
+    selector = DefaultSelector()
+    data = urandom(size)
+    remaining = dict()
+    for _ in range(count):
+        sock = create_connection(address)
+        sock.sendall(data)
+        sock.shutdown(SHUT_WR)
+        sock.setblocking(False)
+        selector.register(sock, EVENT_READ)
+        remaining[sock] = size
+    while remaining:
+        for key, _ in selector.select():
+            chunk = key.fileobj.recv(65536)
+            remaining[key.fileobj] -= len(chunk)
+            if not chunk:
+                if remaining.pop(key.fileobj):
+                    raise ConnectionError('forwarded connection closed before everything was echoed')
+                selector.unregister(key.fileobj)
+                key.fileobj.close()
+    selector.close()
+
+
+@benchmark
+def port_forwarding():
+    """
+    Local forwarding over a socketpair to an echo server: thousands of short connections open at once,
+    and one connection moving 64 MB each way.
+    """
+    target, stop_echo = echo_server()
+    server = Server()
+    relay, client_relay = Relay(), Relay()
+    client_side, server_side = socketpair()
+
+    def run():
+        handler = TransportHandler(server, server_side)
+        handler.exchange_protocols()
+        serve(handler, {'direct-tcpip': DirectTCPIP(relay)})
+        handler.close()
+
+    thread = Thread(target=run)
+    thread.start()
+    client = SimulatedClient(client_side)
+    client.handshake()
+    forward = LocalForward(client.connection(), client_relay, *target)
+
+    output = dict()
+    for count in (100, 1000, 4000):
+        start = perf_counter_ns()
+        _echo_many(forward.address, count, 1024)
+        output[f'{count}_connections_per_second'] = count/((perf_counter_ns()-start)/1_000_000_000)
+
+    size = 64 << 20
+    start = perf_counter_ns()
+    with create_connection(forward.address) as sock:
+        data = urandom(size)
+        writer = Thread(target=lambda: (sock.sendall(data), sock.shutdown(SHUT_WR)))
+        writer.start()
+        received = 0
+        while chunk := sock.recv(1 << 20):
+            received += len(chunk)
+        writer.join()
+    output['bulk_mb_per_second'] = 2*received/1_000_000/((perf_counter_ns()-start)/1_000_000_000)
+
+    forward.close()
+    client_side.shutdown(SHUT_WR)
+    thread.join()
+    client_side.close()
+    relay.close()
+    client_relay.close()
+    stop_echo()
+    server.close()
+    return output
+
+
+@benchmark
+def cipher_engine():
+    """
+    Encrypt 32 KB packets with every cipher and installed backend, 256 KB on the pure Python backend
+    and 64 MB on the others. CTR ciphers are timed generating keystream as packets need it and
+    with the keystream prefetched, which leaves only the XOR.
+    """
+    output = dict()
+    packet = urandom(32 << 10)
+    for backend in backends.values():
+        size = 256 << 10 if backend.name == 'python' else 64 << 20
+        count = size//len(packet)
+        results = output[backend.name] = dict()
+        for name, cipher in ciphers.items():
+            row = results[name] = dict()
+            for prefetched in ((False, True) if issubclass(cipher, CTRCipher) else (False, )):
+                engine = cipher(urandom(64), urandom(16), backend, **({'lookahead': size} if prefetched else {}))
+                while prefetched and engine.prefetch():
+                    pass
+                start = perf_counter_ns()
+                for sequence in range(count):
+                    engine.encrypt(sequence, packet)
+                seconds = (perf_counter_ns()-start)/1_000_000_000
+                row['prefetched_mb_per_second' if prefetched else 'mb_per_second'] = size/1_000_000/seconds
+    keystream = urandom(len(packet))
+    output['xor_32kb_ns'] = per_call(lambda: xor(packet, keystream))
+    return output
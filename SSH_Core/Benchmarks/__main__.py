@@ -0,0 +1,14 @@
+from SSH_Core.Benchmarks import benchmarks, run
+
+from argparse import ArgumentParser
+from json import dumps
+
+
+parser = ArgumentParser(prog='python -m SSH_Core.Benchmarks', description='Run SSH_Core micro benchmarks')
+parser.add_argument('names', nargs='*', help=f'benchmarks to run, all of them by default: {", ".join(benchmarks)}')
+args = parser.parse_args()
+for name in args.names:
+    if name not in benchmarks:
+        parser.error(f'unknown benchmark: {name}')
+
+print(dumps(run(args.names), indent=2))
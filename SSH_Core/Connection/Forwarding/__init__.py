@@ -0,0 +1,517 @@
+from SSH_Core.Connection import ChannelHandler, pack_string, unpack_string, OPEN_CONNECT_FAILED
+
+from collections import deque
+from errno import EINPROGRESS
+from heapq import heappush, heappop
+from ipaddress import ip_address
+from itertools import count
+from os import strerror
+from queue import SimpleQueue, Empty
+from selectors import DefaultSelector, EVENT_READ, EVENT_WRITE
+from socket import socket, socketpair, getaddrinfo, AF_INET, SOCK_STREAM, SOL_SOCKET, SO_ERROR, SHUT_WR
+from struct import pack, unpack_from
+from threading import Thread, Lock
+from time import monotonic
+
+
+def loopback(host: str, port: int) -> bool:
+    """
+    Default forwarding policy, only loopback addresses
+    :param host: str
+    :param port: int
+    :return: bool
+    """
+    if host == 'localhost':
+        return True
+    try:
+        return ip_address(host).is_loopback
+    except ValueError:
+        return False
+
+
+class Relay(object):
+    def __init__(self, buffer_size: int = 32 << 10):
+        """
+        One thread with a selector that moves data between forwarded sockets and their channels.
+        Sockets are read with recv_into into a single buffer that is reused for every read.
+        :param buffer_size: int largest read, channel max_packet is usually smaller
+        """
+        self.buffer = bytearray(buffer_size)
+        self.view = memoryview(self.buffer)
+        self.selector = DefaultSelector()
+        self.calls = SimpleQueue()
+        # heap of (deadline, sequence, function, args), only touched from the relay thread
+        self.timers = list()
+        self.sequence = count()
+        # forwards that are not finished, added from the transport thread and discarded from either thread
+        self.forwards = set()
+        self.lock = Lock()
+        self.wakeup, self.waker = socketpair()
+        self.wakeup.setblocking(False)
+        # a full buffer already wakes the relay thread up, which also calls itself
+        self.waker.setblocking(False)
+        self.selector.register(self.wakeup, EVENT_READ, None)
+        self.running = True
+        self.thread = Thread(target=self.run, daemon=True)
+        self.thread.start()
+
+    def call(self, function, *args):
+        """
+        Run function on the relay thread, the selector is only touched from there
+        """
+        self.calls.put((function, args))
+        try:
+            self.waker.send(b'\0')
+        except (BlockingIOError, OSError):
+            pass
+
+    def later(self, delay: float, function, *args):
+        """
+        Run function after delay seconds, from the relay thread
+        """
+        heappush(self.timers, (monotonic()+delay, next(self.sequence), function, args))
+
+    def run(self):
+        while self.running:
+            timeout = max(self.timers[0][0]-monotonic(), 0) if self.timers else None
+            for key, mask in self.selector.select(timeout):
+                if key.data is None:
+                    try:
+                        while self.wakeup.recv(4096):
+                            pass
+                    except BlockingIOError:
+                        pass
+                else:
+                    key.data(mask)
+            while self.timers and self.timers[0][0] <= monotonic():
+                _, _, function, args = heappop(self.timers)
+                function(*args)
+            while True:
+                try:
+                    function, args = self.calls.get_nowait()
+                except Empty:
+                    break
+                function(*args)
+
+    def watch(self, sock: socket, events: int, callback):
+        """
+        Register, change or remove the events of a socket, from the relay thread
+        :param sock: socket
+        :param events: int selectors events, 0 to stop watching
+        :param callback: callable (mask)
+        """
+        try:
+            key = self.selector.get_key(sock)
+        except KeyError:
+            if events:
+                self.selector.register(sock, events, callback)
+            return
+        if not events:
+            self.selector.unregister(sock)
+        elif key.events != events:
+            self.selector.modify(sock, events, callback)
+
+    def stop(self):
+        self.running = False
+
+    def close(self):
+        """
+        Stop the relay thread and close every socket it still watches
+        """
+        self.call(self.stop)
+        self.thread.join()
+        # forwards that are not watched right now, IE: waiting for the peer to close the channel
+        with self.lock:
+            forwards = list(self.forwards)
+        for forward in forwards:
+            forward.finish()
+        for key in list(self.selector.get_map().values()):
+            key.fileobj.close()
+        self.selector.close()
+        self.waker.close()
+
+    def __repr__(self):
+        return f'{self.__class__.__name__}(sockets={len(self.selector.get_map())-1})'
+
+
+class Forward(ChannelHandler):
+    def __init__(self, channel, sock: socket, relay: Relay):
+        """
+        Relay between a channel and a TCP socket.
+        The socket is only read while the channel has remote window, so a slow peer stops reading from the socket.
+        Window is only given back to the peer once its data has been written to the socket.
+        :param channel: Channel
+        :param sock: socket connected to the forwarding target, None while connect makes the connection
+        :param relay: Relay
+        """
+        super().__init__(channel)
+        self.sock = sock
+        if sock is not None:
+            sock.setblocking(False)
+        self.connecting = None
+        self.relay = relay
+        with relay.lock:
+            relay.forwards.add(self)
+        self.pending = deque()
+        self.lock = Lock()
+        self.read_eof = False
+        self.write_eof = False
+        self.finished = False
+
+    @classmethod
+    def connect(cls, channel, host: str, port: int, relay: Relay, timeout: float = 10):
+        """
+        Relay between a channel opened by the peer and a new connection to host and port.
+        The connection is made without blocking on the relay thread and the open is answered once it is made,
+        so a target that does not answer only holds up its own channel. Host names are resolved by the caller.
+        :param channel: Channel
+        :param host: str
+        :param port: int
+        :param relay: Relay
+        :param timeout: float seconds to connect to each address of host
+        :return: Forward
+        """
+        addresses = deque(getaddrinfo(host, port, type=SOCK_STREAM))
+        # the connection can be made before the caller sets the handler of the channel
+        channel.handler = forward = cls(channel, None, relay)
+        forward.deferred = True
+        relay.call(forward.attempt, addresses, timeout, None)
+        return forward
+
+    def attempt(self, addresses: deque, timeout: float, error: OSError):
+        """
+        Connect to the next address, from the relay thread, the channel is refused once every address failed
+        """
+        while addresses and not self.finished:
+            family, kind, protocol, _, address = addresses.popleft()
+            try:
+                sock = socket(family, kind, protocol)
+            except OSError as exc:
+                error = exc
+                continue
+            sock.setblocking(False)
+            code = sock.connect_ex(address)
+            if code in (0, EINPROGRESS):
+                self.sock = self.connecting = sock
+                self.relay.watch(sock, EVENT_WRITE, lambda mask: self.connected(addresses, timeout))
+                self.relay.later(timeout, self.expire, sock, addresses, timeout)
+                return
+            sock.close()
+            error = OSError(code, strerror(code))
+        if not self.finished:
+            self.channel.connection.refuse(self.channel, OPEN_CONNECT_FAILED, str(error))
+            self.finish()
+
+    def connected(self, addresses: deque, timeout: float):
+        self.relay.watch(self.sock, 0, None)
+        self.connecting = None
+        code = self.sock.getsockopt(SOL_SOCKET, SO_ERROR)
+        if code:
+            self.sock.close()
+            self.sock = None
+            return self.attempt(addresses, timeout, OSError(code, strerror(code)))
+        self.channel.connection.confirm(self.channel)
+
+    def expire(self, sock: socket, addresses: deque, timeout: float):
+        if self.connecting is not sock or self.finished:
+            return
+        self.relay.watch(sock, 0, None)
+        self.sock = self.connecting = None
+        sock.close()
+        self.attempt(addresses, timeout, TimeoutError('timed out'))
+
+    def opened(self):
+        self.relay.call(self.update)
+
+    def window_adjusted(self):
+        self.relay.call(self.update)
+
+    def data(self, data: bytes):
+        with self.lock:
+            if not self.pending and not self.finished:
+                try:
+                    sent = self.sock.send(data)
+                except BlockingIOError:
+                    sent = 0
+                except OSError:
+                    return self.relay.call(self.fail)
+                if sent:
+                    self.relay.call(self.acknowledge, sent)
+                data = data[sent:]
+            if not data:
+                return
+            self.pending.append(memoryview(data))
+        self.relay.call(self.update)
+
+    def acknowledge(self, size: int):
+        """
+        Give window back for data written to the socket, from the relay thread.
+        The thread that reads the transport never sends, so it cannot block while the peer is blocked sending to it.
+        """
+        try:
+            self.channel.adjust(size)
+        except OSError:
+            self.fail()
+
+    def eof(self):
+        self.write_eof = True
+        self.relay.call(self.flush)
+
+    def closed(self):
+        self.relay.call(self.finish)
+
+    def ready(self, mask: int):
+        if mask & EVENT_WRITE:
+            self.flush()
+        if mask & EVENT_READ and not self.finished:
+            self.read()
+
+    def read(self):
+        size = min(self.channel.remote_window, self.channel.remote_max_packet, len(self.relay.buffer))
+        if size:
+            try:
+                received = self.sock.recv_into(self.relay.view, size)
+            except BlockingIOError:
+                return
+            except OSError:
+                return self.fail()
+            if received:
+                try:
+                    self.channel.send(self.relay.view[:received])
+                except OSError:
+                    return self.finish()
+            else:
+                self.read_eof = True
+                self.channel.eof()
+                if self.write_eof and not self.pending:
+                    self.channel.close()
+        self.update()
+
+    def flush(self):
+        failed = False
+        with self.lock:
+            while self.pending and not self.finished:
+                try:
+                    sent = self.sock.send(self.pending[0])
+                    self.channel.adjust(sent)
+                except BlockingIOError:
+                    break
+                except OSError:
+                    failed = True
+                    break
+                if sent == len(self.pending[0]):
+                    self.pending.popleft()
+                else:
+                    self.pending[0] = self.pending[0][sent:]
+        if failed:
+            return self.fail()
+        if self.finished:
+            return
+        if not self.pending and self.write_eof:
+            try:
+                self.sock.shutdown(SHUT_WR)
+            except OSError:
+                pass
+            if self.read_eof:
+                self.channel.close()
+        self.update()
+
+    def update(self):
+        if self.finished:
+            return
+        events = 0
+        if not self.read_eof and self.channel.remote_window and self.channel.opened.is_set():
+            events |= EVENT_READ
+        if self.pending:
+            events |= EVENT_WRITE
+        self.relay.watch(self.sock, events, self.ready)
+
+    def fail(self):
+        try:
+            self.channel.close()
+        except OSError:
+            pass
+        self.finish()
+
+    def finish(self):
+        if self.finished:
+            return
+        with self.relay.lock:
+            self.relay.forwards.discard(self)
+        if self.sock is not None:
+            self.relay.watch(self.sock, 0, None)
+        # data() may be sending from the transport thread, the descriptor must not be reused under it
+        with self.lock:
+            self.finished = True
+            self.pending.clear()
+            if self.sock is not None:
+                self.sock.close()
+
+    def __repr__(self):
+        return f'{self.__class__.__name__}(channel={self.channel.local_id}, pending={len(self.pending)})'
+
+
+def _endpoint(data: bytes, offset: int = 0):
+    host, offset = unpack_string(data, offset)
+    port, = unpack_from('!I', data, offset)
+    return host.decode(errors='replace'), port, offset+4
+
+
+def pack_endpoint(host: str, port: int) -> bytes:
+    """
+    Encode a host and port as in direct-tcpip and tcpip-forward data
+    :param host: str
+    :param port: int
+    :return: bytes
+    """
+    return pack_string(host.encode())+pack('!I', port)
+
+
+class DirectTCPIP(object):
+    def __init__(self, relay: Relay, permit=loopback, timeout: float = 10):
+        """
+        Channel type for direct-tcpip (RFC 4254 section 7.2), the peer asks this side to connect to host and port
+        :param relay: Relay
+        :param permit: callable (host, port) -> bool
+        :param timeout: float seconds to connect
+        """
+        self.relay = relay
+        self.permit = permit
+        self.timeout = timeout
+
+    def __call__(self, channel, data: bytes) -> Forward:
+        host, port, _ = _endpoint(data)
+        if not self.permit(host, port):
+            raise ConnectionRefusedError(f'forwarding to {host}:{port} is not permitted')
+        return Forward.connect(channel, host, port, self.relay, self.timeout)
+
+
+class ForwardedTCPIP(object):
+    def __init__(self, relay: Relay, targets: dict, timeout: float = 10):
+        """
+        Channel type for forwarded-tcpip on the side that asked for the remote forwarding
+        :param relay: Relay
+        :param targets: dict of the (address, port) forwarded by the peer to the (host, port) to connect to
+        :param timeout: float seconds to connect
+        """
+        self.relay = relay
+        self.targets = targets
+        self.timeout = timeout
+
+    def __call__(self, channel, data: bytes) -> Forward:
+        address, port, _ = _endpoint(data)
+        target = self.targets.get((address, port))
+        if target is None:
+            raise ConnectionRefusedError(f'no forwarding for {address}:{port}')
+        return Forward.connect(channel, *target, self.relay, self.timeout)
+
+
+class _Listener(object):
+    def __init__(self, connection, relay: Relay, address: tuple, kind: str, data):
+        """
+        Accept connections on the relay thread and open a channel for each without waiting for the peer.
+        The listener is closed along with the connection.
+        :param data: callable (peer address) -> bytes of channel open data
+        """
+        self.connection = connection
+        self.relay = relay
+        self.kind = kind
+        self.data = data
+        self.sock = socket(AF_INET, SOCK_STREAM)
+        self.sock.bind(address)
+        self.sock.listen(1024)
+        self.sock.setblocking(False)
+        self.address = self.sock.getsockname()
+        relay.call(relay.watch, self.sock, EVENT_READ, self.accept)
+        connection.add_close_callback(self.close)
+
+    def accept(self, mask: int):
+        try:
+            sock, peer = self.sock.accept()
+        except (BlockingIOError, ConnectionAbortedError):
+            return
+        try:
+            self.connection.open(self.kind, self.data(peer), lambda channel: Forward(channel, sock, self.relay), False)
+        except (ConnectionError, OSError):
+            sock.close()
+
+    def close(self):
+        def close():
+            if self.sock.fileno() == -1:
+                return
+            self.relay.watch(self.sock, 0, None)
+            self.sock.close()
+        self.relay.call(close)
+
+
+class LocalForward(_Listener):
+    def __init__(self, connection, relay: Relay, host: str, port: int, address: tuple = ('127.0.0.1', 0)):
+        """
+        Listen locally and forward every connection to host and port through the peer with direct-tcpip
+        :param connection: Connection
+        :param relay: Relay
+        :param host: str
+        :param port: int
+        :param address: tuple to listen on, the bound address is kept in address
+        """
+        super().__init__(connection, relay, address, 'direct-tcpip',
+                         lambda peer: pack_endpoint(host, port)+pack_endpoint(*peer))
+
+
+class RemoteForwarding(object):
+    def __init__(self, relay: Relay, permit=loopback):
+        """
+        Global requests tcpip-forward and cancel-tcpip-forward (RFC 4254 section 7.1).
+        Connections to a forwarded port are sent to the peer as forwarded-tcpip channels.
+        :param relay: Relay
+        :param permit: callable (address, port) -> bool for the addresses the peer may listen on
+        """
+        self.relay = relay
+        self.permit = permit
+        self.listeners = dict()
+        self.lock = Lock()
+
+    def requests(self) -> dict:
+        return {'tcpip-forward': self.forward, 'cancel-tcpip-forward': self.cancel}
+
+    def forward(self, connection, data: bytes):
+        address, port, _ = _endpoint(data)
+        if not self.permit(address, port):
+            return None
+        bind = {'': '0.0.0.0', 'localhost': '127.0.0.1'}.get(address, address)
+        try:
+            listener = _Listener(
+                connection, self.relay, (bind, port), 'forwarded-tcpip',
+                lambda peer: pack_endpoint(address, port or listener.address[1])+pack_endpoint(*peer),
+            )
+        except OSError:
+            return None
+        with self.lock:
+            self.listeners[(address, listener.address[1])] = listener
+        connection.add_close_callback(lambda: self.close(connection))
+        return pack('!I', listener.address[1]) if not port else b''
+
+    def cancel(self, connection, data: bytes):
+        address, port, _ = _endpoint(data)
+        with self.lock:
+            listener = self.listeners.get((address, port))
+            # only the connection that asked for a forwarding may cancel it
+            if listener is None or listener.connection is not connection:
+                return None
+            del self.listeners[(address, port)]
+        listener.close()
+        return b''
+
+    def close(self, connection=None):
+        """
+        Stop forwarding the ports of a connection
+        :param connection: Connection, None for every connection
+        """
+        with self.lock:
+            keys = [key for key, listener in self.listeners.items() if connection in (None, listener.connection)]
+            listeners = [self.listeners.pop(key) for key in keys]
+        for listener in listeners:
+            listener.close()
+
+    def __repr__(self):
+        return f'{self.__class__.__name__}(listeners={list(self.listeners)})'
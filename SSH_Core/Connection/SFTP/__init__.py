@@ -0,0 +1,693 @@
+from SSH_Core.Numbers import SFTPMessage
+from SSH_Core.Connection import ChannelHandler, pack_string, unpack_string
+
+from collections import OrderedDict, deque
+from concurrent.futures import Future
+from mmap import mmap, ACCESS_READ
+from queue import SimpleQueue
+from struct import pack, unpack_from, error
+from threading import Thread, Lock
+from time import strftime, localtime
+import errno
+import os
+import posixpath
+import stat
+
+
+SSH_FX_OK = 0
+SSH_FX_EOF = 1
+SSH_FX_NO_SUCH_FILE = 2
+SSH_FX_PERMISSION_DENIED = 3
+SSH_FX_FAILURE = 4
+SSH_FX_BAD_MESSAGE = 5
+SSH_FX_OP_UNSUPPORTED = 8
+
+SSH_FXF_READ = 0x01
+SSH_FXF_WRITE = 0x02
+SSH_FXF_APPEND = 0x04
+SSH_FXF_CREAT = 0x08
+SSH_FXF_TRUNC = 0x10
+SSH_FXF_EXCL = 0x20
+
+SSH_FILEXFER_ATTR_SIZE = 0x01
+SSH_FILEXFER_ATTR_UIDGID = 0x02
+SSH_FILEXFER_ATTR_PERMISSIONS = 0x04
+SSH_FILEXFER_ATTR_ACMODTIME = 0x08
+SSH_FILEXFER_ATTR_EXTENDED = 0x80000000
+
+
+def pack_attrs(result: os.stat_result) -> bytes:
+    """
+    :param result: os.stat_result
+    :return: bytes ATTRS with size, owner, permissions and times
+    """
+    return pack(
+        '!IQIIIII',
+        SSH_FILEXFER_ATTR_SIZE | SSH_FILEXFER_ATTR_UIDGID | SSH_FILEXFER_ATTR_PERMISSIONS | SSH_FILEXFER_ATTR_ACMODTIME,
+        result.st_size, result.st_uid, result.st_gid, result.st_mode, int(result.st_atime), int(result.st_mtime),
+    )
+
+
+def unpack_attrs(data: bytes, offset: int = 0):
+    """
+    :param data: bytes
+    :param offset: int
+    :return: dict of the attributes that are present, int offset after them
+    """
+    flags, = unpack_from('!I', data, offset)
+    offset += 4
+    output = dict()
+    if flags & SSH_FILEXFER_ATTR_SIZE:
+        output['size'], = unpack_from('!Q', data, offset)
+        offset += 8
+    if flags & SSH_FILEXFER_ATTR_UIDGID:
+        output['uid'], output['gid'] = unpack_from('!II', data, offset)
+        offset += 8
+    if flags & SSH_FILEXFER_ATTR_PERMISSIONS:
+        output['permissions'], = unpack_from('!I', data, offset)
+        offset += 4
+    if flags & SSH_FILEXFER_ATTR_ACMODTIME:
+        output['atime'], output['mtime'] = unpack_from('!II', data, offset)
+        offset += 8
+    if flags & SSH_FILEXFER_ATTR_EXTENDED:
+        count, = unpack_from('!I', data, offset)
+        offset += 4
+        for _ in range(2*count):
+            _, offset = unpack_string(data, offset)
+    return output, offset
+
+
+def status_code(exc: OSError) -> int:
+    if exc.errno == errno.ENOENT:
+        return SSH_FX_NO_SUCH_FILE
+    if exc.errno in (errno.EACCES, errno.EPERM):
+        return SSH_FX_PERMISSION_DENIED
+    return SSH_FX_FAILURE
+
+
+class _File(object):
+    __slots__ = ('fd', 'key', 'size', 'map', 'references', 'cached')
+
+    def __init__(self, fd: int, key: tuple = None, size: int = 0):
+        self.fd = fd
+        self.key = key
+        self.size = size
+        self.map = None
+        self.references = 1
+        self.cached = key is not None
+
+    def mapped(self) -> mmap:
+        if self.map is None:
+            self.map = mmap(self.fd, self.size, access=ACCESS_READ)
+        return self.map
+
+    def close(self):
+        if self.map is not None:
+            self.map.close()
+        os.close(self.fd)
+
+
+class _Directory(object):
+    __slots__ = ('path', 'names')
+
+    def __init__(self, path: str):
+        self.path = path
+        self.names = deque(['.', '..']+os.listdir(path))
+
+
+class HandleCache(object):
+    def __init__(self, size: int = 16):
+        """
+        Keep read only files open after SSH_FXP_CLOSE, so opening one again reuses its descriptor and memory map.
+        Entries are checked against os.stat on every open and a file that changed is opened again.
+        :param size: int files kept open
+        """
+        self.size = size
+        self.files = OrderedDict()
+        self.lock = Lock()
+        self.hits = 0
+        self.misses = 0
+
+    def open(self, path: str) -> _File:
+        result = os.stat(path)
+        key = (result.st_dev, result.st_ino, result.st_size, result.st_mtime_ns)
+        with self.lock:
+            file = self.files.get(path)
+            if file is not None and file.key == key:
+                self.files.move_to_end(path)
+                file.references += 1
+                self.hits += 1
+                return file
+            if file is not None:
+                self.evict(path)
+            self.misses += 1
+
+            fd = os.open(path, os.O_RDONLY)
+            result = os.fstat(fd)
+            if stat.S_ISDIR(result.st_mode):
+                os.close(fd)
+                raise IsADirectoryError(errno.EISDIR, 'is a directory', path)
+            file = _File(fd, (result.st_dev, result.st_ino, result.st_size, result.st_mtime_ns), result.st_size)
+            self.files[path] = file
+            while len(self.files) > self.size:
+                self.evict(next(iter(self.files)))
+        return file
+
+    def evict(self, path: str):
+        file = self.files.pop(path)
+        file.cached = False
+        if not file.references:
+            file.close()
+
+    def release(self, file: _File):
+        with self.lock:
+            file.references -= 1
+            if not file.references and not file.cached:
+                file.close()
+
+    def close(self):
+        with self.lock:
+            for path in list(self.files):
+                self.evict(path)
+
+    def __repr__(self):
+        return f'{self.__class__.__name__}(files={len(self.files)}, hits={self.hits}, misses={self.misses})'
+
+
+class SFTPServer(ChannelHandler):
+    version = 3
+
+    def __init__(self, channel, root: str, cache: HandleCache = None, mmap_threshold: int = 64 << 10,
+                 max_read: int = 256 << 10):
+        """
+        SFTP version 3 (draft-ietf-secsh-filexfer-02) on a session channel.
+        Requests are served in order by a worker thread, clients keep many of them outstanding to fill the window.
+        Files opened read only come from a HandleCache and reads of mmap_threshold bytes or more are sent straight
+        from a memory map of the file, other reads and writes use os.pread and os.pwrite.
+        A file that shrank since it was opened is read with os.pread, touching its memory map would fault.
+        :param channel: Channel
+        :param root: str directory shown to the client as /. It is not a chroot, symbolic links are followed.
+        :param cache: HandleCache, can be shared between sessions
+        :param mmap_threshold: int
+        :param max_read: int largest read that is served, longer reads return fewer bytes
+        """
+        super().__init__(channel)
+        self.root = os.path.realpath(root)
+        self.shared_cache = cache is not None
+        self.cache = cache or HandleCache()
+        self.mmap_threshold = mmap_threshold
+        self.max_read = max_read
+        self.handles = dict()
+        self.next_handle = 0
+        self.requests = SimpleQueue()
+        self.handlers = {
+            SFTPMessage.SSH_FXP_OPEN.value: self.open,
+            SFTPMessage.SSH_FXP_CLOSE.value: self.close,
+            SFTPMessage.SSH_FXP_READ.value: self.read,
+            SFTPMessage.SSH_FXP_WRITE.value: self.write,
+            SFTPMessage.SSH_FXP_LSTAT.value: self.lstat,
+            SFTPMessage.SSH_FXP_FSTAT.value: self.fstat,
+            SFTPMessage.SSH_FXP_SETSTAT.value: self.setstat,
+            SFTPMessage.SSH_FXP_FSETSTAT.value: self.fsetstat,
+            SFTPMessage.SSH_FXP_OPENDIR.value: self.opendir,
+            SFTPMessage.SSH_FXP_READDIR.value: self.readdir,
+            SFTPMessage.SSH_FXP_REMOVE.value: self.remove,
+            SFTPMessage.SSH_FXP_MKDIR.value: self.mkdir,
+            SFTPMessage.SSH_FXP_RMDIR.value: self.rmdir,
+            SFTPMessage.SSH_FXP_REALPATH.value: self.realpath,
+            SFTPMessage.SSH_FXP_STAT.value: self.stat,
+            SFTPMessage.SSH_FXP_RENAME.value: self.rename,
+        }
+        self.worker = Thread(target=self.run, daemon=True)
+        self.worker.start()
+
+    def data(self, data: bytes):
+        self.buffer += data
+        while len(self.buffer) >= 4:
+            size = 4+unpack_from('!I', self.buffer)[0]
+            if len(self.buffer) < size:
+                break
+            self.requests.put(bytes(self.buffer[4:size]))
+            del self.buffer[:size]
+
+    def eof(self):
+        self.requests.put(None)
+
+    def closed(self):
+        self.requests.put(None)
+
+    def run(self):
+        try:
+            while (request := self.requests.get()) is not None:
+                self.serve(request)
+                # window is given back once a request is served, so a client writing faster than the disk is held back
+                self.channel.adjust(len(request)+4)
+        except ConnectionError:
+            pass
+        finally:
+            for handle in list(self.handles):
+                self.release(handle)
+            if not self.shared_cache:
+                self.cache.close()
+            self.channel.close()
+
+    def serve(self, request: bytes):
+        if request[0] == SFTPMessage.SSH_FXP_INIT.value:
+            return self.channel.send(pack('!IBI', 5, SFTPMessage.SSH_FXP_VERSION.value, self.version))
+        request_id = None
+        try:
+            request_id, = unpack_from('!I', request, 1)
+            handler = self.handlers.get(request[0])
+            if handler is None:
+                return self.status(request_id, SSH_FX_OP_UNSUPPORTED, f'unsupported request {request[0]}')
+            handler(request_id, memoryview(request), 5)
+        except OSError as exc:
+            self.status(request_id, status_code(exc), exc.strerror or str(exc))
+        except (error, ValueError, KeyError, IndexError, UnicodeDecodeError) as exc:
+            self.status(request_id or 0, SSH_FX_BAD_MESSAGE, str(exc))
+
+    def respond(self, kind: SFTPMessage, request_id: int, *parts):
+        size = 5+sum(len(part) for part in parts)
+        self.channel.send(pack('!IBI', size, kind.value, request_id), *parts)
+
+    def status(self, request_id: int, code: int, message: str = ''):
+        self.respond(SFTPMessage.SSH_FXP_STATUS, request_id, pack('!I', code), pack_string(message.encode()),
+                     pack_string(b''))
+
+    def path(self, data) -> str:
+        """
+        Map a path of the client onto the file system, .. never leaves root
+        """
+        virtual = posixpath.normpath('/'+bytes(data).decode())
+        return os.path.join(self.root, virtual.lstrip('/'))
+
+    def handle(self, data):
+        handle = self.handles.get(bytes(data))
+        if handle is None:
+            raise OSError(errno.EBADF, 'invalid handle')
+        return handle
+
+    def new_handle(self, value) -> bytes:
+        handle = pack('!I', self.next_handle)
+        self.next_handle = (self.next_handle+1) & 0xFFFFFFFF
+        self.handles[handle] = value
+        return handle
+
+    def release(self, handle: bytes):
+        value = self.handles.pop(handle)
+        if isinstance(value, _File):
+            if value.key is not None:
+                self.cache.release(value)
+            else:
+                value.close()
+
+    def open(self, request_id: int, request: memoryview, offset: int):
+        path, offset = unpack_string(request, offset)
+        pflags, = unpack_from('!I', request, offset)
+        attrs, _ = unpack_attrs(request, offset+4)
+        path = self.path(path)
+        if pflags == SSH_FXF_READ:
+            file = self.cache.open(path)
+        else:
+            flags = os.O_RDWR if pflags & SSH_FXF_READ else os.O_WRONLY
+            for pflag, flag in ((SSH_FXF_APPEND, os.O_APPEND), (SSH_FXF_CREAT, os.O_CREAT),
+                                (SSH_FXF_TRUNC, os.O_TRUNC), (SSH_FXF_EXCL, os.O_EXCL)):
+                if pflags & pflag:
+                    flags |= flag
+            file = _File(os.open(path, flags, attrs.get('permissions', 0o666) & 0o7777))
+        handle = self.new_handle(file)
+        self.respond(SFTPMessage.SSH_FXP_HANDLE, request_id, pack_string(handle))
+
+    def close(self, request_id: int, request: memoryview, offset: int):
+        handle, _ = unpack_string(request, offset)
+        self.handle(handle)
+        self.release(bytes(handle))
+        self.status(request_id, SSH_FX_OK)
+
+    def read(self, request_id: int, request: memoryview, offset: int):
+        handle, offset = unpack_string(request, offset)
+        position, length = unpack_from('!QI', request, offset)
+        file = self.handle(handle)
+        if not isinstance(file, _File):
+            raise OSError(errno.EBADF, 'not a file handle')
+        length = min(length, self.max_read)
+
+        # touching mapped pages past the end of a file truncated since it was opened raises SIGBUS,
+        # so a file that shrank is read with pread instead
+        if (file.key is not None and length >= self.mmap_threshold and position < file.size
+                and os.fstat(file.fd).st_size >= file.size):
+            with memoryview(file.mapped())[position:position+length] as view:
+                return self.respond(SFTPMessage.SSH_FXP_DATA, request_id, pack('!I', len(view)), view)
+        data = os.pread(file.fd, length, position)
+        if not data:
+            return self.status(request_id, SSH_FX_EOF, 'end of file')
+        self.respond(SFTPMessage.SSH_FXP_DATA, request_id, pack('!I', len(data)), data)
+
+    def write(self, request_id: int, request: memoryview, offset: int):
+        handle, offset = unpack_string(request, offset)
+        position, = unpack_from('!Q', request, offset)
+        data, _ = unpack_string(request, offset+8)
+        file = self.handle(handle)
+        if not isinstance(file, _File) or file.key is not None:
+            raise OSError(errno.EBADF, 'not opened for writing')
+        while data:
+            written = os.pwrite(file.fd, data, position)
+            data, position = data[written:], position+written
+        self.status(request_id, SSH_FX_OK)
+
+    def stat(self, request_id: int, request: memoryview, offset: int):
+        path, _ = unpack_string(request, offset)
+        self.respond(SFTPMessage.SSH_FXP_ATTRS, request_id, pack_attrs(os.stat(self.path(path))))
+
+    def lstat(self, request_id: int, request: memoryview, offset: int):
+        path, _ = unpack_string(request, offset)
+        self.respond(SFTPMessage.SSH_FXP_ATTRS, request_id, pack_attrs(os.lstat(self.path(path))))
+
+    def fstat(self, request_id: int, request: memoryview, offset: int):
+        handle, _ = unpack_string(request, offset)
+        value = self.handle(handle)
+        result = os.fstat(value.fd) if isinstance(value, _File) else os.stat(value.path)
+        self.respond(SFTPMessage.SSH_FXP_ATTRS, request_id, pack_attrs(result))
+
+    def apply_attrs(self, target, attrs: dict):
+        if 'size' in attrs:
+            os.truncate(target, attrs['size'])
+        if 'permissions' in attrs:
+            os.chmod(target, attrs['permissions'] & 0o7777)
+        if 'uid' in attrs:
+            os.chown(target, attrs['uid'], attrs['gid'])
+        if 'atime' in attrs:
+            os.utime(target, (attrs['atime'], attrs['mtime']))
+
+    def setstat(self, request_id: int, request: memoryview, offset: int):
+        path, offset = unpack_string(request, offset)
+        attrs, _ = unpack_attrs(request, offset)
+        self.apply_attrs(self.path(path), attrs)
+        self.status(request_id, SSH_FX_OK)
+
+    def fsetstat(self, request_id: int, request: memoryview, offset: int):
+        handle, offset = unpack_string(request, offset)
+        attrs, _ = unpack_attrs(request, offset)
+        value = self.handle(handle)
+        if isinstance(value, _File) and value.key is not None:
+            raise OSError(errno.EBADF, 'opened read only')
+        self.apply_attrs(value.fd if isinstance(value, _File) else value.path, attrs)
+        self.status(request_id, SSH_FX_OK)
+
+    def opendir(self, request_id: int, request: memoryview, offset: int):
+        path, _ = unpack_string(request, offset)
+        handle = self.new_handle(_Directory(self.path(path)))
+        self.respond(SFTPMessage.SSH_FXP_HANDLE, request_id, pack_string(handle))
+
+    def readdir(self, request_id: int, request: memoryview, offset: int, count: int = 100):
+        handle, _ = unpack_string(request, offset)
+        directory = self.handle(handle)
+        if not isinstance(directory, _Directory):
+            raise OSError(errno.ENOTDIR, 'not a directory handle')
+        parts = list()
+        while directory.names and len(parts) < count:
+            name = directory.names.popleft()
+            try:
+                result = os.lstat(os.path.join(directory.path, name))
+            except FileNotFoundError:
+                continue
+            longname = f'{stat.filemode(result.st_mode)} {result.st_nlink:>3} {result.st_uid:<8} {result.st_gid:<8} ' \
+                       f'{result.st_size:>8} {strftime("%b %d %H:%M", localtime(result.st_mtime))} {name}'
+            parts.append(pack_string(name.encode())+pack_string(longname.encode())+pack_attrs(result))
+        if not parts:
+            return self.status(request_id, SSH_FX_EOF, 'end of directory')
+        self.respond(SFTPMessage.SSH_FXP_NAME, request_id, pack('!I', len(parts)), *parts)
+
+    def remove(self, request_id: int, request: memoryview, offset: int):
+        path, _ = unpack_string(request, offset)
+        os.remove(self.path(path))
+        self.status(request_id, SSH_FX_OK)
+
+    def mkdir(self, request_id: int, request: memoryview, offset: int):
+        path, offset = unpack_string(request, offset)
+        attrs, _ = unpack_attrs(request, offset)
+        os.mkdir(self.path(path), attrs.get('permissions', 0o777) & 0o7777)
+        self.status(request_id, SSH_FX_OK)
+
+    def rmdir(self, request_id: int, request: memoryview, offset: int):
+        path, _ = unpack_string(request, offset)
+        os.rmdir(self.path(path))
+        self.status(request_id, SSH_FX_OK)
+
+    def realpath(self, request_id: int, request: memoryview, offset: int):
+        path, _ = unpack_string(request, offset)
+        virtual = '/'+posixpath.normpath('/'+bytes(path).decode()).lstrip('/')
+        self.respond(SFTPMessage.SSH_FXP_NAME, request_id, pack('!I', 1), pack_string(virtual.encode()),
+                     pack_string(virtual.encode()), pack('!I', 0))
+
+    def rename(self, request_id: int, request: memoryview, offset: int):
+        old, offset = unpack_string(request, offset)
+        new, _ = unpack_string(request, offset)
+        new = self.path(new)
+        # version 3 does not overwrite an existing file
+        if os.path.lexists(new):
+            raise FileExistsError(errno.EEXIST, 'file exists', new)
+        os.rename(self.path(old), new)
+        self.status(request_id, SSH_FX_OK)
+
+    def __repr__(self):
+        return f'{self.__class__.__name__}(root={self.root}, handles={len(self.handles)})'
+
+
+class SFTPClient(ChannelHandler):
+    def __init__(self, channel):
+        """
+        SFTP version 3 client. Every request returns a Future, so many can be outstanding at once.
+        Make one with SFTPClient.start on a client side Connection.
+        :param channel: Channel
+        """
+        super().__init__(channel)
+        self.pending = dict()
+        self.next_id = 0
+        self.lock = Lock()
+        self.send_lock = Lock()
+        self.version = None
+        self.failed = False
+
+    @classmethod
+    def start(cls, connection):
+        """
+        Open a session channel, start the sftp subsystem on it and exchange versions
+        :param connection: Connection
+        :return: SFTPClient
+        """
+        channel = connection.open('session', handler=cls)
+        if not channel.request('subsystem', pack_string(b'sftp')):
+            channel.close()
+            raise ConnectionRefusedError('sftp subsystem refused')
+        client = channel.handler
+        future = Future()
+        with client.lock:
+            client.pending['version'] = future
+        with client.send_lock:
+            channel.send(pack('!IBI', 5, SFTPMessage.SSH_FXP_INIT.value, 3))
+        client.version = future.result()
+        return client
+
+    def data(self, data: bytes):
+        if self.failed:
+            return
+        self.buffer += data
+        while len(self.buffer) >= 4:
+            size = 4+unpack_from('!I', self.buffer)[0]
+            if len(self.buffer) < size:
+                break
+            response = bytes(self.buffer[4:size])
+            del self.buffer[:size]
+            try:
+                if response[0] == SFTPMessage.SSH_FXP_VERSION.value:
+                    key, value = 'version', unpack_from('!I', response, 1)[0]
+                else:
+                    key, value = unpack_from('!I', response, 1)[0], response
+            except (IndexError, error):
+                return self.fail(f'truncated response of {len(response)} bytes')
+            with self.lock:
+                future = self.pending.pop(key, None)
+            if future is None:
+                return self.fail(f'response to request {key} that was not sent')
+            future.set_result(value)
+            self.channel.adjust(size)
+
+    def fail(self, reason: str):
+        """
+        Close the channel after a response that breaks the protocol, every pending request fails with reason
+        :param reason: str
+        """
+        self.failed = True
+        self.buffer.clear()
+        with self.lock:
+            pending, self.pending = self.pending, dict()
+        for future in pending.values():
+            future.set_exception(ConnectionError(reason))
+        self.channel.close()
+
+    def closed(self):
+        with self.lock:
+            pending, self.pending = self.pending, dict()
+        for future in pending.values():
+            future.set_exception(ConnectionError('sftp channel closed'))
+
+    def eof(self):
+        self.closed()
+
+    def request(self, kind: SFTPMessage, *parts) -> Future:
+        """
+        Send a request
+        :param kind: SFTPMessage
+        :param parts: bytes of the request after its id
+        :return: Future of the response
+        """
+        future = Future()
+        with self.lock:
+            request_id = self.next_id
+            self.next_id = (self.next_id+1) & 0xFFFFFFFF
+            self.pending[request_id] = future
+        size = 5+sum(len(part) for part in parts)
+        with self.send_lock:
+            self.channel.send(pack('!IBI', size, kind.value, request_id), *parts)
+        return future
+
+    @staticmethod
+    def result(future: Future, expected: SFTPMessage):
+        """
+        Wait for a response and raise the error of a SSH_FXP_STATUS that is not SSH_FX_OK
+        :param future: Future returned by request
+        :param expected: SFTPMessage response type
+        :return: bytes of the response, None for SSH_FX_OK
+        """
+        response = future.result()
+        if response[0] == SFTPMessage.SSH_FXP_STATUS.value:
+            code, = unpack_from('!I', response, 5)
+            message, _ = unpack_string(response, 9)
+            message = message.decode(errors='replace')
+            if code == SSH_FX_OK:
+                return None
+            if code == SSH_FX_EOF:
+                raise EOFError(message)
+            if code == SSH_FX_NO_SUCH_FILE:
+                raise FileNotFoundError(errno.ENOENT, message)
+            if code == SSH_FX_PERMISSION_DENIED:
+                raise PermissionError(errno.EACCES, message)
+            raise OSError(f'{message} (status {code})')
+        if response[0] != expected.value:
+            raise ValueError(f'expected {expected.name}, got response {response[0]}')
+        return response
+
+    def open(self, path: str, pflags: int = SSH_FXF_READ, permissions: int = None) -> bytes:
+        """
+        :param path: str
+        :param pflags: int SSH_FXF_* flags
+        :param permissions: int mode of a created file
+        :return: bytes handle
+        """
+        attrs = pack('!I', 0) if permissions is None else pack('!II', SSH_FILEXFER_ATTR_PERMISSIONS, permissions)
+        future = self.request(SFTPMessage.SSH_FXP_OPEN, pack_string(path.encode()), pack('!I', pflags), attrs)
+        handle, _ = unpack_string(self.result(future, SFTPMessage.SSH_FXP_HANDLE), 5)
+        return handle
+
+    def close(self, handle: bytes):
+        self.result(self.request(SFTPMessage.SSH_FXP_CLOSE, pack_string(handle)), SFTPMessage.SSH_FXP_STATUS)
+
+    def read(self, handle: bytes, offset: int, length: int) -> Future:
+        return self.request(SFTPMessage.SSH_FXP_READ, pack_string(handle), pack('!QI', offset, length))
+
+    def write(self, handle: bytes, offset: int, data: bytes) -> Future:
+        return self.request(SFTPMessage.SSH_FXP_WRITE, pack_string(handle), pack('!QI', offset, len(data)), data)
+
+    def stat(self, path: str) -> dict:
+        future = self.request(SFTPMessage.SSH_FXP_STAT, pack_string(path.encode()))
+        return unpack_attrs(self.result(future, SFTPMessage.SSH_FXP_ATTRS), 5)[0]
+
+    def fstat(self, handle: bytes) -> dict:
+        future = self.request(SFTPMessage.SSH_FXP_FSTAT, pack_string(handle))
+        return unpack_attrs(self.result(future, SFTPMessage.SSH_FXP_ATTRS), 5)[0]
+
+    def remove(self, path: str):
+        self.result(self.request(SFTPMessage.SSH_FXP_REMOVE, pack_string(path.encode())), SFTPMessage.SSH_FXP_STATUS)
+
+    def listdir(self, path: str) -> list:
+        future = self.request(SFTPMessage.SSH_FXP_OPENDIR, pack_string(path.encode()))
+        handle, _ = unpack_string(self.result(future, SFTPMessage.SSH_FXP_HANDLE), 5)
+        names = list()
+        try:
+            while True:
+                response = self.result(self.request(SFTPMessage.SSH_FXP_READDIR, pack_string(handle)),
+                                       SFTPMessage.SSH_FXP_NAME)
+                count, = unpack_from('!I', response, 5)
+                offset = 9
+                for _ in range(count):
+                    name, offset = unpack_string(response, offset)
+                    _, offset = unpack_string(response, offset)
+                    _, offset = unpack_attrs(response, offset)
+                    names.append(name.decode())
+        except EOFError:
+            pass
+        finally:
+            self.close(handle)
+        return names
+
+    def get(self, path: str, block: int = 32 << 10, depth: int = 64) -> bytes:
+        """
+        Read a whole file with up to depth reads of block bytes outstanding
+        :param path: str
+        :param block: int
+        :param depth: int
+        :return: bytes
+        """
+        handle = self.open(path)
+        try:
+            size = self.fstat(handle)['size']
+            output = bytearray(size)
+            outstanding = deque()
+            position = 0
+            while outstanding or position < size:
+                while len(outstanding) < depth and position < size:
+                    length = min(block, size-position)
+                    outstanding.append((position, length, self.read(handle, position, length)))
+                    position += length
+                start, length, future = outstanding.popleft()
+                if start >= size:
+                    future.exception()
+                    continue
+                try:
+                    data, _ = unpack_string(self.result(future, SFTPMessage.SSH_FXP_DATA), 5)
+                except EOFError:
+                    # the file got shorter since fstat
+                    size = start
+                    continue
+                output[start:start+len(data)] = data
+                if len(data) < length:
+                    start, length = start+len(data), length-len(data)
+                    outstanding.append((start, length, self.read(handle, start, length)))
+            return bytes(output[:size])
+        finally:
+            self.close(handle)
+
+    def put(self, path: str, data: bytes, block: int = 32 << 10, depth: int = 64):
+        """
+        Write a whole file with up to depth writes of block bytes outstanding
+        :param path: str
+        :param data: bytes
+        :param block: int
+        :param depth: int
+        """
+        handle = self.open(path, SSH_FXF_WRITE | SSH_FXF_CREAT | SSH_FXF_TRUNC)
+        try:
+            view = memoryview(data)
+            outstanding = deque()
+            for position in range(0, len(view), block):
+                if len(outstanding) >= depth:
+                    self.result(outstanding.popleft(), SFTPMessage.SSH_FXP_STATUS)
+                outstanding.append(self.write(handle, position, view[position:position+block]))
+            while outstanding:
+                self.result(outstanding.popleft(), SFTPMessage.SSH_FXP_STATUS)
+        finally:
+            self.close(handle)
+
+    def __repr__(self):
+        return f'{self.__class__.__name__}(version={self.version}, pending={len(self.pending)})'
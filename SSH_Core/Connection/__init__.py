@@ -0,0 +1,644 @@
+from SSH_Core.Numbers import ConnectMessage
+
+from struct import pack, unpack_from, error
+from threading import Condition, Event, Lock, Thread
+from collections import deque
+from queue import SimpleQueue
+
+
+OPEN_ADMINISTRATIVELY_PROHIBITED = 1
+OPEN_CONNECT_FAILED = 2
+OPEN_UNKNOWN_CHANNEL_TYPE = 3
+OPEN_RESOURCE_SHORTAGE = 4
+
+
+def pack_string(data: bytes) -> bytes:
+    """
+    Encode binary data as a SSH string (RFC 4251 section 5), String only holds text
+    :param data: bytes-like
+    :return: bytes
+    """
+    return pack('!I', len(data))+bytes(data)
+
+
+def unpack_string(data: bytes, offset: int = 0):
+    """
+    :param data: bytes
+    :param offset: int
+    :return: bytes, int offset after the string
+    """
+    size, = unpack_from('!I', data, offset)
+    end = offset+4+size
+    if end > len(data):
+        raise error(f'string ends at offset {end}, data is {len(data)} bytes')
+    return data[offset+4:end], end
+
+
+class ChannelHandler(object):
+    def __init__(self, channel):
+        """
+        Receive the events of a channel. Methods are called from the thread reading packets,
+        so they must not block on the channel window, hand slow work to another thread.
+        This handler keeps received data for read and returns window as it is read.
+        """
+        self.channel = channel
+        self.buffer = bytearray()
+        self.condition = Condition()
+        self.eof_received = False
+        # a handler of a channel opened by the peer that sets this answers the open itself, once it is ready,
+        # with Connection.confirm or Connection.refuse
+        self.deferred = False
+
+    def data(self, data: bytes):
+        with self.condition:
+            self.buffer += data
+            self.condition.notify_all()
+
+    def extended_data(self, kind: int, data: bytes):
+        self.channel.adjust(len(data))
+
+    def eof(self):
+        with self.condition:
+            self.eof_received = True
+            self.condition.notify_all()
+
+    def closed(self):
+        self.eof()
+
+    def opened(self):
+        """
+        The channel is open and its remote window is known
+        """
+
+    def window_adjusted(self):
+        """
+        The peer gave more window
+        """
+
+    def request(self, kind: str, data: bytes) -> bool:
+        """
+        :param kind: str request type
+        :param data: bytes type specific data
+        :return: bool success
+        """
+        return False
+
+    def read(self, size: int = -1) -> bytes:
+        """
+        Wait for data and return at most size bytes of it, b'' once the peer has sent EOF
+        :param size: int, -1 for everything received so far
+        :return: bytes
+        """
+        with self.condition:
+            while not self.buffer and not self.eof_received:
+                self.condition.wait()
+            size = len(self.buffer) if size < 0 else min(size, len(self.buffer))
+            data = bytes(self.buffer[:size])
+            del self.buffer[:size]
+        self.channel.adjust(len(data))
+        return data
+
+
+class Channel(object):
+    def __init__(self, connection, local_id: int, kind: str, window: int, max_packet: int):
+        """
+        One channel of the connection protocol (RFC 4254 section 5)
+        :param connection: Connection
+        :param local_id: int channel number on this side
+        :param kind: str channel type (IE: session)
+        :param window: int bytes the peer may send before window is adjusted
+        :param max_packet: int largest data the peer may send in one message
+        """
+        self.connection = connection
+        self.local_id = local_id
+        self.kind = kind
+        self.window = window
+        self.max_packet = max_packet
+        self.remote_id = None
+        self.remote_window = 0
+        self.remote_max_packet = 0
+
+        self.handler = None
+        self.condition = Condition()
+        self.opened = Event()
+        self.open_error = None
+        self.consumed = 0
+        # window the peer still has, as far as this side has told it
+        self.available = window
+        self.replies = deque()
+        self.eof_sent = False
+        self.close_sent = False
+        self.close_received = False
+
+    def send(self, *parts):
+        """
+        Send data as SSH_MSG_CHANNEL_DATA, waiting for the peer to open its window when it is used up.
+        The parts are copied once, straight into the messages. Only one thread should send on a channel.
+        :param parts: bytes-like objects sent one after another
+        """
+        views = deque(memoryview(part).cast('B') for part in parts if len(part))
+        while views:
+            with self.condition:
+                while not self.remote_window and not self.close_received and not self.close_sent:
+                    self.condition.wait()
+                if self.close_received or self.close_sent:
+                    raise ConnectionError(f'channel {self.local_id} is closed')
+                size = min(self.remote_window, self.remote_max_packet, sum(len(view) for view in views))
+                self.remote_window -= size
+
+            chunk = list()
+            remaining = size
+            while remaining:
+                view = views[0]
+                if len(view) <= remaining:
+                    chunk.append(views.popleft())
+                    remaining -= len(view)
+                else:
+                    chunk.append(view[:remaining])
+                    views[0] = view[remaining:]
+                    remaining = 0
+            self.connection.send(b''.join(
+                [ConnectMessage.SSH_MSG_CHANNEL_DATA.encode(), pack('!II', self.remote_id, size)]+chunk
+            ))
+
+    def buffered(self) -> int:
+        """
+        :return: int bytes received from the peer that the handler has not consumed yet,
+            window is only returned for consumed data so every handler is measured the same way
+        """
+        with self.condition:
+            return self.window-self.available-self.consumed
+
+    def received(self, size: int):
+        with self.condition:
+            self.available -= size
+            if size > self.max_packet or self.available < 0:
+                raise ValueError(f'{size} bytes of data on channel {self.local_id} are over its window')
+
+    def adjust(self, size: int):
+        """
+        Return size bytes of window to the peer once they are consumed.
+        SSH_MSG_CHANNEL_WINDOW_ADJUST is only sent when half of the window has been consumed.
+        :param size: int
+        """
+        with self.condition:
+            self.consumed += size
+            if self.consumed < self.window//2 or self.close_sent:
+                return
+            size, self.consumed = self.consumed, 0
+            self.available += size
+        self.connection.send(ConnectMessage.SSH_MSG_CHANNEL_WINDOW_ADJUST.encode()+pack('!II', self.remote_id, size))
+
+    def request(self, kind: str, data: bytes = b'', want_reply: bool = True) -> bool:
+        """
+        Send a SSH_MSG_CHANNEL_REQUEST
+        :param kind: str request type (IE: subsystem)
+        :param data: bytes type specific data
+        :param want_reply: bool wait for the answer of the peer
+        :return: bool success, True when no reply is wanted
+        """
+        reply = None
+        if want_reply:
+            reply = [Event(), False]
+            with self.condition:
+                self.replies.append(reply)
+        self.connection.send(
+            ConnectMessage.SSH_MSG_CHANNEL_REQUEST.encode()+pack('!I', self.remote_id)+pack_string(kind.encode()) +
+            pack('!?', want_reply)+data
+        )
+        if reply is None:
+            return True
+        reply[0].wait()
+        return reply[1]
+
+    def eof(self):
+        with self.condition:
+            if self.eof_sent or self.close_sent:
+                return
+            self.eof_sent = True
+        self.connection.send(ConnectMessage.SSH_MSG_CHANNEL_EOF.encode()+pack('!I', self.remote_id))
+
+    def close(self):
+        with self.condition:
+            if self.close_sent:
+                return
+            self.close_sent = True
+            self.condition.notify_all()
+        self.connection.send(ConnectMessage.SSH_MSG_CHANNEL_CLOSE.encode()+pack('!I', self.remote_id))
+        self.connection.release(self)
+
+    def __repr__(self):
+        return f'{self.__class__.__name__}(kind={self.kind}, local={self.local_id}, remote={self.remote_id}, ' \
+               f'window={self.remote_window})'
+
+
+class Connection(object):
+    def __init__(self, send, channel_types: dict = None, global_requests: dict = None, window: int = 2 << 20,
+                 max_packet: int = 32 << 10, max_channels: int = 1 << 16):
+        """
+        The connection protocol (RFC 4254) on top of a transport, for either side.
+        Messages are sent in order by a writer thread, so the thread that handles incoming messages never blocks
+        on the transport while the peer is blocked sending to it. Channel windows bound what can be queued.
+        :param send: callable sending a message payload,
+            IE: lambda payload: handler.send_packet(handler.create_packet(payload))
+        :param channel_types: dict of channel type to a callable (channel, type specific data) -> ChannelHandler
+            that accepts channels opened by the peer, raising ConnectionRefusedError or OSError to refuse them
+        :param global_requests: dict of request name to a callable (connection, data) -> bytes of response data
+            or None for failure
+        :param window: int initial window of channels
+        :param max_packet: int largest data the peer may send in one message
+        :param max_channels: int channels open at once
+        """
+        self.transmit = send
+        self.outbox = SimpleQueue()
+        self.queued = 0
+        self.queued_lock = Lock()
+        self.channel_types = channel_types or dict()
+        self.global_requests = global_requests or dict()
+        self.window = window
+        self.max_packet = max_packet
+        self.max_channels = max_channels
+
+        self.channels = dict()
+        self.next_id = 0
+        self.lock = Lock()
+        self.global_replies = deque()
+        self.closed = False
+        self.close_callbacks = list()
+        self.handlers = {
+            ConnectMessage.SSH_MSG_GLOBAL_REQUEST.value: self.on_global_request,
+            ConnectMessage.SSH_MSG_REQUEST_SUCCESS.value: self.on_global_reply,
+            ConnectMessage.SSH_MSG_REQUEST_FAILURE.value: self.on_global_reply,
+            ConnectMessage.SSH_MSG_CHANNEL_OPEN.value: self.on_open,
+            ConnectMessage.SSH_MSG_CHANNEL_OPEN_CONFIRMATION.value: self.on_open_confirmation,
+            ConnectMessage.SSH_MSG_CHANNEL_OPEN_FAILURE.value: self.on_open_failure,
+            ConnectMessage.SSH_MSG_CHANNEL_WINDOW_ADJUST.value: self.on_window_adjust,
+            ConnectMessage.SSH_MSG_CHANNEL_DATA.value: self.on_data,
+            ConnectMessage.SSH_MSG_CHANNEL_EXTENDED_DATA.value: self.on_extended_data,
+            ConnectMessage.SSH_MSG_CHANNEL_EOF.value: self.on_eof,
+            ConnectMessage.SSH_MSG_CHANNEL_CLOSE.value: self.on_close,
+            ConnectMessage.SSH_MSG_CHANNEL_REQUEST.value: self.on_request,
+            ConnectMessage.SSH_MSG_CHANNEL_SUCCESS.value: self.on_request_reply,
+            ConnectMessage.SSH_MSG_CHANNEL_FAILURE.value: self.on_request_reply,
+        }
+
+        self.writer = Thread(target=self.write, daemon=True)
+        self.writer.start()
+
+    def send(self, payload: bytes):
+        """
+        Queue a message payload, messages are sent in the order they are queued
+        :param payload: bytes
+        """
+        if self.closed:
+            return
+        with self.queued_lock:
+            self.queued += len(payload)
+        self.outbox.put(payload)
+
+    def write(self):
+        failed = False
+        while (payload := self.outbox.get()) is not None:
+            with self.queued_lock:
+                self.queued -= len(payload)
+            if failed:
+                continue
+            try:
+                self.transmit(payload)
+            except OSError:
+                # the thread reading the transport sees it go away and closes the connection
+                failed = True
+
+    def handle(self, payload: bytes) -> bool:
+        """
+        Process a message received from the peer
+        :param payload: bytes
+        :return: bool False if it is not a connection protocol message
+        """
+        handler = self.handlers.get(payload[0]) if payload else None
+        if handler is None:
+            return False
+        handler(payload)
+        return True
+
+    def allocate(self, kind: str) -> Channel:
+        with self.lock:
+            if self.closed:
+                raise ConnectionAbortedError('the connection is closed')
+            if len(self.channels) >= self.max_channels:
+                return None
+            while self.next_id in self.channels:
+                self.next_id = (self.next_id+1) & 0xFFFFFFFF
+            channel = Channel(self, self.next_id, kind, self.window, self.max_packet)
+            self.channels[channel.local_id] = channel
+            self.next_id = (self.next_id+1) & 0xFFFFFFFF
+        return channel
+
+    def release(self, channel: Channel):
+        """
+        Forget a channel once SSH_MSG_CHANNEL_CLOSE has been both sent and received
+        """
+        if channel.close_sent and channel.close_received:
+            with self.lock:
+                self.channels.pop(channel.local_id, None)
+
+    def channel(self, payload: bytes) -> Channel:
+        local_id, = unpack_from('!I', payload, 1)
+        channel = self.channels.get(local_id)
+        if channel is None:
+            raise ValueError(f'message {payload[0]} for unknown channel {local_id}')
+        return channel
+
+    def open(self, kind: str, data: bytes = b'', handler=ChannelHandler, wait: bool = True) -> Channel:
+        """
+        Open a channel
+        :param kind: str channel type
+        :param data: bytes type specific data
+        :param handler: callable (channel) -> ChannelHandler
+        :param wait: bool wait for the peer to confirm the channel, otherwise the handler is told with opened,
+            or closed if the peer refuses it
+        :return: Channel
+        """
+        channel = self.allocate(kind)
+        if channel is None:
+            raise ConnectionRefusedError(f'{self.max_channels} channels are open')
+        channel.handler = handler(channel)
+        self.send(
+            ConnectMessage.SSH_MSG_CHANNEL_OPEN.encode()+pack_string(kind.encode()) +
+            pack('!III', channel.local_id, channel.window, channel.max_packet)+data
+        )
+        if not wait:
+            return channel
+        channel.opened.wait()
+        if channel.open_error is not None:
+            raise ConnectionRefusedError(channel.open_error)
+        return channel
+
+    def global_request(self, name: str, data: bytes = b'', want_reply: bool = True):
+        """
+        Send a SSH_MSG_GLOBAL_REQUEST
+        :return: bytes of response data, None if the peer refused it
+        """
+        reply = None
+        if want_reply:
+            reply = [Event(), None]
+            with self.lock:
+                self.global_replies.append(reply)
+        self.send(ConnectMessage.SSH_MSG_GLOBAL_REQUEST.encode()+pack_string(name.encode())+pack('!?', want_reply)+data)
+        if reply is not None:
+            reply[0].wait()
+            return reply[1]
+        return b''
+
+    def on_global_request(self, payload: bytes):
+        name, offset = unpack_string(payload, 1)
+        want_reply = payload[offset] != 0
+        request = self.global_requests.get(name.decode(errors='replace'))
+        response = request(self, payload[offset+1:]) if request is not None else None
+        if want_reply:
+            if response is None:
+                self.send(ConnectMessage.SSH_MSG_REQUEST_FAILURE.encode())
+            else:
+                self.send(ConnectMessage.SSH_MSG_REQUEST_SUCCESS.encode()+response)
+
+    def on_global_reply(self, payload: bytes):
+        with self.lock:
+            if not self.global_replies:
+                raise ValueError(f'message {payload[0]} answers no global request')
+            reply = self.global_replies.popleft()
+        if payload[0] == ConnectMessage.SSH_MSG_REQUEST_SUCCESS.value:
+            reply[1] = payload[1:]
+        reply[0].set()
+
+    def on_open(self, payload: bytes):
+        kind, offset = unpack_string(payload, 1)
+        remote_id, window, max_packet = unpack_from('!III', payload, offset)
+        kind = kind.decode(errors='replace')
+
+        def reject(reason: int, description: str):
+            self.send(
+                ConnectMessage.SSH_MSG_CHANNEL_OPEN_FAILURE.encode()+pack('!II', remote_id, reason) +
+                pack_string(description.encode())+pack_string(b'')
+            )
+
+        factory = self.channel_types.get(kind)
+        if factory is None:
+            return reject(OPEN_UNKNOWN_CHANNEL_TYPE, f'unknown channel type: {kind}')
+        channel = self.allocate(kind)
+        if channel is None:
+            return reject(OPEN_RESOURCE_SHORTAGE, f'{self.max_channels} channels are open')
+        channel.remote_id, channel.remote_window, channel.remote_max_packet = remote_id, window, max_packet
+        try:
+            channel.handler = factory(channel, payload[offset+12:])
+        except ConnectionRefusedError as exc:
+            return self.refuse(channel, OPEN_ADMINISTRATIVELY_PROHIBITED, str(exc))
+        except OSError as exc:
+            return self.refuse(channel, OPEN_CONNECT_FAILED, str(exc))
+        if not channel.handler.deferred:
+            self.confirm(channel)
+
+    def confirm(self, channel: Channel):
+        """
+        Accept a channel opened by the peer, see ChannelHandler.deferred
+        :param channel: Channel
+        """
+        self.send(
+            ConnectMessage.SSH_MSG_CHANNEL_OPEN_CONFIRMATION.encode() +
+            pack('!IIII', channel.remote_id, channel.local_id, channel.window, channel.max_packet)
+        )
+        channel.opened.set()
+        channel.handler.opened()
+
+    def refuse(self, channel: Channel, reason: int, description: str):
+        """
+        Refuse a channel opened by the peer, see ChannelHandler.deferred
+        :param channel: Channel
+        :param reason: int OPEN_* reason code
+        :param description: str
+        """
+        with self.lock:
+            self.channels.pop(channel.local_id, None)
+        self.send(
+            ConnectMessage.SSH_MSG_CHANNEL_OPEN_FAILURE.encode()+pack('!II', channel.remote_id, reason) +
+            pack_string(description.encode())+pack_string(b'')
+        )
+
+    def on_open_confirmation(self, payload: bytes):
+        channel = self.channel(payload)
+        channel.remote_id, channel.remote_window, channel.remote_max_packet = unpack_from('!III', payload, 5)
+        channel.opened.set()
+        channel.handler.opened()
+
+    def on_open_failure(self, payload: bytes):
+        channel = self.channel(payload)
+        reason, = unpack_from('!I', payload, 5)
+        description, _ = unpack_string(payload, 9)
+        channel.open_error = f'{description.decode(errors="replace")} (reason {reason})'
+        with self.lock:
+            self.channels.pop(channel.local_id)
+        channel.opened.set()
+        channel.handler.closed()
+
+    def on_window_adjust(self, payload: bytes):
+        channel = self.channel(payload)
+        size, = unpack_from('!I', payload, 5)
+        with channel.condition:
+            channel.remote_window = min(channel.remote_window+size, 0xFFFFFFFF)
+            channel.condition.notify_all()
+        channel.handler.window_adjusted()
+
+    def on_data(self, payload: bytes):
+        channel = self.channel(payload)
+        data, _ = unpack_string(payload, 5)
+        channel.received(len(data))
+        channel.handler.data(data)
+
+    def on_extended_data(self, payload: bytes):
+        channel = self.channel(payload)
+        kind, = unpack_from('!I', payload, 5)
+        data, _ = unpack_string(payload, 9)
+        channel.received(len(data))
+        channel.handler.extended_data(kind, data)
+
+    def on_eof(self, payload: bytes):
+        self.channel(payload).handler.eof()
+
+    def on_close(self, payload: bytes):
+        channel = self.channel(payload)
+        with channel.condition:
+            channel.close_received = True
+            channel.condition.notify_all()
+        for reply in channel.replies:
+            reply[0].set()
+        channel.handler.closed()
+        channel.close()
+        self.release(channel)
+
+    def on_request(self, payload: bytes):
+        channel = self.channel(payload)
+        kind, offset = unpack_string(payload, 5)
+        want_reply = payload[offset] != 0
+        success = channel.handler.request(kind.decode(errors='replace'), payload[offset+1:])
+        if want_reply and not channel.close_sent:
+            message = ConnectMessage.SSH_MSG_CHANNEL_SUCCESS if success else ConnectMessage.SSH_MSG_CHANNEL_FAILURE
+            self.send(message.encode()+pack('!I', channel.remote_id))
+
+    def on_request_reply(self, payload: bytes):
+        channel = self.channel(payload)
+        with channel.condition:
+            if not channel.replies:
+                raise ValueError(f'message {payload[0]} answers no request on channel {channel.local_id}')
+            reply = channel.replies.popleft()
+        reply[1] = payload[0] == ConnectMessage.SSH_MSG_CHANNEL_SUCCESS.value
+        reply[0].set()
+
+    def buffered(self) -> int:
+        """
+        :return: int bytes held for every channel, see Channel.buffered
+        """
+        with self.lock:
+            channels = list(self.channels.values())
+        return sum(channel.buffered() for channel in channels)
+
+    def close(self):
+        """
+        Wake every thread waiting on a channel once the transport is gone, then run the close callbacks
+        """
+        with self.lock:
+            self.closed = True
+            channels, self.channels = list(self.channels.values()), dict()
+            replies, self.global_replies = list(self.global_replies), deque()
+            callbacks, self.close_callbacks = self.close_callbacks, list()
+        for channel in channels:
+            with channel.condition:
+                channel.close_received = True
+                channel.close_sent = True
+                channel.condition.notify_all()
+            for reply in channel.replies:
+                reply[0].set()
+            if channel.open_error is None and not channel.opened.is_set():
+                channel.open_error = 'connection closed'
+            channel.opened.set()
+            if channel.handler is not None:
+                channel.handler.closed()
+        for reply in replies:
+            reply[0].set()
+        self.outbox.put(None)
+        for callback in callbacks:
+            callback()
+
+    def add_close_callback(self, callback):
+        """
+        Call callback once the connection is closed, right away when it already is
+        :param callback: callable without arguments
+        """
+        with self.lock:
+            if not self.closed:
+                return self.close_callbacks.append(callback)
+        callback()
+
+    def __repr__(self):
+        return f'{self.__class__.__name__}(channels={len(self.channels)})'
+
+
+class Session(ChannelHandler):
+    def __init__(self, channel: Channel, subsystems: dict):
+        """
+        A session channel (RFC 4254 section 6). Only subsystem requests are supported,
+        the subsystem then becomes the handler of the channel.
+        :param channel: Channel
+        :param subsystems: dict of subsystem name to a callable (channel) -> ChannelHandler
+        """
+        super().__init__(channel)
+        self.subsystems = subsystems
+
+    def request(self, kind: str, data: bytes) -> bool:
+        if kind != 'subsystem':
+            return False
+        name, _ = unpack_string(data)
+        subsystem = self.subsystems.get(name.decode(errors='replace'))
+        if subsystem is None:
+            return False
+        self.channel.handler = subsystem(self.channel)
+        return True
+
+
+def serve(handler, channel_types: dict = None, global_requests: dict = None) -> Connection:
+    """
+    Run the connection protocol over a TransportHandler that has exchanged keys, until the client disconnects.
+    A message that breaks the protocol, IE: data over the window of a channel, ends the connection as well.
+    There is no user authentication yet, so the connection protocol starts right after the key exchange.
+    :param handler: TransportHandler
+    :param channel_types: dict of extra channel types, session channels get the subsystems of the server
+    :param global_requests: dict of global request handlers
+    :return: Connection
+    """
+    subsystems = handler.server.subsystems
+
+    def send(payload: bytes):
+        packet = handler.create_packet(payload)
+        while True:
+            try:
+                return handler.send_packet(packet)
+            except BufferError:
+                # the queue of a key exchange is full, the writer thread waits for the new keys instead
+                if connection.closed:
+                    raise ConnectionAbortedError('connection closed during a key exchange')
+                handler.keys_ready.wait(1)
+
+    connection = Connection(
+        send,
+        {'session': lambda channel, data: Session(channel, subsystems), **(channel_types or dict())},
+        global_requests,
+    )
+    if handler.memory is not None:
+        handler.memory.track('connection', 'outbox', lambda: connection.queued)
+        handler.memory.track('connection', 'channels', connection.buffered)
+    try:
+        while True:
+            connection.handle(handler.get_packet().payload.data)
+    except (ConnectionError, OSError, ValueError, IndexError, error):
+        pass
+    finally:
+        connection.close()
+    return connection
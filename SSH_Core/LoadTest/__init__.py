@@ -0,0 +1,408 @@
+from SSH_Core.Numbers import TransportMessage
+from SSH_Core.Server import Server, kexinit, default_algorithms
+from SSH_Core.Transport import TransportHandler
+from SSH_Core.Transport.Packets import Packet, AlgoNegotiation
+from SSH_Core.Metrics import MetricsRegistry, percentiles
+from SSH_Core.Connection import Connection, ChannelHandler, serve
+
+from struct import error as StructError
+from selectors import DefaultSelector, EVENT_READ
+from socket import socket, socketpair, create_connection, SHUT_WR
+from threading import Thread, Lock
+from time import perf_counter, perf_counter_ns, sleep
+from queue import SimpleQueue
+import random
+
+
+def _delay(source: socket, destination: socket, delay: float):
+    queue = SimpleQueue()
+
+    def read():
+        try:
+            while data := source.recv(65536):
+                queue.put((perf_counter()+delay, data))
+        except OSError:
+            pass
+        queue.put((perf_counter()+delay, b''))
+
+    reader = Thread(target=read, daemon=True)
+    reader.start()
+    try:
+        while True:
+            deadline, data = queue.get()
+            wait = deadline-perf_counter()
+            if wait > 0:
+                sleep(wait)
+            if not data:
+                destination.shutdown(SHUT_WR)
+                break
+            destination.sendall(data)
+    except OSError:
+        pass
+    reader.join()
+
+
+def delayed_socketpair(delay: float):
+    """
+    Create a connected pair of sockets that delivers data after delay seconds in each direction,
+    to simulate a long round trip without a network
+    :param delay: float one way latency in seconds
+    :return: tuple of two sockets
+    """
+    first, first_relay = socketpair()
+    second, second_relay = socketpair()
+    relays = (
+        Thread(target=_delay, args=(first_relay, second_relay, delay), daemon=True),
+        Thread(target=_delay, args=(second_relay, first_relay, delay), daemon=True),
+    )
+    for relay in relays:
+        relay.start()
+
+    def close():
+        for relay in relays:
+            relay.join()
+        first_relay.close()
+        second_relay.close()
+
+    Thread(target=close, daemon=True).start()
+    return first, second
+
+
+def echo_server(address: tuple = ('127.0.0.1', 0)):
+    """
+    A TCP server on one thread that sends back everything it receives, as a target for forwarded connections
+    :param address: tuple to listen on
+    :return: tuple of the bound address and a callable that stops the server
+    """
+    listener = socket()
+    listener.bind(address)
+    listener.listen(1024)
+    listener.setblocking(False)
+    selector = DefaultSelector()
+    selector.register(listener, EVENT_READ)
+    stop, stopper = socketpair()
+    selector.register(stop, EVENT_READ)
+
+    def run():
+        while True:
+            for key, _ in selector.select():
+                if key.fileobj is stop:
+                    for other in list(selector.get_map().values()):
+                        other.fileobj.close()
+                    selector.close()
+                    return
+                if key.fileobj is listener:
+                    try:
+                        sock, _ = listener.accept()
+                    except BlockingIOError:
+                        continue
+                    # blocking sends keep the echo simple, forwarding tests read as much as they write
+                    selector.register(sock, EVENT_READ)
+                    continue
+                sock = key.fileobj
+                try:
+                    data = sock.recv(65536)
+                    if data:
+                        sock.sendall(data)
+                        continue
+                    sock.shutdown(SHUT_WR)
+                except OSError:
+                    pass
+                selector.unregister(sock)
+                sock.close()
+
+    thread = Thread(target=run, daemon=True)
+    thread.start()
+
+    def close():
+        stopper.send(b'\0')
+        thread.join()
+        stopper.close()
+
+    return listener.getsockname(), close
+
+
+class SimulatedClient(object):
+    def __init__(self, sock: socket, version_exchange: str = 'SSH-2.0-SSH_Core_LoadTest\r\n', algorithms: dict = None):
+        """
+        Minimal client side of the transport used to drive a server
+        :param sock: socket connected to the server
+        :param version_exchange: str identification string, including CR LF
+        :param algorithms: dict of algorithm name tuples keyed by AlgoNegotiation field
+        """
+        self.sock = sock
+        self.version_exchange = version_exchange
+        self.algorithms = algorithms or default_algorithms
+        self.buffer = b''
+
+    def read(self, size: int) -> bytes:
+        while len(self.buffer) < size:
+            data = self.sock.recv(max(65536, size-len(self.buffer)))
+            if not data:
+                raise ConnectionError('connection closed by server')
+            self.buffer = self.buffer + data
+        data, self.buffer = self.buffer[:size], self.buffer[size:]
+        return data
+
+    def read_line(self) -> bytes:
+        while b'\n' not in self.buffer:
+            data = self.sock.recv(255)
+            if not data:
+                raise ConnectionError('connection closed by server')
+            self.buffer = self.buffer + data
+        line, _, self.buffer = self.buffer.partition(b'\n')
+        return line+b'\n'
+
+    def read_packet(self) -> Packet:
+        size = int.from_bytes(self.read(4), 'big')
+        packet, _ = Packet.decode(size.to_bytes(4, 'big')+self.read(size))
+        return packet
+
+    def handshake(self, first_kex_packet: bytes = None) -> AlgoNegotiation:
+        """
+        Send the identification string and KEXINIT in one write, then read those of the server
+        :param first_kex_packet: bytes payload of a guessed first kex packet sent right after KEXINIT
+        :return: AlgoNegotiation sent by the server
+        """
+        data = self.version_exchange.encode()
+        data = data+Packet.create(kexinit(self.algorithms, first_kex_packet is not None).encode()).encode()
+        if first_kex_packet is not None:
+            data = data+Packet.create(first_kex_packet).encode()
+        self.sock.sendall(data)
+        self.server_version = self.read_line()
+        return AlgoNegotiation.decode(self.read_packet().payload.data)
+
+    def bulk(self, size: int, packet_size: int) -> int:
+        """
+        Send size bytes of SSH_MSG_IGNORE packets, raw transport traffic without channel flow control
+        :param size: int total payload bytes
+        :param packet_size: int payload bytes per packet
+        :return: int bytes written to the socket
+        """
+        written = 0
+        message = TransportMessage.SSH_MSG_IGNORE.encode()
+        while size > 0:
+            data = Packet.create(message+bytes(min(size, packet_size))).encode()
+            self.sock.sendall(data)
+            written += len(data)
+            size -= packet_size
+        return written
+
+    def receive(self, count: int = None) -> list:
+        """
+        Read packets from the server, answering a key re-exchange with KEXINIT and NEWKEYS
+        :param count: int packets to read, None to read until the server closes the connection
+        :return: list of payloads in the order they arrived
+        """
+        payloads = list()
+        kexinit_message = TransportMessage.SSH_MSG_KEXINIT.encode()
+        while count is None or len(payloads) < count:
+            try:
+                payload = self.read_packet().payload.data
+            except ConnectionError:
+                if count is None:
+                    return payloads
+                raise
+            if payload[:1] == kexinit_message:
+                data = Packet.create(kexinit(self.algorithms).encode()).encode()
+                data = data+Packet.create(TransportMessage.SSH_MSG_NEWKEYS.encode()).encode()
+                self.sock.sendall(data)
+            payloads.append(payload)
+        return payloads
+
+    def connection(self, **kwargs) -> Connection:
+        """
+        Run the connection protocol after the handshake, with a thread that reads packets from the server
+        and answers a key re-exchange
+        :param kwargs: arguments of Connection
+        :return: Connection
+        """
+        lock = Lock()
+
+        def send(payload: bytes):
+            data = Packet.create(payload).encode()
+            with lock:
+                self.sock.sendall(data)
+
+        connection = Connection(send, **kwargs)
+
+        def read():
+            kexinit_message = TransportMessage.SSH_MSG_KEXINIT.encode()
+            try:
+                while True:
+                    payload = self.read_packet().payload.data
+                    if payload[:1] == kexinit_message:
+                        # queued behind the messages already waiting, the reader must never block on sending
+                        connection.send(kexinit(self.algorithms).encode())
+                        connection.send(TransportMessage.SSH_MSG_NEWKEYS.encode())
+                    else:
+                        connection.handle(payload)
+            except (ConnectionError, OSError, ValueError, IndexError, StructError):
+                pass
+            finally:
+                connection.close()
+
+        Thread(target=read, daemon=True).start()
+        return connection
+
+    def wait_closed(self):
+        """
+        Stop sending and wait until the server has read everything and closed the connection
+        """
+        self.sock.shutdown(SHUT_WR)
+        while self.sock.recv(65536):
+            pass
+
+
+class Discard(ChannelHandler):
+    """
+    Drop the data of a channel as it arrives and return its window right away
+    """
+    def data(self, data: bytes):
+        self.channel.adjust(len(data))
+
+
+class LoadGenerator(object):
+    def __init__(self, clients: int = 8, sessions: int = 100, mix: dict = None, bulk_size: int = 1 << 20,
+                 packet_size: int = 32768, transport: str = 'socketpair', server: Server = None, latency: float = 0):
+        """
+        Run many simulated clients against an in process SSH_Core server.
+        Bulk sessions send their data over a channel that the server discards, so channel windows apply.
+        :param clients: int concurrent clients
+        :param sessions: int sessions opened by every client
+        :param mix: dict of session kind ('handshake' or 'bulk') to relative weight
+        :param bulk_size: int payload bytes sent by every bulk session
+        :param packet_size: int payload bytes per bulk packet, larger packets are split at the max_packet of the channel
+        :param transport: str 'socketpair' or 'tcp' to connect over loopback
+        :param server: Server to run, defaults to Server()
+        :param latency: float one way latency in seconds added to socketpair connections
+        """
+        if transport not in ('socketpair', 'tcp'):
+            raise ValueError(f'unknown transport: {transport}')
+        self.clients = clients
+        self.sessions = sessions
+        self.mix = mix or {'handshake': 1}
+        for kind in self.mix:
+            if kind not in ('handshake', 'bulk'):
+                raise ValueError(f'unknown session kind: {kind}')
+        self.bulk_size = bulk_size
+        self.packet_size = packet_size
+        self.transport = transport
+        self.latency = latency
+        self.server = server or Server()
+        self.registry = MetricsRegistry()
+
+        self.lock = Lock()
+        self.latencies = list()
+        self.bulk_bytes = 0
+        self.bulk_ns = 0
+        self.errors = 0
+        self.server_errors = 0
+
+    def serve(self, sock: socket):
+        handler = None
+        try:
+            handler = TransportHandler(self.server, sock, registry=self.registry)
+            handler.exchange_protocols()
+            serve(handler, {'discard': lambda channel, data: Discard(channel)})
+        except (ConnectionError, OSError):
+            pass
+        except (ValueError, StructError):
+            # the client broke the protocol, IE: a malformed identification line
+            with self.lock:
+                self.server_errors += 1
+        finally:
+            if handler is None:
+                sock.close()
+            else:
+                handler.close()
+
+    def connect(self) -> socket:
+        if self.transport == 'tcp':
+            return create_connection(self.server.getsockname())
+        client, server_side = delayed_socketpair(self.latency) if self.latency else socketpair()
+        Thread(target=self.serve, args=(server_side, ), daemon=True).start()
+        return client
+
+    def accept(self):
+        while True:
+            try:
+                sock, _ = self.server.accept()
+            except OSError:
+                return
+            Thread(target=self.serve, args=(sock, ), daemon=True).start()
+
+    def session(self, kind: str):
+        with self.connect() as sock:
+            client = SimulatedClient(sock)
+            start = perf_counter_ns()
+            client.handshake()
+            latency = perf_counter_ns()-start
+
+            written = duration = 0
+            if kind == 'bulk':
+                start = perf_counter_ns()
+                channel = client.connection().open('discard')
+                data = memoryview(bytes(self.bulk_size))
+                for offset in range(0, self.bulk_size, self.packet_size):
+                    channel.send(data[offset:offset+self.packet_size])
+                channel.close()
+                # the server answers SSH_MSG_CHANNEL_CLOSE once it has read all of the data
+                channel.handler.read()
+                written = self.bulk_size
+                duration = perf_counter_ns()-start
+                sock.shutdown(SHUT_WR)
+
+        with self.lock:
+            self.latencies.append(latency)
+            self.bulk_bytes += written
+            self.bulk_ns += duration
+
+    def client(self, seed: int):
+        rng = random.Random(seed)
+        kinds, weights = zip(*self.mix.items())
+        for kind in rng.choices(kinds, weights, k=self.sessions):
+            try:
+                self.session(kind)
+            except (ConnectionError, OSError):
+                with self.lock:
+                    self.errors += 1
+
+    def run(self) -> dict:
+        """
+        Run every client to completion and return the results.
+        mb_per_second is the bulk throughput of a single session, averaged over every bulk session.
+        :return: dict
+        """
+        if self.transport == 'tcp':
+            self.server.bind(('127.0.0.1', 0))
+            self.server.listen(self.clients)
+            Thread(target=self.accept, daemon=True).start()
+
+        threads = [Thread(target=self.client, args=(seed, )) for seed in range(self.clients)]
+        start = perf_counter_ns()
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+        seconds = (perf_counter_ns()-start)/1_000_000_000
+
+        self.server.close()
+
+        latencies = [latency/1_000_000 for latency in self.latencies]
+        return {
+            'clients': self.clients,
+            'transport': self.transport,
+            'mix': self.mix,
+            'handshakes': len(latencies),
+            'errors': self.errors,
+            'server_errors': self.server_errors,
+            'seconds': seconds,
+            'handshakes_per_second': len(latencies)/seconds if seconds else 0,
+            'handshake_latency_ms': percentiles(latencies, 50, 99),
+            'bulk_bytes': self.bulk_bytes,
+            'mb_per_second': self.bulk_bytes/1_000_000/(self.bulk_ns/1_000_000_000) if self.bulk_ns else 0,
+        }
+
+    def __repr__(self):
+        return f'{self.__class__.__name__}(clients={self.clients}, sessions={self.sessions}, mix={self.mix})'
@@ -0,0 +1,28 @@
+from SSH_Core.LoadTest import LoadGenerator
+
+from argparse import ArgumentParser
+from json import dumps
+
+
+parser = ArgumentParser(prog='python -m SSH_Core.LoadTest', description='Load test an in process SSH_Core server')
+parser.add_argument('--clients', type=int, default=8, help='concurrent clients')
+parser.add_argument('--sessions', type=int, default=100, help='sessions opened by every client')
+parser.add_argument('--handshake', type=float, default=1, help='weight of handshake only sessions')
+parser.add_argument('--bulk', type=float, default=0, help='weight of sessions that also send bulk data')
+parser.add_argument('--bulk-size', type=int, default=1 << 20, help='payload bytes sent by a bulk session')
+parser.add_argument('--packet-size', type=int, default=32768, help='payload bytes per bulk packet')
+parser.add_argument('--transport', choices=('socketpair', 'tcp'), default='socketpair')
+parser.add_argument('--latency', type=float, default=0, help='one way latency in seconds of socketpair connections')
+args = parser.parse_args()
+
+mix = {kind: weight for kind, weight in (('handshake', args.handshake), ('bulk', args.bulk)) if weight}
+generator = LoadGenerator(
+    clients=args.clients,
+    sessions=args.sessions,
+    mix=mix,
+    bulk_size=args.bulk_size,
+    packet_size=args.packet_size,
+    transport=args.transport,
+    latency=args.latency,
+)
+print(dumps(generator.run(), indent=2))
@@ -0,0 +1,203 @@
+from itertools import count
+from os import path, sep
+from threading import Lock
+import tracemalloc
+
+
+package_root = path.dirname(path.dirname(path.abspath(__file__)))
+
+# subsystem to the SSH_Core packages whose allocations it is charged with
+subsystems = {
+    'transport': ('Transport', 'Server'),
+    'auth': ('Authentication', ),
+    'connection': ('Connection', ),
+}
+
+
+class ConnectionMemory(object):
+    def __init__(self, name: str):
+        """
+        Buffers of a single connection, each sized by a callable when a report is made,
+        so nothing is counted in the packet hot path.
+        :param name: str label of the connection
+        """
+        self.name = name
+        self.buffers = dict()
+
+    def track(self, subsystem: str, buffer: str, size):
+        """
+        :param subsystem: str IE: transport
+        :param buffer: str name of the buffer
+        :param size: callable without arguments returning the bytes the buffer holds
+        """
+        self.buffers[(subsystem, buffer)] = size
+
+    def sizes(self) -> dict:
+        """
+        :return: dict of subsystem to a dict of buffer name to bytes
+        """
+        output = dict()
+        for (subsystem, buffer), size in list(self.buffers.items()):
+            output.setdefault(subsystem, dict())[buffer] = size()
+        return output
+
+    def __repr__(self):
+        return f'{self.__class__.__name__}(name={self.name}, buffers={len(self.buffers)})'
+
+
+class MemoryAccounting(object):
+    def __init__(self, frames: int = 25, subsystems: dict = subsystems):
+        """
+        Opt-in accounting of memory by connection and by subsystem.
+        Allocations traced by tracemalloc are charged to the subsystem of the innermost SSH_Core frame that made them,
+        tracemalloc cannot tell connections apart so connections are measured with the bytes their buffers hold.
+        Tracing slows every allocation down, only start it while investigating.
+        :param frames: int frames kept per traced allocation, allocations made deeper than this below SSH_Core code
+            are not charged to a subsystem
+        :param subsystems: dict of subsystem name to a tuple of SSH_Core package names
+        """
+        self.frames = frames
+        self.prefixes = {
+            path.join(package_root, package)+sep: subsystem
+            for subsystem, packages in subsystems.items()
+            for package in packages
+        }
+        self.filters = [tracemalloc.Filter(True, f'{prefix}*', all_frames=True) for prefix in self.prefixes]
+        self.names = tuple(subsystems)
+        self.files = dict()
+        self.connections = dict()
+        self.ids = count(1)
+        self.lock = Lock()
+        self.started = False
+
+    def start(self):
+        """
+        Start tracemalloc, unless something else already traces allocations
+        """
+        if not tracemalloc.is_tracing():
+            tracemalloc.start(self.frames)
+            self.started = True
+        return self
+
+    def stop(self):
+        if self.started:
+            tracemalloc.stop()
+            self.started = False
+
+    def connection(self, name: str = None) -> ConnectionMemory:
+        """
+        Create and register the buffers of a new connection
+        :param name: str label of the connection, defaults to an increasing id
+        :return: ConnectionMemory
+        """
+        memory = ConnectionMemory(name or str(next(self.ids)))
+        with self.lock:
+            self.connections[id(memory)] = memory
+        return memory
+
+    def close(self, memory: ConnectionMemory):
+        with self.lock:
+            self.connections.pop(id(memory), None)
+
+    def subsystem(self, filename: str) -> str:
+        """
+        :param filename: str source file of a frame
+        :return: str subsystem the file belongs to, None outside of them
+        """
+        subsystem = self.files.get(filename, False)
+        if subsystem is False:
+            subsystem = self.files[filename] = next(
+                (name for prefix, name in self.prefixes.items() if filename.startswith(prefix)), None
+            )
+        return subsystem
+
+    def by_subsystem(self, top: int = 10) -> list:
+        """
+        Charge the live traced allocations to subsystems, the innermost frame of a subsystem is where
+        an allocation is reported, IE: a bytes object created by zlib is reported at the decompress call.
+        Buffer bytes of every connection are added up by subsystem as well.
+        :param top: int source lines to list per subsystem
+        :return: list of dicts, the largest subsystem first
+        """
+        if not tracemalloc.is_tracing():
+            raise RuntimeError('tracemalloc is not tracing, start the accounting first')
+        snapshot = tracemalloc.take_snapshot().filter_traces(self.filters)
+        totals = {name: [0, 0, dict()] for name in self.names}
+        for trace in snapshot.traces:
+            for frame in reversed(trace.traceback):
+                subsystem = self.subsystem(frame.filename)
+                if subsystem is not None:
+                    break
+            else:
+                continue
+            total = totals[subsystem]
+            total[0] += trace.size
+            total[1] += 1
+            line = total[2].setdefault(f'{path.relpath(frame.filename, package_root)}:{frame.lineno}', [0, 0])
+            line[0] += trace.size
+            line[1] += 1
+
+        buffers = dict.fromkeys(self.names, 0)
+        for sizes in self.buffer_sizes().values():
+            for subsystem, values in sizes.items():
+                buffers[subsystem] = buffers.get(subsystem, 0)+sum(values.values())
+
+        output = [
+            {
+                'subsystem': subsystem,
+                'bytes': size,
+                'blocks': blocks,
+                'buffer_bytes': buffers.get(subsystem, 0),
+                'top': [
+                    {'line': line, 'bytes': line_size, 'blocks': line_blocks}
+                    for line, (line_size, line_blocks) in sorted(lines.items(), key=lambda item: -item[1][0])[:top]
+                ],
+            }
+            for subsystem, (size, blocks, lines) in totals.items()
+        ]
+        return sorted(output, key=lambda row: row['bytes'], reverse=True)
+
+    def buffer_sizes(self) -> dict:
+        """
+        :return: dict of connection name to the sizes of its buffers
+        """
+        with self.lock:
+            connections = list(self.connections.values())
+        return {memory.name: memory.sizes() for memory in connections}
+
+    def by_connection(self, top: int = 10) -> list:
+        """
+        :param top: int connections to list
+        :return: list of dicts, the connection whose buffers hold the most first
+        """
+        output = list()
+        for name, sizes in self.buffer_sizes().items():
+            output.append({
+                'connection': name,
+                'bytes': sum(sum(values.values()) for values in sizes.values()),
+                'subsystems': {subsystem: sum(values.values()) for subsystem, values in sizes.items()},
+                'buffers': {f'{subsystem}.{buffer}': size for subsystem, values in sizes.items()
+                            for buffer, size in values.items()},
+            })
+        return sorted(output, key=lambda row: row['bytes'], reverse=True)[:top]
+
+    def report(self, top: int = 10) -> dict:
+        """
+        :param top: int entries per list
+        :return: dict with the by_subsystem and by_connection reports, traced memory only while tracing
+        """
+        output = {'connections': self.by_connection(top)}
+        if tracemalloc.is_tracing():
+            current, peak = tracemalloc.get_traced_memory()
+            output.update({'traced_bytes': current, 'traced_peak_bytes': peak, 'subsystems': self.by_subsystem(top)})
+        return output
+
+    def __enter__(self):
+        return self.start()
+
+    def __exit__(self, exc_type, exc_val, exc_tb):
+        self.stop()
+        return False
+
+    def __repr__(self):
+        return f'{self.__class__.__name__}(connections={len(self.connections)}, tracing={tracemalloc.is_tracing()})'
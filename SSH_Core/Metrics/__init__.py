@@ -0,0 +1,243 @@
+from SSH_Core.Numbers import TransportMessage, UserAuthMessage, ConnectMessage
+
+from itertools import count
+from os import replace, unlink, path as os_path
+from socket import socket, AF_UNIX, SOCK_STREAM
+from threading import Lock, Thread
+
+
+message_names = {
+    message.value: message.name
+    for numbers in (TransportMessage, UserAuthMessage, ConnectMessage)
+    for message in numbers
+}
+
+
+def percentiles(values, *points) -> dict:
+    """
+    Return the nearest rank percentiles of a list of values
+    :param values: list of numbers
+    :param points: percentiles to return (IE: 50, 99)
+    :return: dict of 'p50' style keys to values, 0 for every point when values is empty
+    """
+    ordered = sorted(values)
+    output = dict()
+    for point in points:
+        if ordered:
+            index = min(len(ordered)-1, max(0, -(-len(ordered)*point//100)-1))
+            output[f'p{point}'] = ordered[index]
+        else:
+            output[f'p{point}'] = 0
+    return output
+
+
+def format_labels(labels: dict) -> str:
+    """
+    :param labels: dict of label name to value
+    :return: str IE: {connection="1",message="SSH_MSG_KEXINIT"}, empty without labels
+    """
+    if not labels:
+        return ''
+    return '{'+','.join(f'{key}="{value}"' for key, value in labels.items())+'}'
+
+
+class ConnectionMetrics(object):
+    """
+    Counters for a single connection.
+    Updates are plain attribute and dict increments so they can stay enabled in the packet hot path.
+    """
+    __slots__ = (
+        'name', 'bytes_in', 'bytes_out', 'packets_in', 'packets_out', 'messages_in', 'messages_out',
+        'decode_ns', 'encode_ns', 'rekeys', 'receive_buffer', 'queue_depth',
+    )
+
+    counters = (
+        ('bytes_in', 'Bytes received from the peer'),
+        ('bytes_out', 'Bytes sent to the peer'),
+        ('packets_in', 'Packets received from the peer'),
+        ('packets_out', 'Packets sent to the peer'),
+        ('decode_ns', 'Nanoseconds spent decoding packets'),
+        ('encode_ns', 'Nanoseconds spent encoding packets'),
+        ('rekeys', 'Completed key re-exchanges'),
+    )
+
+    gauges = (
+        ('receive_buffer', 'Bytes received but not yet decoded'),
+        ('queue_depth', 'Packets waiting in the outbound queue'),
+    )
+
+    def __init__(self, name: str):
+        self.name = name
+        for key, _ in self.counters:
+            setattr(self, key, 0)
+        for key, _ in self.gauges:
+            setattr(self, key, 0)
+        self.messages_in = dict()
+        self.messages_out = dict()
+
+    def packet_in(self, size: int, message: int, duration: int):
+        """
+        Count a received packet
+        :param size: int bytes on the wire
+        :param message: int message number
+        :param duration: int nanoseconds spent decoding
+        """
+        self.packets_in += 1
+        self.bytes_in += size
+        self.decode_ns += duration
+        self.messages_in[message] = self.messages_in.get(message, 0)+1
+
+    def packet_out(self, size: int, message: int, duration: int):
+        """
+        Count a sent packet
+        :param size: int bytes on the wire
+        :param message: int message number
+        :param duration: int nanoseconds spent encoding
+        """
+        self.packets_out += 1
+        self.bytes_out += size
+        self.encode_ns += duration
+        self.messages_out[message] = self.messages_out.get(message, 0)+1
+
+    def merge(self, other):
+        """
+        Add the counters of another ConnectionMetrics to this one.
+        Gauges are summed as well so totals show the current overall depth.
+        The message dicts are copied first, the connection thread may add message types while they are read.
+        :param other: ConnectionMetrics
+        """
+        for key, _ in self.counters+self.gauges:
+            setattr(self, key, getattr(self, key)+getattr(other, key))
+        for message, value in dict(other.messages_in).items():
+            self.messages_in[message] = self.messages_in.get(message, 0)+value
+        for message, value in dict(other.messages_out).items():
+            self.messages_out[message] = self.messages_out.get(message, 0)+value
+
+    def __repr__(self):
+        out = ', '.join(f'{key}={getattr(self, key)}' for key, _ in self.counters)
+        return f'{self.__class__.__name__}(name={self.name}, {out})'
+
+
+class MetricsRegistry(object):
+    def __init__(self, prefix: str = 'ssh'):
+        """
+        Registry of per connection metrics.
+        Totals are built when a snapshot is taken so the hot path only touches one connection.
+        :param prefix: str prefix of every exported metric name
+        """
+        self.prefix = prefix
+        self.connections = dict()
+        self.closed = ConnectionMetrics('closed')
+        self.ids = count(1)
+        self.lock = Lock()
+
+    def connection(self, name: str = None) -> ConnectionMetrics:
+        """
+        Create and register the metrics of a new connection
+        :param name: str label of the connection, defaults to an increasing id
+        :return: ConnectionMetrics
+        """
+        metrics = ConnectionMetrics(name or str(next(self.ids)))
+        with self.lock:
+            self.connections[id(metrics)] = metrics
+        return metrics
+
+    def close(self, metrics: ConnectionMetrics):
+        """
+        Fold the counters of a closed connection into the totals and stop exporting it
+        :param metrics: ConnectionMetrics
+        """
+        with self.lock:
+            if self.connections.pop(id(metrics), None) is not None:
+                metrics.receive_buffer = metrics.queue_depth = 0
+                self.closed.merge(metrics)
+
+    def totals(self) -> ConnectionMetrics:
+        """
+        Return the sum of every open and closed connection
+        :return: ConnectionMetrics
+        """
+        totals = ConnectionMetrics('all')
+        with self.lock:
+            totals.merge(self.closed)
+            for metrics in self.connections.values():
+                totals.merge(metrics)
+        return totals
+
+    def exposition(self) -> str:
+        """
+        Return a snapshot in the Prometheus text exposition format.
+        Open connections are exported with a connection label, totals of every open and closed connection
+        under their own metric names with an all_ prefix, IE: ssh_all_bytes_in_total, so sums over
+        the connection label never count a connection twice.
+        :return: str
+        """
+        with self.lock:
+            connections = list(self.connections.values())
+        totals = self.totals()
+
+        lines = list()
+        for prefix, series, labelled in ((self.prefix, connections, True), (f'{self.prefix}_all', [totals], False)):
+            for kind, entries in (('counter', ConnectionMetrics.counters), ('gauge', ConnectionMetrics.gauges)):
+                for key, description in entries:
+                    name = f'{prefix}_{key}_total' if kind == 'counter' else f'{prefix}_{key}'
+                    lines.append(f'# HELP {name} {description}')
+                    lines.append(f'# TYPE {name} {kind}')
+                    for metrics in series:
+                        labels = {'connection': metrics.name} if labelled else {}
+                        lines.append(f'{name}{format_labels(labels)} {getattr(metrics, key)}')
+
+            for key, description in (('messages_in', 'Packets received by message type'),
+                                      ('messages_out', 'Packets sent by message type')):
+                name = f'{prefix}_{key}_total'
+                lines.append(f'# HELP {name} {description}')
+                lines.append(f'# TYPE {name} counter')
+                for metrics in series:
+                    for message, value in sorted(dict(getattr(metrics, key)).items()):
+                        labels = {'connection': metrics.name} if labelled else {}
+                        labels['message'] = message_names.get(message, message)
+                        lines.append(f'{name}{format_labels(labels)} {value}')
+        return '\n'.join(lines)+'\n'
+
+    def write(self, path: str):
+        """
+        Atomically write a snapshot to a file, IE: for the node exporter textfile collector
+        :param path: str
+        """
+        temp_path = f'{path}.tmp'
+        with open(temp_path, 'w') as file:
+            file.write(self.exposition())
+        replace(temp_path, path)
+
+    def serve(self, path: str) -> Thread:
+        """
+        Serve a snapshot to every client that connects to a UNIX socket at path
+        :param path: str
+        :return: daemon Thread running the server
+        """
+        if os_path.exists(path):
+            unlink(path)
+        server = socket(AF_UNIX, SOCK_STREAM)
+        server.bind(path)
+        server.listen()
+
+        def run():
+            with server:
+                while True:
+                    client, _ = server.accept()
+                    with client:
+                        try:
+                            client.sendall(self.exposition().encode())
+                        except Exception:
+                            # the scraper went away early or the snapshot failed, keep serving the next one
+                            pass
+
+        thread = Thread(target=run, name=f'metrics:{path}', daemon=True)
+        thread.start()
+        return thread
+
+    def __repr__(self):
+        return f'{self.__class__.__name__}(connections={len(self.connections)})'
+
+
+REGISTRY = MetricsRegistry()
@@ -1,4 +1,5 @@
 from enum import Enum
+from struct import error
 
 
 class MessageNumber(Enum):
@@ -6,6 +7,18 @@ class MessageNumber(Enum):
     def decode(cls, data: bytes):
         return cls(int.from_bytes(data[0:1], 'big')), data[1:]
 
+    @classmethod
+    def skip(cls, data: bytes, offset: int = 0) -> int:
+        """
+        Find where a message number starting at offset ends without decoding it
+        :param data: bytes
+        :param offset: int
+        :return: int offset of the first byte after the value
+        """
+        if offset+1 > len(data):
+            raise error(f'{cls.__name__} needs 1 bytes at offset {offset}, data is {len(data)} bytes')
+        return offset+1
+
     def encode(self):
         return self._value_.to_bytes(1, 'big')
 
@@ -43,3 +56,31 @@ class ConnectMessage(MessageNumber):
     SSH_MSG_CHANNEL_REQUEST = 98
     SSH_MSG_CHANNEL_SUCCESS = 99
     SSH_MSG_CHANNEL_FAILURE = 100
+
+
+class SFTPMessage(MessageNumber):
+    SSH_FXP_INIT = 1
+    SSH_FXP_VERSION = 2
+    SSH_FXP_OPEN = 3
+    SSH_FXP_CLOSE = 4
+    SSH_FXP_READ = 5
+    SSH_FXP_WRITE = 6
+    SSH_FXP_LSTAT = 7
+    SSH_FXP_FSTAT = 8
+    SSH_FXP_SETSTAT = 9
+    SSH_FXP_FSETSTAT = 10
+    SSH_FXP_OPENDIR = 11
+    SSH_FXP_READDIR = 12
+    SSH_FXP_REMOVE = 13
+    SSH_FXP_MKDIR = 14
+    SSH_FXP_RMDIR = 15
+    SSH_FXP_REALPATH = 16
+    SSH_FXP_STAT = 17
+    SSH_FXP_RENAME = 18
+    SSH_FXP_READLINK = 19
+    SSH_FXP_SYMLINK = 20
+    SSH_FXP_STATUS = 101
+    SSH_FXP_HANDLE = 102
+    SSH_FXP_DATA = 103
+    SSH_FXP_NAME = 104
+    SSH_FXP_ATTRS = 105
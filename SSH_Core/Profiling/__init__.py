@@ -0,0 +1,226 @@
+from SSH_Core import Byte, Boolean, UInt32, UInt64, String, MPInt, NameList
+from SSH_Core.Numbers import MessageNumber
+from SSH_Core.Metrics import message_names
+from SSH_Core.Transport.Packets import Packet, AlgoNegotiation, MessageView
+
+from threading import local, Lock
+from time import perf_counter_ns, thread_time_ns
+
+
+field_classes = (Byte, Boolean, UInt32, UInt64, String, MPInt, NameList, MessageNumber)
+message_classes = (Packet, AlgoNegotiation)
+batch_classes = (UInt32, UInt64)
+
+_local = local()
+_patched = list()
+_hook = None
+_every = 1
+
+
+def _consumed(frame_kind: str, args: tuple, result) -> int:
+    """
+    Work out how many bytes a codec call processed
+    :param frame_kind: str 'decode', 'encode', 'index' or 'field'
+    :param args: tuple arguments the codec was called with
+    :param result: value returned by the codec
+    :return: int
+    """
+    if frame_kind == 'encode':
+        return len(result)
+    if frame_kind == 'index':
+        return args[0].size
+    if frame_kind == 'field':
+        view, index = args[0], args[1]
+        return view.offsets[index+1]-view.offsets[index]
+    data = args[1]
+    if type(result) is tuple:
+        return len(data)-len(result[1])
+    return len(data)
+
+
+def _message_number(frame_kind: str, args: tuple, offset: int):
+    """
+    Read the SSH message number a sampled top level call works on
+    :param frame_kind: str 'decode', 'index' or 'field'
+    :param args: tuple arguments the call was made with
+    :param offset: int offset of the message number in the encoded data
+    :return: int, None when data is too short
+    """
+    data = args[0].data if frame_kind == 'field' else args[1]
+    if len(data) > offset:
+        return data[offset]
+    return None
+
+
+def _wrap(frame: str, frame_kind: str, function, message_offset: int = None):
+    def wrapper(*args, **kwargs):
+        state = _local.__dict__
+        stack = state.get('stack')
+        if stack is None:
+            stack = state['stack'] = list()
+            state['skip'] = 0
+            state['countdown'] = _every
+
+        if not stack:
+            if state['skip']:
+                state['skip'] += 1
+                try:
+                    return function(*args, **kwargs)
+                finally:
+                    state['skip'] -= 1
+            state['countdown'] -= 1
+            if state['countdown'] > 0:
+                state['skip'] = 1
+                try:
+                    return function(*args, **kwargs)
+                finally:
+                    state['skip'] = 0
+            state['countdown'] = _every
+            # every frame of a sample is charged to the message its top level call works on
+            state['message'] = None if message_offset is None else _message_number(frame_kind, args, message_offset)
+
+        # [frame, wall time of children, cpu time of children]
+        entry = [frame, 0, 0]
+        stack.append(entry)
+        wall, cpu = perf_counter_ns(), thread_time_ns()
+        try:
+            result = function(*args, **kwargs)
+        finally:
+            wall, cpu = perf_counter_ns()-wall, thread_time_ns()-cpu
+            names = tuple(item[0] for item in stack)
+            stack.pop()
+            if stack:
+                stack[-1][1] += wall
+                stack[-1][2] += cpu
+        hook = _hook
+        if hook is not None:
+            hook.record(
+                state['message'], names, wall, cpu, wall-entry[1], cpu-entry[2], _consumed(frame_kind, args, result)
+            )
+        return result
+    wrapper.__wrapped__ = function
+    return wrapper
+
+
+def install(hook, every: int = 100):
+    """
+    Wrap the Datatype codecs, the batch codecs, the message decoders and the message views
+    so every Nth top level call is measured.
+    Nested calls made by a sampled call are always measured so each sample is a full stack.
+    hook.record(message, stack, wall, cpu, self_wall, self_cpu, size) is called for every measured call,
+    message is the SSH message number a message decoder or view works on, None for a bare field codec.
+    Nothing is wrapped until this is called, so there is no cost while profiling is off.
+    :param hook: object with a record method
+    :param every: int sample 1 in every top level calls
+    """
+    global _hook, _every
+    if every < 1:
+        raise ValueError(f'every is less than 1: {every}')
+    uninstall()
+    _hook, _every = hook, every
+    _local.__dict__.clear()
+
+    # (class, method, frame, kind, offset of the message number in the data or None for field codecs)
+    targets = [(cls, kind, kind, kind, None) for cls in field_classes for kind in ('decode', 'encode')]
+    targets += [
+        (cls, f'{kind}_many', f'{kind}_many', kind, None) for cls in batch_classes for kind in ('decode', 'encode')
+    ]
+    targets += [(Packet, 'decode', 'decode', 'decode', 5), (AlgoNegotiation, 'decode', 'decode', 'decode', 0)]
+    targets += [(MessageView, '__init__', 'index', 'index', 0), (MessageView, 'field', 'field', 'field', 0)]
+
+    for cls, name, frame, frame_kind, message_offset in targets:
+        original = cls.__dict__.get(name)
+        if original is None:
+            continue
+        frame = f'{cls.__name__}.{frame}'
+        if isinstance(original, classmethod):
+            replacement = classmethod(_wrap(frame, frame_kind, original.__func__, message_offset))
+        else:
+            replacement = _wrap(frame, frame_kind, original, message_offset)
+        setattr(cls, name, replacement)
+        _patched.append((cls, name, original))
+
+
+def uninstall():
+    """
+    Restore the original codecs
+    """
+    global _hook
+    while _patched:
+        cls, name, original = _patched.pop()
+        setattr(cls, name, original)
+    _hook = None
+
+
+class SamplingProfiler(object):
+    def __init__(self, every: int = 100):
+        """
+        Sample 1 in every codec calls and aggregate wall time, cpu time and bytes
+        by (SSH message number, field type) and by full call stack.
+        :param every: int
+        """
+        self.every = every
+        self.lock = Lock()
+        self.stats = dict()
+        self.stacks = dict()
+
+    def record(self, message: int, stack: tuple, wall: int, cpu: int, self_wall: int, self_cpu: int, size: int):
+        field = stack[-1].split('.')[0]
+        if message is not None:
+            stack = (message_names.get(message, str(message)), )+stack
+        with self.lock:
+            stats = self.stats.get((message, field))
+            if stats is None:
+                stats = self.stats[(message, field)] = [0, 0, 0, 0]
+            stats[0] += 1
+            stats[1] += wall
+            stats[2] += cpu
+            stats[3] += size
+            self.stacks[stack] = self.stacks.get(stack, 0)+self_wall
+
+    def start(self):
+        install(self, self.every)
+        return self
+
+    def stop(self):
+        uninstall()
+
+    def report(self) -> list:
+        """
+        Return the aggregated samples sorted by wall time, most expensive first
+        :return: list of dicts, message is the SSH message number or None for fields coded outside of a message
+        """
+        with self.lock:
+            items = sorted(self.stats.items(), key=lambda item: item[1][1], reverse=True)
+        return [
+            {
+                'message': message, 'name': message_names.get(message, '-' if message is None else str(message)),
+                'field': field, 'samples': samples, 'wall_ns': wall, 'cpu_ns': cpu, 'bytes': size,
+            }
+            for (message, field), (samples, wall, cpu, size) in items
+        ]
+
+    def collapsed(self) -> str:
+        """
+        Return the samples as collapsed stacks weighted by self wall time in nanoseconds,
+        stacks of a message start with its name, IE: SSH_MSG_KEXINIT;AlgoNegotiation.decode;NameList.decode.
+        The output can be fed straight to flamegraph.pl or speedscope.
+        :return: str
+        """
+        with self.lock:
+            lines = [f'{";".join(stack)} {value}' for stack, value in self.stacks.items()]
+        return '\n'.join(sorted(lines))+'\n'
+
+    def dump(self, path: str):
+        with open(path, 'w') as file:
+            file.write(self.collapsed())
+
+    def __enter__(self):
+        return self.start()
+
+    def __exit__(self, exc_type, exc_val, exc_tb):
+        self.stop()
+        return False
+
+    def __repr__(self):
+        return f'{self.__class__.__name__}(every={self.every}, samples={sum(s[0] for s in self.stats.values())})'
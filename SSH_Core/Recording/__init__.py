@@ -0,0 +1,202 @@
+from SSH_Core.Transport.Packets import Packet, MAX_PACKET_LENGTH
+from SSH_Core.Numbers import TransportMessage
+from SSH_Core.Metrics import percentiles
+
+from socket import socket, socketpair, SHUT_WR
+from struct import pack, unpack, calcsize
+from threading import Lock, Thread
+from time import perf_counter_ns, sleep
+
+
+MAGIC = b'SSHCAP1\n'
+HEADER = '!BQI'
+HEADER_SIZE = calcsize(HEADER)
+
+INBOUND = 0
+OUTBOUND = 1
+
+
+class Recorder(object):
+    def __init__(self, path: str):
+        """
+        Write the raw bytes of a transport session to a capture file.
+        Every read or write becomes a record of direction, nanoseconds since the start and data.
+        :param path: str
+        """
+        self.file = open(path, 'wb')
+        self.file.write(MAGIC)
+        self.start = perf_counter_ns()
+        self.lock = Lock()
+
+    def record(self, direction: int, data: bytes):
+        """
+        Append a record to the capture
+        :param direction: int INBOUND or OUTBOUND
+        :param data: bytes
+        """
+        if data:
+            with self.lock:
+                self.file.write(pack(HEADER, direction, perf_counter_ns()-self.start, len(data)))
+                self.file.write(data)
+
+    def close(self):
+        with self.lock:
+            self.file.close()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_val, exc_tb):
+        self.close()
+        return False
+
+
+class RecordingSocket(object):
+    def __init__(self, sock: socket, recorder: Recorder):
+        """
+        Proxy a socket and copy everything that is read or written to a Recorder
+        :param sock: socket
+        :param recorder: Recorder
+        """
+        self.sock = sock
+        self.recorder = recorder
+
+    def recv(self, size: int, *args) -> bytes:
+        data = self.sock.recv(size, *args)
+        self.recorder.record(INBOUND, data)
+        return data
+
+    def recv_into(self, buffer, size: int = 0, *args) -> int:
+        received = self.sock.recv_into(buffer, size, *args)
+        self.recorder.record(INBOUND, bytes(memoryview(buffer)[:received]))
+        return received
+
+    def send(self, data: bytes, *args) -> int:
+        sent = self.sock.send(data, *args)
+        self.recorder.record(OUTBOUND, bytes(data[:sent]))
+        return sent
+
+    def sendall(self, data: bytes, *args):
+        self.sock.sendall(data, *args)
+        self.recorder.record(OUTBOUND, bytes(data))
+
+    def __getattr__(self, item):
+        return getattr(self.sock, item)
+
+
+def read_capture(path: str):
+    """
+    Iterate over the records of a capture file
+    :param path: str
+    :return: generator of (direction, nanoseconds, data) tuples
+    """
+    with open(path, 'rb') as file:
+        if file.read(len(MAGIC)) != MAGIC:
+            raise ValueError(f'{path} is not a capture file')
+        while header := file.read(HEADER_SIZE):
+            direction, timestamp, size = unpack(HEADER, header)
+            yield direction, timestamp, file.read(size)
+
+
+class Replayer(object):
+    def __init__(self, path: str, direction: int = INBOUND, speed: float = None, mac_len: int = 0):
+        """
+        Feed one direction of a capture back through a socketpair and time the packet decoder on it.
+        Packets are framed by their plain packet_len, captures do not hold keys so encrypted packets cannot be framed.
+        Packets after SSH_MSG_NEWKEYS are followed by mac_len bytes of MAC, a packet that does not follow
+        the framing rules, IE: an encrypted one, raises a ValueError instead of being decoded as garbage.
+        :param path: str capture file
+        :param direction: int INBOUND to replay what the server read, OUTBOUND for what it wrote
+        :param speed: float multiplier of the original timing, None replays as fast as possible
+        :param mac_len: int bytes of MAC after each packet once the first SSH_MSG_NEWKEYS was replayed
+        """
+        self.path = path
+        self.direction = direction
+        self.speed = speed
+        self.mac_len = mac_len
+
+    def feed(self, sock: socket):
+        start = perf_counter_ns()
+        try:
+            for direction, timestamp, data in read_capture(self.path):
+                if direction != self.direction:
+                    continue
+                if self.speed:
+                    delay = timestamp/self.speed-(perf_counter_ns()-start)
+                    if delay > 0:
+                        sleep(delay/1_000_000_000)
+                sock.sendall(data)
+            sock.shutdown(SHUT_WR)
+        except OSError:
+            # the reader stopped early, IE: on a packet it could not frame
+            pass
+
+    def run(self) -> dict:
+        """
+        Replay the capture and return the decode latency and throughput
+        :return: dict
+        """
+        feeder, reader = socketpair()
+        thread = Thread(target=self.feed, args=(feeder, ), daemon=True)
+
+        latencies = list()
+        total = 0
+        buffer = bytearray()
+        version = None
+        mac_len = 0
+        newkeys = TransportMessage.SSH_MSG_NEWKEYS.value
+
+        with feeder, reader:
+            start = perf_counter_ns()
+            thread.start()
+            while data := reader.recv(65536):
+                buffer += data
+                total += len(data)
+                while version is None:
+                    end = buffer.find(b'\n')
+                    if end == -1:
+                        break
+                    line = bytes(buffer[:end+1])
+                    del buffer[:end+1]
+                    # a server may send other lines before its version, RFC 4253 section 4.2
+                    if line.startswith(b'SSH-'):
+                        version = line
+                if version is None:
+                    continue
+                while len(buffer) >= 5:
+                    packet_len, padding_len = unpack('!IB', buffer[:5])
+                    if packet_len > MAX_PACKET_LENGTH or not 4 <= padding_len < packet_len:
+                        raise ValueError(
+                            f'packet {len(latencies)} is not a plain packet (packet_len {packet_len}, '
+                            f'padding_len {padding_len}), the capture is encrypted or mac_len is wrong'
+                        )
+                    size = 4+packet_len+mac_len
+                    if len(buffer) < size:
+                        break
+                    packet_data = bytes(buffer[:size-mac_len])
+                    del buffer[:size]
+                    decode_start = perf_counter_ns()
+                    Packet.decode(packet_data)
+                    latencies.append(perf_counter_ns()-decode_start)
+                    if packet_data[5] == newkeys:
+                        mac_len = self.mac_len
+            duration = perf_counter_ns()-start
+            thread.join()
+
+        seconds = duration/1_000_000_000
+        return {
+            'version': version.decode(errors='replace').strip() if version else None,
+            'packets': len(latencies),
+            'bytes': total,
+            'leftover_bytes': len(buffer),
+            'seconds': seconds,
+            'packets_per_second': len(latencies)/seconds if seconds else 0,
+            'mb_per_second': total/1_000_000/seconds if seconds else 0,
+            'decode_ns': {
+                'mean': sum(latencies)/len(latencies) if latencies else 0,
+                **percentiles(latencies, 50, 99, 100),
+            },
+        }
+
+    def __repr__(self):
+        return f'{self.__class__.__name__}(path={self.path}, direction={self.direction}, speed={self.speed})'
@@ -0,0 +1,76 @@
+from SSH_Core import Byte, Boolean, UInt32, NameList
+from SSH_Core.Numbers import TransportMessage
+from SSH_Core.Transport.Packets import AlgoNegotiation
+
+from socket import socket, AF_INET, SOCK_STREAM
+from os import urandom
+
+
+default_algorithms = {
+    'kex_algorithms': ('curve25519-sha256', 'diffie-hellman-group14-sha256'),
+    'server_host_key_algorithms': ('ssh-ed25519', ),
+    'encryption_algorithms_client_to_server': ('aes128-ctr', 'aes256-ctr'),
+    'encryption_algorithms_server_to_client': ('aes128-ctr', 'aes256-ctr'),
+    'mac_algorithms_client_to_server': ('hmac-sha2-256', ),
+    'mac_algorithms_server_to_client': ('hmac-sha2-256', ),
+    'compression_algorithms_client_to_server': ('none', ),
+    'compression_algorithms_server_to_client': ('none', ),
+    'languages_client_to_server': (),
+    'languages_server_to_client': (),
+}
+
+
+def kexinit(algorithms: dict, first_kex_packet_follows: bool = False) -> AlgoNegotiation:
+    """
+    Build a SSH_MSG_KEXINIT with a fresh cookie
+    :param algorithms: dict of algorithm name tuples keyed by AlgoNegotiation field
+    :param first_kex_packet_follows: bool
+    :return: AlgoNegotiation instance
+    """
+    return AlgoNegotiation(
+        TransportMessage.SSH_MSG_KEXINIT,
+        Byte(urandom(16)),
+        *(NameList(*algorithms[key]) for key in default_algorithms),
+        Boolean(first_kex_packet_follows),
+        UInt32(0),
+    )
+
+
+class Server(socket):
+    def __init__(self, version_exchange: str = 'SSH-2.0-SSH_Core_0.1\r\n', subsystems: dict = None, **algorithms):
+        """
+        Listening socket that holds the settings every TransportHandler of the server shares
+        :param version_exchange: str identification string sent to clients, including CR LF
+        :param subsystems: dict of subsystem name to a callable (channel) -> ChannelHandler, defaults to none.
+            There is no user authentication, so a subsystem is offered to every peer,
+            IE: {'sftp': functools.partial(SFTPServer, root=path)} lets any peer read and write under path
+        :param algorithms: tuples of algorithm names keyed by AlgoNegotiation field to override the defaults
+        """
+        super().__init__(AF_INET, SOCK_STREAM)
+        self.version_exchange = version_exchange
+        self.subsystems = dict() if subsystems is None else subsystems
+        self.algorithms = dict(default_algorithms)
+        for key, value in algorithms.items():
+            if key not in default_algorithms:
+                raise TypeError(f'unknown algorithm list: {key}')
+            self.algorithms[key] = tuple(value)
+
+    def kexinit(self, first_kex_packet_follows: bool = False) -> AlgoNegotiation:
+        """
+        Build the SSH_MSG_KEXINIT the server sends, with a fresh cookie
+        :param first_kex_packet_follows: bool
+        :return: AlgoNegotiation instance
+        """
+        return kexinit(self.algorithms, first_kex_packet_follows)
+
+    def first_kex_packet(self, kex_algorithm: str):
+        """
+        Return the payload the server sends first for kex_algorithm, so it can be guessed ahead of the client KEXINIT.
+        Every kex method offered here starts with a packet from the client, so the server never guesses.
+        :param kex_algorithm: str
+        :return: bytes or None
+        """
+        return None
+
+    def __repr__(self):
+        return f'{self.__class__.__name__}(version={self.version_exchange.strip()}, fd={self.fileno()})'
@@ -1,14 +1,65 @@
 import collections
 import unittest
+import unittest.mock
 import SSH_Core
 import random
+import json
+import os
+import socket
+import tempfile
+import threading
+import time
+import types
+import functools
+import zlib
+import sys
+
+from SSH_Core.Tracing import Tracer, NULL_TRACER
+from SSH_Core.Metrics import MetricsRegistry
+from SSH_Core.Profiling import SamplingProfiler
+from SSH_Core.Memory import MemoryAccounting
+from SSH_Core.Transport.Packets import Packet, AlgoNegotiation, AlgoNegotiationView
+from SSH_Core.Transport import TransportHandler, VersionReader, RekeyScheduler
+from SSH_Core.Recording import Recorder, Replayer, read_capture, INBOUND, OUTBOUND
+from SSH_Core.LoadTest import LoadGenerator, SimulatedClient, delayed_socketpair, echo_server
+from SSH_Core.Server import Server, default_algorithms, kexinit
+from SSH_Core.Transport import negotiate
+from SSH_Core.Analysis import frame_capture, summarize, numpy
+from SSH_Core.Transport.Crypto import Mac, CryptoOffload
+from SSH_Core.Transport.Pipeline import InboundPipeline, Stage
+from SSH_Core.Transport.Cipher import AES, AES128CTR, AES256CTR, ChaCha20Poly1305, chacha20, poly1305, backends, \
+    ciphers
+from SSH_Core.Connection import serve, pack_string, unpack_string
+from SSH_Core.Numbers import SFTPMessage, ConnectMessage
+from SSH_Core.Connection.SFTP import SFTPServer, SFTPClient, HandleCache, SSH_FXF_WRITE, SSH_FXF_TRUNC
+from SSH_Core.Connection.Forwarding import Relay, DirectTCPIP, ForwardedTCPIP, LocalForward, RemoteForwarding, \
+    pack_endpoint
 
 from struct import error as StructError, pack
-from string import printable
+from concurrent.futures import Future
+from string import printable, ascii_letters
 
 random_tests_count = 100
 
 
+def kexinit_payload(*kex_algorithms, first_kex_packet_follows=False):
+    lists = [SSH_Core.NameList(*kex_algorithms)]+[SSH_Core.NameList('none')]*9
+    return b''.join((
+        b'\x14',
+        random.randbytes(16),
+        *(name_list.encode() for name_list in lists),
+        SSH_Core.Boolean(first_kex_packet_follows).encode(),
+        SSH_Core.UInt32(0).encode(),
+    ))
+
+
+def packet_bytes(payload: bytes) -> bytes:
+    padding = 8-(len(payload)+5) % 8
+    if padding < 4:
+        padding += 8
+    return pack('!IB', len(payload)+padding+1, padding)+payload+bytes(padding)
+
+
 class Byte(unittest.TestCase):
     bad_data = (True, False, None, 'test', 100, 0.03, float('inf'), list(), dict(), object)
 
@@ -72,10 +123,18 @@ class Byte(unittest.TestCase):
     def testEncodeFail(self):
         for data in self.bad_data:
             inst = SSH_Core.Byte(b'')
-            inst.data = data
+            inst._data = data
             with self.subTest(f'Expect fail: instance data set to {data}'):
                 self.assertRaises(StructError, inst.encode)
 
+    def testSized(self):
+        self.assertIs(SSH_Core.Byte[16], SSH_Core.Byte[16])
+        self.assertIsNot(SSH_Core.Byte[16], SSH_Core.Byte[8])
+        for data in self.test_data:
+            with self.subTest(f'Sized values spelled separately are equal: {data}'):
+                self.assertEqual(SSH_Core.Byte[16](data), SSH_Core.Byte[16](data))
+                self.assertEqual(len({SSH_Core.Byte[16](data), SSH_Core.Byte[16](data)}), 1)
+
 
 class Boolean(unittest.TestCase):
     bad_data = (None, 1, 0, -1, 0.5, 'test', b'', list, dict())
@@ -158,7 +217,7 @@ class Boolean(unittest.TestCase):
     def testEncodeFail(self):
         for data in (b'', b'\x01\x00', b'test', *self.bad_data):
             inst = SSH_Core.Boolean(True)
-            inst.data = data
+            inst._data = data
             with self.subTest(f'Fail encode with: {data}'):
                 self.assertRaises(StructError, inst.encode)
 
@@ -216,6 +275,42 @@ class UInt32(unittest.TestCase):
             with self.subTest(f'Encoding than decoding: {data}'):
                 self.assertEqual(inst2.data, data)
 
+    def testEncodeMany(self):
+        values = [data for _, data in self.test_data]
+        with self.subTest(f'Compare encode_many with encode: {values}'):
+            self.assertEqual(SSH_Core.UInt32.encode_many(values), b''.join(SSH_Core.UInt32(data).encode() for data in values))
+
+    def testDecodeMany(self):
+        data = b''.join(byte_data for byte_data, _ in self.test_data)
+        values, remaining = SSH_Core.UInt32.decode_many(data+b'\x01')
+        scalar = list()
+        while len(data) >= 4:
+            inst, data = SSH_Core.UInt32.decode(data)
+            scalar.append(inst.data)
+        self.assertEqual(values, scalar)
+        self.assertEqual(remaining, b'\x01')
+
+    def testEncodeManyDecodeMany(self):
+        values = [data for _, data in self.test_data]
+        count = random.randint(0, len(values))
+        decoded, remaining = SSH_Core.UInt32.decode_many(SSH_Core.UInt32.encode_many(values), count)
+        self.assertEqual(decoded, values[:count])
+        self.assertEqual(len(remaining), 4*(len(values)-count))
+
+    def testManyFail(self):
+        self.assertRaises(ValueError, SSH_Core.UInt32.encode_many, [0, -1])
+        self.assertRaises(ValueError, SSH_Core.UInt32.encode_many, [1 << 32])
+        self.assertRaises(TypeError, SSH_Core.UInt32.encode_many, [0.5])
+        self.assertRaises(StructError, SSH_Core.UInt32.decode_many, bytes(4), 2)
+        self.assertRaises(ValueError, SSH_Core.UInt32.decode_many, bytes(4), -1)
+        self.assertRaises(TypeError, SSH_Core.UInt32.decode_many, bytes(4), 1.0)
+        for data in self.bad_data:
+            try:
+                SSH_Core.UInt32(data)
+            except (TypeError, ValueError) as exc:
+                with self.subTest(f'Fail encode_many like the scalar codec with: {data}'):
+                    self.assertRaises(type(exc), SSH_Core.UInt32.encode_many, [data])
+
     def testInstanceFail(self):
         for data in self.bad_data:
             with self.subTest(f'Fail instance with: {data}'):
@@ -235,7 +330,7 @@ class UInt32(unittest.TestCase):
     def testEncodeFail(self):
         for data in self.bad_data:
             inst = SSH_Core.UInt32(0)
-            inst.data = data
+            inst._data = data
             with self.subTest(f'Fail encode with: {data}'):
                 self.assertRaises(StructError, inst.encode)
 
@@ -293,6 +388,42 @@ class UInt64(unittest.TestCase):
             with self.subTest(f'Encoding than decoding: {data}'):
                 self.assertEqual(inst2.data, data)
 
+    def testEncodeMany(self):
+        values = [data for _, data in self.test_data]
+        with self.subTest(f'Compare encode_many with encode: {values}'):
+            self.assertEqual(SSH_Core.UInt64.encode_many(values), b''.join(SSH_Core.UInt64(data).encode() for data in values))
+
+    def testDecodeMany(self):
+        data = b''.join(byte_data for byte_data, _ in self.test_data)
+        values, remaining = SSH_Core.UInt64.decode_many(data+b'\x01')
+        scalar = list()
+        while len(data) >= 8:
+            inst, data = SSH_Core.UInt64.decode(data)
+            scalar.append(inst.data)
+        self.assertEqual(values, scalar)
+        self.assertEqual(remaining, b'\x01')
+
+    def testEncodeManyDecodeMany(self):
+        values = [data for _, data in self.test_data]
+        count = random.randint(0, len(values))
+        decoded, remaining = SSH_Core.UInt64.decode_many(SSH_Core.UInt64.encode_many(values), count)
+        self.assertEqual(decoded, values[:count])
+        self.assertEqual(len(remaining), 8*(len(values)-count))
+
+    def testManyFail(self):
+        self.assertRaises(ValueError, SSH_Core.UInt64.encode_many, [0, -1])
+        self.assertRaises(ValueError, SSH_Core.UInt64.encode_many, [1 << 64])
+        self.assertRaises(TypeError, SSH_Core.UInt64.encode_many, [0.5])
+        self.assertRaises(StructError, SSH_Core.UInt64.decode_many, bytes(8), 2)
+        self.assertRaises(ValueError, SSH_Core.UInt64.decode_many, bytes(8), -1)
+        self.assertRaises(TypeError, SSH_Core.UInt64.decode_many, bytes(8), 1.0)
+        for data in self.bad_data:
+            try:
+                SSH_Core.UInt64(data)
+            except (TypeError, ValueError) as exc:
+                with self.subTest(f'Fail encode_many like the scalar codec with: {data}'):
+                    self.assertRaises(type(exc), SSH_Core.UInt64.encode_many, [data])
+
     def testInstanceFail(self):
         for data in self.bad_data:
             with self.subTest(f'Fail instance with: {data}'):
@@ -312,7 +443,7 @@ class UInt64(unittest.TestCase):
     def testEncodeFail(self):
         for data in self.bad_data:
             inst = SSH_Core.UInt64(0)
-            inst.data = data
+            inst._data = data
             with self.subTest(f'Fail encode with: {data}'):
                 self.assertRaises(StructError, inst.encode)
 
@@ -388,7 +519,7 @@ class String(unittest.TestCase):
     def testEncodeFail(self):
         for data in self.bad_data:
             inst = SSH_Core.String('')
-            inst.data = data
+            inst._data = data
             with self.subTest(f'Fail encode with: {data}'):
                 self.assertRaises(StructError, inst.encode)
 
@@ -490,7 +621,7 @@ class MPInt(unittest.TestCase):
     def testEncodeFail(self):
         for data in self.bad_data:
             inst = SSH_Core.MPInt(0)
-            inst.data = data
+            inst._data = data
             with self.subTest(f'Fail encode with: {data}'):
                 self.assertRaises(StructError, inst.encode)
 
@@ -569,11 +700,1254 @@ class NameList(unittest.TestCase):
     def testEncodeFail(self):
         for data in self.bad_data:
             inst = SSH_Core.NameList()
-            inst.data = data
+            inst._data = data
             with self.subTest(f'Fail encode with: {data}'):
                 if type(data) in (list, tuple, set, dict):
                     self.skipTest(f'bad_data is a collection')
                 self.assertRaises(StructError, inst.encode)
 
+
+class Tracing(unittest.TestCase):
+    def testPhases(self):
+        tracer = Tracer()
+        for _ in range(random_tests_count):
+            with tracer.phase('version_exchange'):
+                pass
+        with tracer.phase('kexinit', size=100):
+            pass
+        self.assertEqual(len(tracer.events), random_tests_count+1)
+        for name, start, end, _, _ in tracer.events:
+            with self.subTest(f'Phase is monotonic: {name}'):
+                self.assertLessEqual(start, end)
+
+    def testMaxEvents(self):
+        tracer = Tracer(max_events=10)
+        for index in range(random_tests_count):
+            tracer.record('packet_decode', index, index)
+        starts = [start for _, start, _, _, _ in tracer.events]
+        self.assertEqual(starts, list(range(random_tests_count-10, random_tests_count)))
+
+    def testTraceEvents(self):
+        tracer = Tracer()
+        with tracer.phase('kexinit', size=100):
+            pass
+        events = json.loads(json.dumps(tracer.trace_events()))['traceEvents']
+        self.assertEqual(events[0]['name'], 'kexinit')
+        self.assertEqual(events[0]['ph'], 'X')
+        self.assertEqual(events[0]['args'], {'size': '100'})
+
+    def testHistograms(self):
+        tracer = Tracer()
+        for duration in (0, 999, 1_000, 5_000, 1_000_000):
+            tracer.record('packet_decode', 0, duration)
+        histogram = tracer.histograms()['packet_decode'].as_dict()
+        self.assertEqual(histogram['count'], 5)
+        self.assertEqual(histogram['buckets'], {1: 2, 2: 1, 8: 1, 1024: 1})
+
+    def testNullTracer(self):
+        with NULL_TRACER.phase('version_exchange') as phase:
+            self.assertIs(phase, NULL_TRACER.phase('kexinit'))
+
+
+class Metrics(unittest.TestCase):
+    def testTotals(self):
+        registry = MetricsRegistry()
+        first, second = registry.connection(), registry.connection()
+        for _ in range(random_tests_count):
+            first.packet_in(100, 20, 10)
+            second.packet_out(50, 94, 10)
+        registry.close(first)
+        totals = registry.totals()
+        self.assertEqual(totals.bytes_in, 100*random_tests_count)
+        self.assertEqual(totals.bytes_out, 50*random_tests_count)
+        self.assertEqual(totals.messages_in, {20: random_tests_count})
+        self.assertEqual(len(registry.connections), 1)
+
+    def testExposition(self):
+        registry = MetricsRegistry()
+        metrics = registry.connection('client')
+        metrics.packet_in(100, 20, 10)
+        text = registry.exposition()
+        self.assertIn('# TYPE ssh_bytes_in_total counter', text)
+        self.assertIn('ssh_bytes_in_total{connection="client"} 100', text)
+        self.assertIn('ssh_all_bytes_in_total 100', text)
+        self.assertNotIn('connection="all"', text)
+        self.assertIn('ssh_messages_in_total{connection="client",message="SSH_MSG_KEXINIT"} 1', text)
+        self.assertIn('ssh_all_messages_in_total{message="SSH_MSG_KEXINIT"} 1', text)
+
+    def testServeEarlyDisconnect(self):
+        registry = MetricsRegistry()
+        for _ in range(2000):
+            registry.connection()
+        with tempfile.TemporaryDirectory() as directory:
+            path = os.path.join(directory, 'metrics.sock')
+            thread = registry.serve(path)
+            for _ in range(3):
+                # closed without reading, the server gets a reset while it is still sending
+                scraper = socket.socket(socket.AF_UNIX)
+                scraper.setsockopt(socket.SOL_SOCKET, socket.SO_LINGER, pack('ii', 1, 0))
+                scraper.connect(path)
+                scraper.close()
+            with socket.socket(socket.AF_UNIX) as scraper:
+                scraper.connect(path)
+                text = b''.join(iter(lambda: scraper.recv(65536), b'')).decode()
+            self.assertTrue(thread.is_alive())
+            self.assertIn('ssh_all_packets_in_total 0', text)
+
+
+    def testServeFailedSnapshot(self):
+        registry = MetricsRegistry()
+        exposition = registry.exposition
+        with tempfile.TemporaryDirectory() as directory, \
+                unittest.mock.patch.object(registry, 'exposition', side_effect=[RuntimeError, exposition()]):
+            path = os.path.join(directory, 'metrics.sock')
+            thread = registry.serve(path)
+            texts = list()
+            for _ in range(2):
+                with socket.socket(socket.AF_UNIX) as scraper:
+                    scraper.connect(path)
+                    texts.append(b''.join(iter(lambda: scraper.recv(65536), b'')).decode())
+            self.assertTrue(thread.is_alive())
+            self.assertEqual(texts[0], '')
+            self.assertIn('ssh_all_packets_in_total 0', texts[1])
+
+    def testConcurrentMerge(self):
+        registry = MetricsRegistry()
+        metrics = registry.connection()
+
+        def count():
+            # new message types keep growing the dicts while totals are read
+            for message in range(20_000):
+                metrics.packet_in(1, message, 0)
+
+        interval = sys.getswitchinterval()
+        sys.setswitchinterval(1e-6)
+        counter = threading.Thread(target=count)
+        counter.start()
+        try:
+            while counter.is_alive():
+                registry.totals()
+        finally:
+            counter.join()
+            sys.setswitchinterval(interval)
+        self.assertEqual(len(registry.totals().messages_in), 20_000)
+
+
+class Profiling(unittest.TestCase):
+    def testSampling(self):
+        original = AlgoNegotiation.__dict__['decode']
+        payload = kexinit_payload('curve25519-sha256')
+        with SamplingProfiler(every=1) as profiler:
+            AlgoNegotiation.decode(payload)
+        self.assertIs(AlgoNegotiation.__dict__['decode'], original)
+
+        fields = {(row['message'], row['field']): row for row in profiler.report()}
+        self.assertEqual(fields[(20, 'NameList')]['samples'], 10)
+        self.assertEqual(fields[(20, 'NameList')]['name'], 'SSH_MSG_KEXINIT')
+        self.assertEqual(fields[(20, 'AlgoNegotiation')]['bytes'], len(payload))
+        self.assertIn('SSH_MSG_KEXINIT;AlgoNegotiation.decode;NameList.decode ', profiler.collapsed())
+
+    def testMessageNumber(self):
+        packet = Packet.create(b'\x5e'+SSH_Core.UInt32(7).encode()).encode()
+        payload = kexinit_payload('curve25519-sha256')
+        with SamplingProfiler(every=1) as profiler:
+            Packet.decode(packet)
+            view = AlgoNegotiationView(payload)
+            view.kex_algorithms
+            SSH_Core.UInt32.decode_many(bytes(40))
+            SSH_Core.UInt64.encode_many([1, 2])
+        self.assertFalse(hasattr(AlgoNegotiationView.field, '__wrapped__'))
+
+        fields = {(row['message'], row['field']): row for row in profiler.report()}
+        self.assertEqual(fields[(94, 'Packet')]['bytes'], len(packet))
+        self.assertEqual(fields[(20, 'MessageView')]['samples'], 2)
+        self.assertEqual(fields[(20, 'NameList')]['samples'], 1)
+        self.assertEqual(fields[(None, 'UInt32')]['bytes'], 40)
+        self.assertEqual(fields[(None, 'UInt64')]['bytes'], 16)
+        collapsed = profiler.collapsed()
+        self.assertIn('SSH_MSG_KEXINIT;MessageView.index ', collapsed)
+        self.assertIn('SSH_MSG_KEXINIT;MessageView.field;NameList.decode ', collapsed)
+        self.assertIn('\nUInt32.decode_many ', collapsed)
+
+    def testSampleRate(self):
+        with SamplingProfiler(every=10) as profiler:
+            for _ in range(random_tests_count):
+                SSH_Core.UInt32.decode(SSH_Core.UInt32(1).encode())
+        samples = {row['field']: row['samples'] for row in profiler.report()}
+        self.assertEqual(samples['UInt32'], 2*random_tests_count//10)
+
+
+class Memory(unittest.TestCase):
+    def testSubsystems(self):
+        with MemoryAccounting() as accounting:
+            kept = [pack_string(bytes(100_000)), Packet.create(bytes(200_000)).encode(), bytes(400_000)]
+            subsystems = {row['subsystem']: row for row in accounting.by_subsystem(top=3)}
+        self.assertEqual(list(subsystems), ['transport', 'connection', 'auth'])
+        self.assertGreaterEqual(subsystems['transport']['bytes'], 200_000)
+        self.assertLess(subsystems['transport']['bytes'], 400_000)
+        self.assertGreaterEqual(subsystems['connection']['bytes'], 100_000)
+        self.assertTrue(subsystems['connection']['top'][0]['line'].startswith(os.path.join('Connection', '')))
+        self.assertEqual(subsystems['auth']['bytes'], 0)
+        self.assertRaises(RuntimeError, accounting.by_subsystem)
+        del kept
+
+    def testConnections(self):
+        accounting = MemoryAccounting()
+        server = Server()
+        client_side, server_side = socket.socketpair()
+
+        def run():
+            handler = TransportHandler(server, server_side, accounting=accounting)
+            handler.exchange_protocols()
+            serve(handler)
+            handler.close()
+
+        thread = threading.Thread(target=run)
+        thread.start()
+        client = SimulatedClient(client_side)
+        client.handshake()
+        # nothing reads a session without a subsystem, so its data stays buffered on the server
+        channel = client.connection().open('session')
+        channel.send(bytes(100_000))
+        for _ in range(100):
+            connections = accounting.by_connection(top=1)
+            if connections[0]['buffers']['connection.channels'] == 100_000:
+                break
+            time.sleep(0.01)
+        self.assertEqual(connections[0]['bytes'], 100_000)
+        self.assertEqual(connections[0]['subsystems'], {'transport': 0, 'connection': 100_000})
+        self.assertNotIn('subsystems', accounting.report())
+
+        client_side.shutdown(socket.SHUT_WR)
+        thread.join()
+        client_side.close()
+        server.close()
+        self.assertEqual(accounting.by_connection(), [])
+
+
+class Recording(unittest.TestCase):
+    def setUp(self):
+        self.directory = tempfile.TemporaryDirectory()
+        self.path = os.path.join(self.directory.name, 'session.cap')
+        self.addCleanup(self.directory.cleanup)
+
+    def testRecordReplay(self):
+        server = Server('SSH-2.0-SSH_Core\r\n')
+        client, remote = socket.socketpair()
+        with Recorder(self.path) as recorder, server, client, remote:
+            remote.sendall(b'SSH-2.0-Test\r\n')
+            handler = TransportHandler(server, client, recorder=recorder)
+            self.assertEqual(SimulatedClient(remote).read_line(), b'SSH-2.0-SSH_Core\r\n')
+            payloads = [kexinit_payload('curve25519-sha256') for _ in range(10)]
+            for payload in payloads:
+                remote.sendall(packet_bytes(payload))
+                self.assertEqual(handler.get_packet().payload.data, payload)
+            handler.close()
+
+        records = list(read_capture(self.path))
+        self.assertEqual(records[0][0], OUTBOUND)
+        outbound = [data for direction, _, data in records if direction == OUTBOUND]
+        self.assertEqual(len(outbound), 1)
+        self.assertTrue(outbound[0].startswith(b'SSH-2.0-SSH_Core\r\n'))
+
+        report = Replayer(self.path).run()
+        self.assertEqual(report['version'], 'SSH-2.0-Test')
+        self.assertEqual(report['packets'], 10)
+        self.assertEqual(report['leftover_bytes'], 0)
+
+    def testProtected(self):
+        newkeys = packet_bytes(b'\x15')
+        plain = [packet_bytes(b'\x5e'+SSH_Core.UInt32(index).encode()) for index in range(3)]
+        with Recorder(self.path) as recorder:
+            recorder.record(OUTBOUND, b'banner line\r\nSSH-2.0-Server\r\n')
+            recorder.record(OUTBOUND, plain[0]+newkeys)
+            for packet in plain[1:]:
+                recorder.record(OUTBOUND, packet+bytes(32))
+        report = Replayer(self.path, OUTBOUND, mac_len=32).run()
+        self.assertEqual(report['version'], 'SSH-2.0-Server')
+        self.assertEqual(report['packets'], 4)
+        self.assertEqual(report['leftover_bytes'], 0)
+        # without the MAC length the MAC is read as the next packet
+        self.assertRaises(ValueError, Replayer(self.path, OUTBOUND).run)
+
+        cipher = AES128CTR(bytes(16), bytes(16))
+        with Recorder(self.path) as recorder:
+            recorder.record(INBOUND, b'SSH-2.0-Client\r\n'+newkeys)
+            recorder.record(INBOUND, cipher.encrypt(0, plain[0]))
+        self.assertRaises(ValueError, Replayer(self.path).run)
+
+
+class LoadTest(unittest.TestCase):
+    def testSocketpair(self):
+        report = LoadGenerator(clients=4, sessions=5, mix={'handshake': 1, 'bulk': 1}, bulk_size=100_000).run()
+        self.assertEqual(report['handshakes'], 20)
+        self.assertEqual(report['errors'], 0)
+
+    def testMalformedVersion(self):
+        generator = LoadGenerator()
+        registry = generator.registry
+        client_side, server_side = socket.socketpair()
+        with client_side, generator.server:
+            client_side.sendall(b'SSH-1.0-Old\r\n')
+            generator.serve(server_side)
+            self.assertEqual(server_side.fileno(), -1)
+            self.assertEqual(generator.server_errors, 1)
+            self.assertEqual(registry.connections, dict())
+            client = SimulatedClient(client_side)
+            client.read_line()
+            # the KEXINIT sent with the identification string, then the server closed the connection
+            client.read_packet()
+            self.assertRaises(ConnectionError, client.read_packet)
+
+    def testTCP(self):
+        report = LoadGenerator(clients=2, sessions=5, transport='tcp').run()
+        self.assertEqual(report['handshakes'], 10)
+        self.assertEqual(report['errors'], 0)
+
+
+class MessageView(unittest.TestCase):
+    @property
+    def test_data(self):
+        for _ in range(random_tests_count):
+            names = [''.join(random.sample(ascii_letters, random.randint(1, 20))) for _ in range(random.randint(0, 5))]
+            yield kexinit_payload(*names, first_kex_packet_follows=random.choice((True, False)))
+
+    def testFields(self):
+        for data in self.test_data:
+            view = AlgoNegotiationView(data)
+            message = AlgoNegotiation.decode(data)
+            with self.subTest(f'Compare view with decode: {data}'):
+                self.assertEqual(view.kex_algorithms.data, message.kex_algorithms.data)
+                self.assertEqual(view.first_kex_packet_follows.data, message.first_kex_packet_follows.data)
+                self.assertEqual(view.materialize(), message)
+                self.assertEqual(view.encode(), data)
+
+    def testLazy(self):
+        for data in self.test_data:
+            view = AlgoNegotiationView(data)
+            view.kex_algorithms
+            with self.subTest(f'Only accessed fields are decoded: {data}'):
+                self.assertEqual(sum(value is not None for value in view.values), 1)
+                self.assertIs(view.kex_algorithms, view.kex_algorithms)
+
+    def testTruncated(self):
+        for data in self.test_data:
+            size = random.randint(0, len(data)-1)
+            with self.subTest(f'Fail view of {size} bytes of {data}'):
+                self.assertRaises(StructError, AlgoNegotiationView, data[:size])
+
+
+class Analysis(unittest.TestCase):
+    def setUp(self):
+        self.directory = tempfile.TemporaryDirectory()
+        self.path = os.path.join(self.directory.name, 'session.cap')
+        self.addCleanup(self.directory.cleanup)
+
+        self.payloads = [bytes([random.choice((2, 20, 94))])+random.randbytes(random.randint(0, 3000))
+                         for _ in range(random_tests_count)]
+        stream = b'SSH-2.0-Test\r\n'+b''.join(packet_bytes(payload) for payload in self.payloads)
+        with Recorder(self.path) as recorder:
+            recorder.record(OUTBOUND, b'Welcome\r\nSSH-2.0-SSH_Core\r\n'+packet_bytes(b'\x15'))
+            while stream:
+                size = random.randint(1, 4096)
+                recorder.record(INBOUND, stream[:size])
+                stream = stream[size:]
+
+    def testFraming(self):
+        columns = frame_capture(self.path)
+        inbound = [index for index, direction in enumerate(columns.direction) if direction == INBOUND]
+        self.assertEqual(len(inbound), len(self.payloads))
+        self.assertEqual(list(columns.direction).count(OUTBOUND), 1)
+
+        offset = len(b'SSH-2.0-Test\r\n')
+        for index, payload in zip(inbound, self.payloads):
+            with self.subTest(f'Packet at {offset}'):
+                self.assertEqual(columns.offset[index], offset)
+                self.assertEqual(columns.message[index], payload[0])
+                self.assertEqual(columns.length[index], columns.padding[index]+len(payload)+1)
+            offset += 4+columns.length[index]
+        self.assertEqual(list(columns.timestamp), sorted(columns.timestamp))
+
+    def testMac(self):
+        packets = [packet_bytes(b'\x02'), packet_bytes(b'\x15'), packet_bytes(b'\x5e'+bytes(100))]
+        with Recorder(self.path) as recorder:
+            recorder.record(OUTBOUND, b'SSH-2.0-SSH_Core\r\n'+b''.join(packets[:2]))
+            recorder.record(OUTBOUND, packets[2]+bytes(32)+packets[2][:10])
+            recorder.record(OUTBOUND, packets[2][10:]+bytes(32))
+        columns = frame_capture(self.path, mac_len=32)
+        self.assertEqual(list(columns.message), [2, 21, 94, 94])
+        start = len(b'SSH-2.0-SSH_Core\r\n')+len(packets[0])+len(packets[1])
+        self.assertEqual(list(columns.offset)[2:], [start, start+len(packets[2])+32])
+        # the MAC is read as the next packet without mac_len
+        self.assertRaises(ValueError, frame_capture, self.path)
+
+    def testSummary(self):
+        summary = summarize(frame_capture(self.path))
+        self.assertEqual(summary['inbound']['packets'], len(self.payloads))
+        self.assertEqual(summary['outbound']['messages'], {'SSH_MSG_NEWKEYS': 1})
+        self.assertEqual(summary['outbound']['packet_size']['max'], 16)
+
+    def testSummaryWithoutNumpy(self):
+        columns = frame_capture(self.path)
+        with unittest.mock.patch('SSH_Core.Analysis.numpy', None):
+            summary = summarize(columns)
+        self.assertEqual(summary['inbound']['packets'], len(self.payloads))
+        self.assertEqual(summary['inbound']['bytes'], sum(length+4 for length in columns.length)-16)
+        self.assertEqual(sum(summary['inbound']['messages'].values()), len(self.payloads))
+        if numpy is not None:
+            self.assertEqual(summary['inbound']['messages'], summarize(columns)['inbound']['messages'])
+
+
+class Hashing(unittest.TestCase):
+    @property
+    def test_data(self):
+        for _ in range(random_tests_count):
+            yield random.choice((
+                (SSH_Core.Byte, (random.randbytes(random.randint(0, 30)), )),
+                (SSH_Core.UInt32, (random.randint(0, (1 << 32)-1), )),
+                (SSH_Core.String, (''.join(random.sample(printable, random.randint(0, 30))), )),
+                (SSH_Core.NameList, tuple(random.sample(ascii_letters, random.randint(0, 10)))),
+            ))
+
+    def testEqual(self):
+        for data_cls, data in self.test_data:
+            inst1, inst2 = data_cls(*data), data_cls(*data)
+            with self.subTest(f'Equal values of {data_cls.__name__}: {data}'):
+                self.assertEqual(inst1, inst2)
+                self.assertEqual(hash(inst1), hash(inst2))
+                self.assertEqual(len({inst1, inst2}), 1)
+
+    def testTypes(self):
+        self.assertNotEqual(SSH_Core.UInt32(1), SSH_Core.UInt64(1))
+        self.assertNotEqual(SSH_Core.UInt32(1), SSH_Core.MPInt(1))
+        self.assertNotEqual(SSH_Core.String('a'), 'a')
+        self.assertNotEqual(SSH_Core.Byte(b'\x01'), SSH_Core.Boolean(True))
+
+    def testImmutable(self):
+        inst = SSH_Core.String('none')
+        cache = {inst: 1}
+        self.assertRaises(AttributeError, setattr, inst, 'data', 'zlib')
+        self.assertRaises(AttributeError, setattr, inst, 'other', 'zlib')
+        self.assertEqual(inst.data, 'none')
+        self.assertIn(SSH_Core.String('none'), cache)
+        self.assertEqual(SSH_Core.Byte[4](b'test').data, b'test')
+
+
+class FirstKexPacket(unittest.TestCase):
+    delay = 0.02
+    guess = b'\x1e'+SSH_Core.MPInt(random.getrandbits(2048)).encode()
+    marker = b'\x02marker'
+
+    def exchange(self, kex_algorithms: tuple) -> tuple:
+        server = Server()
+        self.addCleanup(server.close)
+        client_side, server_side = delayed_socketpair(self.delay)
+        self.addCleanup(client_side.close)
+        self.addCleanup(server_side.close)
+        result = dict()
+
+        def serve():
+            handler = TransportHandler(server, server_side)
+            handler.exchange_protocols()
+            start = time.perf_counter()
+            result['packet'] = handler.get_packet().payload.data
+            result['wait'] = time.perf_counter()-start
+            result['handler'] = handler
+
+        thread = threading.Thread(target=serve)
+        thread.start()
+        client = SimulatedClient(client_side, algorithms={**default_algorithms, 'kex_algorithms': kex_algorithms})
+        client.handshake(self.guess)
+        client_side.sendall(packet_bytes(self.marker))
+        thread.join()
+        return result['handler'], result['packet'], result['wait']
+
+    def testRightGuess(self):
+        handler, packet, wait = self.exchange(default_algorithms['kex_algorithms'])
+        self.assertTrue(handler.client_guess)
+        self.assertEqual(packet, self.guess)
+        self.assertLess(wait, self.delay)
+
+    def testWrongGuess(self):
+        handler, packet, _ = self.exchange(tuple(reversed(default_algorithms['kex_algorithms'])))
+        self.assertFalse(handler.client_guess)
+        self.assertEqual(handler.algorithms['kex_algorithms'], default_algorithms['kex_algorithms'][1])
+        self.assertEqual(packet, self.marker)
+
+    def testNegotiate(self):
+        server = kexinit(default_algorithms)
+        client = kexinit({**default_algorithms, 'mac_algorithms_client_to_server': ('hmac-md5', )})
+        self.assertRaises(ValueError, negotiate, client, server)
+
+
+class VersionExchange(unittest.TestCase):
+    banner = b'Welcome\r\nsecond line\n'
+
+    def testIncremental(self):
+        data = self.banner+b'SSH-2.0-Test comment\r\n'+b'\x00\x00\x00\x0c'
+        reader = VersionReader()
+        versions = [reader.feed(data[index:index+1]) for index in range(len(data))]
+        self.assertEqual(versions.count(None), len(self.banner)+len(b'SSH-2.0-Test comment\r'))
+        self.assertEqual(reader.version, 'SSH-2.0-Test comment')
+        self.assertEqual(reader.banner, ['Welcome', 'second line'])
+        self.assertEqual(reader.leftover, b'\x00\x00\x00\x0c')
+
+    def testFail(self):
+        for data in (b'SSH-1.5-Old\r\n', b'x'*300, b'\n'*(VersionReader.max_banner+1)):
+            with self.subTest(f'Fail version exchange with: {data[:20]}'):
+                self.assertRaises(ValueError, VersionReader().feed, data)
+
+    def testPipelined(self):
+        server = Server()
+        client, remote = socket.socketpair()
+        with server, client, remote:
+            payload = kexinit(default_algorithms).encode()
+            remote.sendall(self.banner+b'SSH-2.0-Test\r\n'+packet_bytes(payload)+packet_bytes(b'\x02marker'))
+            handler = TransportHandler(server, client)
+            handler.exchange_protocols()
+            self.assertEqual(handler.client_version, 'SSH-2.0-Test')
+            self.assertEqual(handler.get_packet().payload.data, b'\x02marker')
+
+            simulated = SimulatedClient(remote)
+            self.assertEqual(simulated.read_line().decode(), server.version_exchange)
+            self.assertEqual(simulated.read_packet().payload.data, handler.server_protocols.encode())
+            handler.close()
+
+
+class Rekey(unittest.TestCase):
+    def testConcurrentCount(self):
+        scheduler = RekeyScheduler()
+        threads = [
+            threading.Thread(target=lambda: [scheduler.count(100) for _ in range(random_tests_count*100)])
+            for _ in range(4)
+        ]
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+        self.assertEqual(scheduler.packets, 4*random_tests_count*100)
+        self.assertEqual(scheduler.bytes, 400*random_tests_count*100)
+
+    def testBulkTransfer(self):
+        server = Server()
+        client_side, server_side = socket.socketpair()
+        with server, client_side, server_side:
+            client = SimulatedClient(client_side)
+            client_side.sendall(b'SSH-2.0-Test\r\n'+packet_bytes(kexinit(default_algorithms).encode()))
+            handler = TransportHandler(server, server_side, rekey=RekeyScheduler(bytes_limit=50_000))
+            handler.exchange_protocols()
+            client.read_line()
+            client.read_packet()
+
+            def read():
+                try:
+                    while True:
+                        handler.get_packet()
+                except ConnectionError:
+                    pass
+
+            reader = threading.Thread(target=read)
+            reader.start()
+            count = 200
+            received = list()
+            receiver = threading.Thread(target=lambda: received.extend(client.receive()))
+            receiver.start()
+            for index in range(count):
+                if index % 10 == 0:
+                    # let each exchange finish now and then, packets sent in between are queued
+                    handler.keys_ready.wait()
+                handler.send_packet(Packet.create(b'\x5e'+SSH_Core.UInt32(index).encode()+bytes(1000)))
+            # set once the packets queued during the last exchange have been written
+            handler.keys_ready.wait()
+            server_side.shutdown(socket.SHUT_WR)
+            receiver.join()
+            client_side.shutdown(socket.SHUT_WR)
+            reader.join()
+            handler.close()
+
+        data = [payload for payload in received if payload[:1] == b'\x5e']
+        self.assertEqual([SSH_Core.UInt32.decode(payload[1:])[0].data for payload in data], list(range(count)))
+        self.assertGreater(handler.metrics.rekeys, 1)
+
+        kex = False
+        for payload in received:
+            with self.subTest('No channel data between KEXINIT and NEWKEYS'):
+                if payload[:1] == b'\x14':
+                    kex = True
+                elif payload[:1] == b'\x15':
+                    kex = False
+                else:
+                    self.assertFalse(kex)
+
+    def testScheduler(self):
+        scheduler = RekeyScheduler(bytes_limit=100, packets_limit=3)
+        scheduler.count(10)
+        scheduler.count(10)
+        self.assertFalse(scheduler.due())
+        scheduler.count(10)
+        self.assertTrue(scheduler.due())
+        scheduler.reset()
+        scheduler.count(100)
+        self.assertTrue(scheduler.due())
+        self.assertTrue(RekeyScheduler(seconds_limit=0).due())
+
+class Crypto(unittest.TestCase):
+    def connect(self, server, client_side, server_side, offload):
+        client = SimulatedClient(client_side)
+        client_side.sendall(b'SSH-2.0-Test\r\n'+packet_bytes(kexinit(default_algorithms).encode()))
+        handler = TransportHandler(server, server_side, offload=offload)
+        handler.exchange_protocols()
+        client.read_line()
+        client.read_packet()
+        return client, handler
+
+    def testMac(self):
+        for name in Mac.algorithms:
+            mac = Mac(name, os.urandom(32))
+            for _ in range(random_tests_count):
+                sequence = random.randint(0, 0xFFFFFFFF)
+                data = os.urandom(random.randint(0, 1024))
+                with self.subTest('Sign and verify', name=name, sequence=sequence):
+                    self.assertEqual(mac.verify(sequence, mac.sign(sequence, data)), data)
+                with self.subTest('Wrong sequence number', name=name, sequence=sequence):
+                    self.assertRaises(ValueError, mac.verify, (sequence+1) & 0xFFFFFFFF, mac.sign(sequence, data))
+        self.assertRaises(ValueError, Mac, 'hmac-md5', b'')
+
+    def testOffloadOrder(self):
+        def work(sequence, data):
+            time.sleep(random.random()/1000)
+            return sequence
+
+        offload = CryptoOffload(threshold=100, workers=4)
+        sizes = [random.choice((10, 1000)) for _ in range(random_tests_count)]
+        for sequence, size in enumerate(sizes):
+            offload.submit(work, sequence, bytes(size))
+        self.assertEqual(offload.ready(block=True), list(range(len(sizes))))
+        self.assertEqual(list(offload.map(work, enumerate(bytes(size) for size in sizes))), list(range(len(sizes))))
+        offload.shutdown()
+
+    def testOffloadedSend(self):
+        server = Server()
+        client_side, server_side = socket.socketpair()
+        offload = CryptoOffload(threshold=1024, workers=4)
+        with server, client_side, server_side:
+            client, handler = self.connect(server, client_side, server_side, offload)
+            mac = Mac('hmac-sha2-256', os.urandom(32))
+            handler.set_mac(outbound=mac)
+
+            count = 100
+            sizes = [random.choice((16, 8192)) for _ in range(count)]
+            received = list()
+
+            def receive():
+                for sequence in range(1, count+1):
+                    size = int.from_bytes(client.read(4), 'big')
+                    data = mac.verify(sequence, size.to_bytes(4, 'big')+client.read(size+mac.size))
+                    received.append(Packet.decode(data)[0].payload.data)
+
+            receiver = threading.Thread(target=receive)
+            receiver.start()
+            for index, size in enumerate(sizes):
+                handler.send_packet(Packet.create(b'\x5e'+SSH_Core.UInt32(index).encode()+bytes(size)))
+            handler.flush(block=True)
+            receiver.join()
+            handler.close()
+        offload.shutdown()
+
+        self.assertEqual([SSH_Core.UInt32.decode(payload[1:])[0].data for payload in received], list(range(count)))
+        self.assertEqual([len(payload)-5 for payload in received], sizes)
+
+    def testOffloadBothWays(self):
+        # one pool thread seals outbound and opens inbound packets, it must never be the one blocked on the socket
+        server = Server()
+        client_side, server_side = socket.socketpair()
+        offload = CryptoOffload(threshold=1024, workers=1)
+        with server, client_side, server_side:
+            client, handler = self.connect(server, client_side, server_side, offload)
+            mac = Mac('hmac-sha2-256', os.urandom(32))
+            handler.set_mac(outbound=mac, inbound=mac)
+
+            count = 64
+            payload = b'\x5e'+bytes(32 << 10)
+            inbound = b''.join(mac.sign(index+1, packet_bytes(payload)) for index in range(count))
+            received = list()
+
+            def peer():
+                # sends everything before reading, like a client uploading while the server is downloading
+                client_side.sendall(inbound)
+                for _ in range(count):
+                    size = int.from_bytes(client.read(4), 'big')
+                    received.append(client.read(size+mac.size))
+
+            def read():
+                for _ in range(count):
+                    handler.get_packet()
+
+            def send():
+                for _ in range(count):
+                    handler.send_packet(Packet.create(payload))
+
+            threads = [threading.Thread(target=target, daemon=True) for target in (peer, read, send)]
+            for thread in threads:
+                thread.start()
+            deadline = time.monotonic()+30
+            for thread in threads:
+                thread.join(max(0.0, deadline-time.monotonic()))
+            stalled = any(thread.is_alive() for thread in threads)
+            if stalled:
+                server_side.shutdown(socket.SHUT_RDWR)
+                client_side.shutdown(socket.SHUT_RDWR)
+            else:
+                handler.close()
+        offload.shutdown()
+        self.assertFalse(stalled)
+        self.assertEqual(len(received), count)
+
+    def testOffloadedReceive(self):
+        server = Server()
+        client_side, server_side = socket.socketpair()
+        offload = CryptoOffload(threshold=1024, workers=4)
+        with server, client_side, server_side:
+            client, handler = self.connect(server, client_side, server_side, offload)
+            mac = Mac('hmac-sha2-512', os.urandom(64))
+            handler.set_mac(inbound=mac)
+
+            count = 50
+            sizes = [random.choice((16, 8192)) for _ in range(count)]
+            data = b''.join(
+                mac.sign(index+1, packet_bytes(b'\x02'+SSH_Core.UInt32(index).encode()+bytes(size)))
+                for index, size in enumerate(sizes)
+            )
+            sender = threading.Thread(target=client_side.sendall, args=(data, ))
+            sender.start()
+            for index in range(count):
+                with self.subTest('Packets come back in order', index=index):
+                    payload = handler.get_packet().payload.data
+                    self.assertEqual(SSH_Core.UInt32.decode(payload[1:])[0].data, index)
+            sender.join()
+
+            data = bytearray(mac.sign(count+1, packet_bytes(b'\x02'+bytes(8192))))
+            data[-1] ^= 1
+            client_side.sendall(data)
+            self.assertRaises(ValueError, handler.get_packet)
+            handler.close()
+        offload.shutdown()
+
+    def testPaddedForCipher(self):
+        server = Server()
+        client_side, server_side = socket.socketpair()
+        with server, client_side, server_side:
+            client, handler = self.connect(server, client_side, server_side, None)
+            handler.set_cipher(outbound=AES128CTR(os.urandom(16), os.urandom(16)))
+            encode = Packet.encode
+            with unittest.mock.patch.object(Packet, 'encode', autospec=True, side_effect=encode) as patched:
+                for size in range(1, 33):
+                    payload = b'\x5e'+bytes(size)
+                    for packet in (handler.create_packet(payload), Packet.create(payload)):
+                        with self.subTest('Encoded once and padded to the block size', size=size):
+                            self.assertEqual(len(handler.encode_packet(packet)) % 16, 0)
+            self.assertEqual(patched.call_count, 64)
+            handler.close()
+
+    def testEncryptedTransport(self):
+        for offload in (None, CryptoOffload(threshold=1024, workers=2)):
+            server = Server()
+            client_side, server_side = socket.socketpair()
+            with server, client_side, server_side, self.subTest(offload=offload is not None):
+                client, handler = self.connect(server, client_side, server_side, offload)
+                keys = os.urandom(16), os.urandom(16), os.urandom(64)
+                handler.set_cipher(AES128CTR(keys[0], keys[1]), ChaCha20Poly1305(keys[2]))
+                mac = Mac('hmac-sha2-256', os.urandom(32))
+                handler.set_mac(outbound=mac)
+                outbound = ChaCha20Poly1305(keys[2])
+                inbound = InboundPipeline(AES128CTR(keys[0], keys[1]), mac)
+                inbound.framer.sequence = handler.send_sequence
+
+                sizes = [random.choice((16, 4096)) for _ in range(20)]
+                data = b''.join(
+                    outbound.encrypt(index+1, Packet.create(
+                        b'\x02'+SSH_Core.UInt32(index).encode()+bytes(size), 8, 4
+                    ).encode())
+                    for index, size in enumerate(sizes)
+                )
+                sender = threading.Thread(target=client_side.sendall, args=(data, ))
+                sender.start()
+                for index in range(len(sizes)):
+                    payload = handler.get_packet().payload.data
+                    self.assertEqual(SSH_Core.UInt32.decode(payload[1:])[0].data, index)
+                    handler.send_packet(Packet.create(payload))
+                handler.flush(block=True)
+                sender.join()
+
+                received = list()
+                while len(received) < len(sizes):
+                    received += inbound.run(client_side.recv(65536))
+                self.assertEqual([len(packet.payload.data)-5 for packet in received], sizes)
+                handler.close()
+            if offload is not None:
+                offload.shutdown()
+
+
+class Cipher(unittest.TestCase):
+    def testVectors(self):
+        block = 0x00112233445566778899aabbccddeeff
+        with self.subTest('AES-128, FIPS-197 appendix C.1'):
+            self.assertEqual(AES(bytes(range(16))).encrypt(block).hex(), '69c4e0d86a7b0430d8cdb78070b4c55a')
+        with self.subTest('AES-256, FIPS-197 appendix C.3'):
+            self.assertEqual(AES(bytes(range(32))).encrypt(block).hex(), '8ea2b7ca516745bfeafc49904b496089')
+        with self.subTest('Poly1305, RFC 7539 section 2.5.2'):
+            key = bytes.fromhex('85d6be7857556d337f4452fe42d506a80103808afb0db2fd4abff6af4149f51b')
+            self.assertEqual(poly1305(key, b'Cryptographic Forum Research Group').hex(),
+                             'a8061dc1305136c6c22b8baf0c0127a9')
+        with self.subTest('ChaCha20 block, RFC 7539 section 2.3.2'):
+            # the 96 bit nonce 000000090000004a00000000 with counter 1 as a 64 bit counter and nonce
+            keystream = chacha20(bytes(range(32)), bytes.fromhex('0000004a00000000'), 1 | 0x09000000 << 32, 64)
+            self.assertEqual(keystream[:16].hex(), '10f1e7e4d13b5915500fdd1fa32071c4')
+        with self.subTest('AES-128 CTR, SP 800-38A F.5.1'):
+            cipher = AES128CTR(bytes.fromhex('2b7e151628aed2a6abf7158809cf4f3c'),
+                               bytes.fromhex('f0f1f2f3f4f5f6f7f8f9fafbfcfdfeff'), backends['python'])
+            plain = bytes.fromhex('6bc1bee22e409f96e93d7e117393172aae2d8a571e03ac9c9eb76fac45af8e51')
+            self.assertEqual(cipher.encrypt(0, plain[:16])+cipher.encrypt(1, plain[16:]), bytes.fromhex(
+                '874d6191b620e3261bef6864990db6ce9806f66b7970fdff8617187bb9fffdff'
+            ))
+        self.assertRaises(ValueError, AES256CTR, bytes(16), bytes(16))
+
+    def testPipeline(self):
+        for name, backend in ((name, backend) for name in ciphers for backend in backends.values()):
+            key, iv, integrity = os.urandom(64), os.urandom(16), os.urandom(32)
+            mac_name = 'none' if name.startswith('chacha20') else 'hmac-sha2-256'
+            algorithms = {
+                'encryption_algorithms_client_to_server': name,
+                'mac_algorithms_client_to_server': mac_name,
+                'compression_algorithms_client_to_server': 'none',
+            }
+            pipeline = InboundPipeline.from_algorithms(algorithms, key, iv, integrity)
+            sender = ciphers[name](key, iv, backend)
+            mac = Mac(mac_name, integrity) if mac_name != 'none' else None
+            payloads = [os.urandom(random.randint(1, 2000)) for _ in range(20)]
+            data = b''
+            for sequence, payload in enumerate(payloads):
+                packet = Packet.create(payload, sender.block_size, sender.aad_size).encode()
+                data += sender.encrypt(sequence, packet)+(mac.compute(sequence, packet) if mac else b'')
+            with self.subTest('Decrypted by the inbound pipeline', name=name, backend=backend.name):
+                position = random.randint(1, len(data)-1)
+                packets = pipeline.run(data[:position])+pipeline.run(data[position:])
+                self.assertEqual([packet.payload.data for packet in packets], payloads)
+            with self.subTest('Tampered packets are refused', name=name, backend=backend.name):
+                plain = Packet.create(b'\x02', sender.block_size, sender.aad_size).encode()
+                packet = bytearray(sender.encrypt(len(payloads), plain))
+                packet[-1] ^= 1
+                if mac is not None:
+                    packet += mac.compute(len(payloads), plain)
+                self.assertRaises(ValueError, pipeline.run, bytes(packet))
+
+    def testOutOfOrder(self):
+        key, iv = os.urandom(16), os.urandom(16)
+        ordered = AES128CTR(key, iv, backends['python'])
+        packets = [os.urandom(16*random.randint(1, 20)) for _ in range(10)]
+        expected = [ordered.encrypt(sequence, packet) for sequence, packet in enumerate(packets)]
+        cipher = AES128CTR(key, iv, backends['python'])
+        for sequence, packet in enumerate(packets):
+            cipher.reserve(sequence, len(packet))
+        self.assertEqual([cipher.encrypt(sequence, packets[sequence]) for sequence in reversed(range(10))],
+                         expected[::-1])
+        self.assertEqual(len(cipher.frames), 0)
+
+    def testLookahead(self):
+        generated = list()
+        cipher = AES128CTR(os.urandom(16), os.urandom(16), backends['python'], lookahead=8192)
+        generate = cipher.keystream.generate
+        cipher.keystream.generate = lambda size: generated.append(size) or generate(size)
+        while cipher.prefetch():
+            pass
+        self.assertEqual(generated, [4096, 4096])
+        cipher.encrypt(0, bytes(8000))
+        with self.subTest('Encrypting only takes prefetched keystream'):
+            self.assertEqual(len(generated), 2)
+        with self.subTest('Used keystream is released'):
+            self.assertEqual(len(cipher.keystream.buffer), 192)
+        cipher.prefetch()
+        self.assertEqual(len(generated), 3)
+
+
+class Pipeline(unittest.TestCase):
+    def testStages(self):
+        mac = Mac('hmac-sha2-256', os.urandom(32))
+        pipeline = InboundPipeline(mac=mac, compression='zlib')
+        self.assertEqual(repr(pipeline), 'InboundPipeline(framer -> verify -> decode -> decompress -> dispatch)')
+        dispatched = list()
+        pipeline.dispatcher.register(2, lambda packet: dispatched.append(packet.payload.data))
+
+        compressor = zlib.compressobj()
+        payloads = [b'\x02'+os.urandom(8)*random.randint(0, 1000) for _ in range(random_tests_count)]
+        data = b''.join(
+            mac.sign(sequence, packet_bytes(compressor.compress(payload)+compressor.flush(zlib.Z_SYNC_FLUSH)))
+            for sequence, payload in enumerate(payloads)
+        )
+        packets = list()
+        while data:
+            size = random.randint(1, 4096)
+            packets.extend(pipeline.run(data[:size]))
+            data = data[size:]
+
+        self.assertEqual([packet.payload.data for packet in packets], payloads)
+        self.assertEqual(dispatched, payloads)
+        for name, stats in pipeline.stats().items():
+            with self.subTest('Every stage counts every packet', stage=name):
+                self.assertEqual(stats['calls'], len(payloads))
+
+    def testVerifyFails(self):
+        mac = Mac('hmac-sha1', os.urandom(20))
+        pipeline = InboundPipeline(mac=mac)
+        data = bytearray(mac.sign(0, packet_bytes(b'\x02')))
+        data[5] ^= 1
+        self.assertRaises(ValueError, pipeline.run, bytes(data))
+
+    def testUnread(self):
+        pipeline = InboundPipeline()
+        pipeline.framer.feed(b''.join(packet_bytes(bytes([index])) for index in range(5)))
+        frames = pipeline.framer.frames()
+        self.assertEqual([sequence for sequence, _ in frames], list(range(5)))
+        pipeline.framer.unread(frames[2:])
+        self.assertEqual(pipeline.framer.sequence, 2)
+        self.assertEqual([packet.payload.data for packet in pipeline.run(b'')], [b'\x02', b'\x03', b'\x04'])
+
+    def testMaxPacket(self):
+        pipeline = InboundPipeline()
+        pipeline.framer.feed(b'\xff\xff\xff\xff')
+        self.assertRaises(ValueError, pipeline.framer.needed)
+
+        data = packet_bytes(b'\x02'+bytes(40_000))
+        self.assertRaises(ValueError, InboundPipeline().run, data[:16])
+        self.assertEqual(len(InboundPipeline(max_packet=1 << 16).run(data)), 1)
+
+        keys = os.urandom(16), os.urandom(16)
+        data = AES128CTR(*keys).encrypt(0, Packet.create(b'\x02'+bytes(40_000), 16).encode())
+        self.assertRaises(ValueError, InboundPipeline(AES128CTR(*keys)).run, data[:16])
+        self.assertEqual(len(InboundPipeline(AES128CTR(*keys), max_packet=1 << 16).run(data)), 1)
+
+    def testAbstractStage(self):
+        self.assertRaises(TypeError, Stage)
+
+    def testFromAlgorithms(self):
+        algorithms = negotiate(kexinit(default_algorithms), kexinit(default_algorithms))
+        self.assertRaises(ValueError, InboundPipeline.from_algorithms, algorithms)
+        algorithms['encryption_algorithms_client_to_server'] = 'none'
+        pipeline = InboundPipeline.from_algorithms(algorithms, integrity_key=os.urandom(32))
+        self.assertEqual(pipeline.mac.name, 'hmac-sha2-256')
+        self.assertEqual(repr(pipeline), 'InboundPipeline(framer -> verify -> decode -> dispatch)')
+
+
+class ProtocolErrors(unittest.TestCase):
+    def testDisconnect(self):
+        server = Server()
+        self.addCleanup(server.close)
+        open_session = ConnectMessage.SSH_MSG_CHANNEL_OPEN.encode()+pack_string(b'session')+pack('!III', 0, 1 << 20, 1 << 15)
+        cases = {
+            'Unsolicited global reply': [ConnectMessage.SSH_MSG_REQUEST_SUCCESS.encode()],
+            'Unsolicited channel reply': [open_session, ConnectMessage.SSH_MSG_CHANNEL_SUCCESS.encode()+pack('!I', 0)],
+            'Unknown channel': [ConnectMessage.SSH_MSG_CHANNEL_EOF.encode()+pack('!I', 7)],
+            'Over the window': [open_session, ConnectMessage.SSH_MSG_CHANNEL_DATA.encode()+pack('!I', 0) +
+                                pack_string(bytes(33_000))],
+            'Truncated message': [ConnectMessage.SSH_MSG_CHANNEL_OPEN.encode()+pack('!I', 100)],
+        }
+        for name, payloads in cases.items():
+            with self.subTest(name):
+                client_side, server_side = socket.socketpair()
+                self.addCleanup(client_side.close)
+
+                def run():
+                    handler = TransportHandler(server, server_side)
+                    handler.exchange_protocols()
+                    serve(handler)
+                    handler.close()
+
+                thread = threading.Thread(target=run)
+                thread.start()
+                client_side.settimeout(10)
+                client = SimulatedClient(client_side)
+                client.handshake()
+                client_side.sendall(b''.join(Packet.create(payload).encode() for payload in payloads))
+                # the server drops the connection instead of leaving it open behind a failed thread
+                client.receive()
+                thread.join()
+
+
+class SFTP(unittest.TestCase):
+    def setUp(self):
+        self.directory = tempfile.TemporaryDirectory()
+        self.root = self.directory.name
+        self.cache = HandleCache(size=2)
+        self.server = Server(subsystems={'sftp': functools.partial(SFTPServer, root=self.root, cache=self.cache)})
+        self.client_side, server_side = socket.socketpair()
+
+        def run():
+            handler = TransportHandler(self.server, server_side)
+            handler.exchange_protocols()
+            serve(handler)
+            handler.close()
+
+        self.thread = threading.Thread(target=run)
+        self.thread.start()
+        client = SimulatedClient(self.client_side)
+        client.handshake()
+        self.sftp = SFTPClient.start(client.connection())
+
+    def tearDown(self):
+        self.sftp.channel.close()
+        self.client_side.shutdown(socket.SHUT_WR)
+        self.thread.join()
+        self.client_side.close()
+        self.server.close()
+        self.cache.close()
+        self.directory.cleanup()
+
+    def write(self, name: str, data: bytes):
+        with open(os.path.join(self.root, name), 'wb') as file:
+            file.write(data)
+
+    def testTransfer(self):
+        for size in (0, 1, 1000, 64 << 10, 300_001, 2 << 20):
+            data = os.urandom(size)
+            for block in (4096, 32 << 10, 1 << 20):
+                with self.subTest('Pipelined get and put', size=size, block=block):
+                    self.sftp.put(f'/file-{size}', data, block=block, depth=16)
+                    self.assertEqual(self.sftp.stat(f'file-{size}')['size'], size)
+                    self.assertEqual(self.sftp.get(f'/file-{size}', block=block, depth=16), data)
+
+    def testHandleCache(self):
+        self.write('cached', b'first')
+        self.assertEqual(self.sftp.get('/cached'), b'first')
+        self.assertEqual(self.sftp.get('/cached'), b'first')
+        self.assertEqual((self.cache.hits, self.cache.misses), (1, 1))
+        self.write('cached', b'second version')
+        self.assertEqual(self.sftp.get('/cached'), b'second version')
+        self.assertEqual(self.cache.misses, 2)
+        for name in ('a', 'b', 'c'):
+            self.write(name, name.encode())
+            self.assertEqual(self.sftp.get(name), name.encode())
+        self.assertEqual(len(self.cache.files), 2)
+
+    def testNotOfferedByDefault(self):
+        server = Server()
+        self.assertEqual(server.subsystems, dict())
+        client_side, server_side = socket.socketpair()
+
+        def run():
+            handler = TransportHandler(server, server_side)
+            handler.exchange_protocols()
+            serve(handler)
+            handler.close()
+
+        thread = threading.Thread(target=run)
+        thread.start()
+        with server, client_side:
+            client = SimulatedClient(client_side)
+            client.handshake()
+            self.assertRaises(ConnectionRefusedError, SFTPClient.start, client.connection())
+            client_side.shutdown(socket.SHUT_WR)
+            thread.join()
+
+    def testUnknownResponse(self):
+        waiter = Future()
+        with self.sftp.lock:
+            self.sftp.pending[0xFFFFFFFF] = waiter
+        # a status for request 1000, which was never sent
+        self.sftp.data(pack('!IBII', 9, SFTPMessage.SSH_FXP_STATUS.value, 1000, 0))
+        self.assertIsInstance(waiter.exception(timeout=10), ConnectionError)
+        self.assertTrue(self.sftp.channel.close_sent)
+        self.assertRaises(ConnectionError, self.sftp.stat, '/')
+
+    def testTruncatedWhileRead(self):
+        data = os.urandom(1 << 20)
+        self.write('big', data)
+        handle = self.sftp.open('/big')
+        first, _ = unpack_string(self.sftp.result(self.sftp.read(handle, 0, 64 << 10), SFTPMessage.SSH_FXP_DATA), 5)
+        self.assertEqual(first, data[:64 << 10])
+        self.sftp.close(self.sftp.open('/big', SSH_FXF_WRITE | SSH_FXF_TRUNC))
+        with self.assertRaises(EOFError):
+            self.sftp.result(self.sftp.read(handle, 512 << 10, 64 << 10), SFTPMessage.SSH_FXP_DATA)
+        self.sftp.close(handle)
+
+    def testPaths(self):
+        self.write('inside', b'data')
+        self.assertEqual(self.sftp.get('/../../inside'), b'data')
+        self.assertEqual(sorted(self.sftp.listdir('/')), ['.', '..', 'inside'])
+        self.assertRaises(FileNotFoundError, self.sftp.get, '/missing')
+        self.sftp.put('/other', b'')
+        self.assertRaises(OSError, self.sftp.result, self.sftp.request(
+            SFTPMessage.SSH_FXP_RENAME, pack('!I', 6)+b'/other', pack('!I', 7)+b'/inside'
+        ), SFTPMessage.SSH_FXP_STATUS)
+        self.sftp.remove('/other')
+        self.assertRaises(FileNotFoundError, self.sftp.stat, '/other')
+
+
+class Forwarding(unittest.TestCase):
+    def setUp(self):
+        self.target, self.stop_echo = echo_server()
+        self.server = Server()
+        self.relay = Relay()
+        self.client_relay = Relay()
+        self.remote = RemoteForwarding(self.relay)
+        self.targets = dict()
+        self.client_side, server_side = socket.socketpair()
+
+        def run():
+            handler = TransportHandler(self.server, server_side)
+            handler.exchange_protocols()
+            serve(handler, {'direct-tcpip': DirectTCPIP(self.relay, timeout=1)}, self.remote.requests())
+            handler.close()
+
+        self.thread = threading.Thread(target=run)
+        self.thread.start()
+        client = SimulatedClient(self.client_side)
+        client.handshake()
+        self.connection = client.connection(channel_types={
+            'forwarded-tcpip': ForwardedTCPIP(self.client_relay, self.targets),
+        })
+
+    def tearDown(self):
+        self.client_side.shutdown(socket.SHUT_WR)
+        self.thread.join()
+        self.client_side.close()
+        self.remote.close()
+        self.relay.close()
+        self.client_relay.close()
+        self.stop_echo()
+        self.server.close()
+
+    def echo(self, address: tuple, size: int):
+        data = os.urandom(size)
+        with socket.create_connection(address, timeout=30) as sock:
+            writer = threading.Thread(target=lambda: (sock.sendall(data), sock.shutdown(socket.SHUT_WR)))
+            writer.start()
+            received = bytearray()
+            while chunk := sock.recv(65536):
+                received += chunk
+            writer.join()
+        self.assertEqual(received, data)
+
+    def concurrent(self, address: tuple, count: int, size: int):
+        threads = [threading.Thread(target=self.echo, args=(address, size)) for _ in range(count)]
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+
+    def testLocal(self):
+        forward = LocalForward(self.connection, self.client_relay, *self.target)
+        for size in (0, 1, 100_000, 5 << 20):
+            with self.subTest('Echo through a local forwarding', size=size):
+                self.echo(forward.address, size)
+        with self.subTest('Concurrent connections'):
+            self.concurrent(forward.address, 64, 50_000)
+        forward.close()
+
+    def testRemote(self):
+        response = self.connection.global_request('tcpip-forward', pack_endpoint('127.0.0.1', 0))
+        port = int.from_bytes(response, 'big')
+        self.targets[('127.0.0.1', port)] = self.target
+        with self.subTest('Concurrent connections to the forwarded port'):
+            self.concurrent(('127.0.0.1', port), 64, 50_000)
+        with self.subTest('Cancel'):
+            cancel = pack_endpoint('127.0.0.1', port)
+            # another session cannot cancel the forwarding of this one
+            self.assertIsNone(self.remote.cancel(object(), cancel))
+            self.assertEqual(self.connection.global_request('cancel-tcpip-forward', cancel), b'')
+            self.assertIsNone(self.connection.global_request('cancel-tcpip-forward', cancel))
+        with self.subTest('Only loopback addresses are permitted'):
+            self.assertIsNone(self.connection.global_request('tcpip-forward', pack_endpoint('0.0.0.0', 0)))
+
+    def testRemoteClosedWithConnection(self):
+        response = self.connection.global_request('tcpip-forward', pack_endpoint('127.0.0.1', 0))
+        port = int.from_bytes(response, 'big')
+        self.client_side.shutdown(socket.SHUT_WR)
+        self.thread.join()
+        self.assertEqual(self.remote.listeners, dict())
+        # calls run in order, so the listener is closed once this one has run
+        done = threading.Event()
+        self.relay.call(done.set)
+        done.wait()
+        self.assertRaises(ConnectionRefusedError, socket.create_connection, ('127.0.0.1', port))
+
+    def testUnresponsiveTarget(self):
+        with socket.socket() as listener, socket.socket() as queued:
+            listener.bind(('127.0.0.1', 0))
+            listener.listen(0)
+            queued.connect(listener.getsockname())
+            # the accept queue of the listener is full, so connecting to it waits for the timeout
+            pending = self.connection.open('direct-tcpip', pack_endpoint(*listener.getsockname()) +
+                                           pack_endpoint('127.0.0.1', 0), wait=False)
+            with self.subTest('Other channels open while the connect is pending'):
+                channel = self.connection.open('direct-tcpip', pack_endpoint(*self.target)+pack_endpoint('127.0.0.1', 0))
+                self.assertFalse(pending.opened.is_set())
+                channel.close()
+            with self.subTest('The channel is refused after the timeout'):
+                self.assertTrue(pending.opened.wait(10))
+                self.assertIn('timed out', pending.open_error)
+
+    def testRekeyDuringTransfer(self):
+        server = Server()
+        relay = Relay()
+        client_side, server_side = socket.socketpair()
+        handlers = list()
+
+        def run():
+            # a small queue makes the writer thread run into its limit while keys are exchanged
+            rekey = RekeyScheduler(bytes_limit=1 << 20, queue_limit=64 << 10)
+            handler = TransportHandler(server, server_side, rekey=rekey)
+            handlers.append(handler)
+            handler.exchange_protocols()
+            serve(handler, {'direct-tcpip': DirectTCPIP(relay)})
+            handler.close()
+
+        thread = threading.Thread(target=run)
+        thread.start()
+        self.addCleanup(server.close)
+        self.addCleanup(relay.close)
+        self.addCleanup(client_side.close)
+        self.addCleanup(thread.join)
+        self.addCleanup(client_side.shutdown, socket.SHUT_RDWR)
+        client = SimulatedClient(client_side)
+        client.handshake()
+        forward = LocalForward(client.connection(), self.client_relay, *self.target)
+        self.addCleanup(forward.close)
+        self.echo(forward.address, 16 << 20)
+        self.assertGreater(handlers[0].metrics.rekeys, 0)
+
+    def testRefused(self):
+        with self.subTest('Not permitted'):
+            self.assertRaises(ConnectionRefusedError, self.connection.open, 'direct-tcpip',
+                              pack_endpoint('192.0.2.1', 22)+pack_endpoint('127.0.0.1', 0))
+        with socket.socket() as closed:
+            closed.bind(('127.0.0.1', 0))
+            address = closed.getsockname()
+        with self.subTest('Nothing listening'):
+            self.assertRaises(ConnectionRefusedError, self.connection.open, 'direct-tcpip',
+                              pack_endpoint(*address)+pack_endpoint('127.0.0.1', 0))
+
+    def testBackpressure(self):
+        with socket.socket() as listener:
+            listener.bind(('127.0.0.1', 0))
+            listener.listen()
+            channel = self.connection.open('direct-tcpip', pack_endpoint(*listener.getsockname()) +
+                                           pack_endpoint('127.0.0.1', 0))
+            target, _ = listener.accept()
+        data = os.urandom(16 << 20)
+        sender = threading.Thread(target=channel.send, args=(data, ))
+        sender.start()
+        sender.join(0.5)
+        with self.subTest('Sending stops once the window is used up while the target does not read'):
+            self.assertTrue(sender.is_alive())
+            self.assertEqual(channel.remote_window, 0)
+        received = bytearray()
+        with target:
+            while len(received) < len(data):
+                received += target.recv(1 << 20)
+        sender.join()
+        self.assertEqual(received, data)
+        channel.close()
+
+
 if __name__ == '__main__':
     unittest.main()
@@ -0,0 +1,165 @@
+from collections import deque
+from time import perf_counter_ns
+from threading import get_ident
+from os import getpid
+from json import dump
+
+
+class Histogram(object):
+    def __init__(self):
+        """
+        Latency histogram with power of two buckets in microseconds.
+        Bucket n counts samples that took less than 2**n microseconds.
+        """
+        self.buckets = dict()
+        self.count = 0
+        self.total = 0
+
+    def add(self, duration: int):
+        """
+        Record a single duration
+        :param duration: int nanoseconds
+        """
+        bucket = (duration//1000).bit_length()
+        self.buckets[bucket] = self.buckets.get(bucket, 0)+1
+        self.count += 1
+        self.total += duration
+
+    def as_dict(self) -> dict:
+        """
+        Return the histogram keyed by the upper bound of each bucket in microseconds
+        :return: dict
+        """
+        return {
+            'count': self.count,
+            'total_us': self.total/1000,
+            'buckets': {1 << bucket: self.buckets[bucket] for bucket in sorted(self.buckets)},
+        }
+
+    def __repr__(self):
+        return f'{self.__class__.__name__}(count={self.count}, buckets={self.buckets})'
+
+
+class _Phase(object):
+    __slots__ = ('tracer', 'name', 'args', 'start')
+
+    def __init__(self, tracer, name: str, args: dict):
+        self.tracer = tracer
+        self.name = name
+        self.args = args
+
+    def __enter__(self):
+        self.start = perf_counter_ns()
+        return self
+
+    def __exit__(self, exc_type, exc_val, exc_tb):
+        self.tracer.record(self.name, self.start, perf_counter_ns(), self.args)
+        return False
+
+
+class _NullPhase(object):
+    __slots__ = ()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_val, exc_tb):
+        return False
+
+
+class NullTracer(object):
+    """
+    Tracer used when tracing is disabled.
+    Every phase is the same shared no-op context manager so the cost is a single method call.
+    """
+    enabled = False
+    _phase = _NullPhase()
+
+    def phase(self, name: str, **args):
+        return self._phase
+
+    def record(self, name: str, start: int, end: int, args: dict = None):
+        pass
+
+
+class Tracer(object):
+    enabled = True
+
+    def __init__(self, max_events: int = 100_000):
+        """
+        Collect timings of handshake phases using perf_counter_ns timestamps.
+        Phases are recorded as (name, start, end, thread id, args) tuples.
+        Packets are traced for the whole connection, so only the latest max_events are kept.
+        :param max_events: int events kept, the oldest are dropped first
+        """
+        self.events = deque(maxlen=max_events)
+
+    def phase(self, name: str, **args):
+        """
+        Time the body of a with statement as the given phase
+        :param name: str name of the phase (IE: version_exchange)
+        :param args: extra values to attach to the trace event
+        :return: context manager
+        """
+        return _Phase(self, name, args)
+
+    def record(self, name: str, start: int, end: int, args: dict = None):
+        """
+        Record a phase that has already been timed
+        :param name: str
+        :param start: int perf_counter_ns at the start of the phase
+        :param end: int perf_counter_ns at the end of the phase
+        :param args: dict
+        """
+        self.events.append((name, start, end, get_ident(), args))
+
+    def clear(self):
+        self.events.clear()
+
+    def trace_events(self) -> dict:
+        """
+        Return the recorded phases in the Chrome trace-event format
+        :return: dict that can be serialized with json
+        """
+        pid = getpid()
+        events = list()
+        for name, start, end, tid, args in self.events:
+            event = {
+                'name': name,
+                'cat': 'ssh',
+                'ph': 'X',
+                'ts': start/1000,
+                'dur': (end-start)/1000,
+                'pid': pid,
+                'tid': tid,
+            }
+            if args:
+                event['args'] = {key: str(value) for key, value in args.items()}
+            events.append(event)
+        return {'traceEvents': events, 'displayTimeUnit': 'ns'}
+
+    def dump(self, path: str):
+        """
+        Write the trace-event JSON to a file so it can be loaded in chrome://tracing or Perfetto
+        :param path: str
+        """
+        with open(path, 'w') as file:
+            dump(self.trace_events(), file)
+
+    def histograms(self) -> dict:
+        """
+        Return a latency Histogram for every recorded phase
+        :return: dict of phase name to Histogram
+        """
+        output = dict()
+        for name, start, end, _, _ in self.events:
+            if name not in output:
+                output[name] = Histogram()
+            output[name].add(end-start)
+        return output
+
+    def __repr__(self):
+        return f'{self.__class__.__name__}(events={len(self.events)})'
+
+
+NULL_TRACER = NullTracer()
@@ -0,0 +1,432 @@
+from hmac import compare_digest
+from struct import pack, unpack
+from threading import Lock
+
+try:
+    from cryptography.hazmat.primitives.ciphers import Cipher, algorithms, modes
+    from cryptography.hazmat.primitives.poly1305 import Poly1305
+except ImportError:
+    Cipher = None
+
+
+def xor(data, keystream) -> bytes:
+    """
+    :param data: bytes-like
+    :param keystream: bytes-like of the same size
+    :return: bytes
+    """
+    return (int.from_bytes(data, 'big') ^ int.from_bytes(keystream, 'big')).to_bytes(len(data), 'big')
+
+
+def _double(value: int) -> int:
+    return ((value << 1) ^ (0x1B if value & 0x80 else 0)) & 0xFF
+
+
+def _sbox() -> list:
+    # walk GF(2**8) with generator 3 and its inverse together, so p * q == 1 at every step
+    sbox = [0x63]*256
+    p = q = 1
+    while True:
+        p ^= _double(p)
+        q ^= q << 1
+        q ^= q << 2
+        q ^= q << 4
+        q &= 0xFF
+        if q & 0x80:
+            q ^= 0x09
+        x = q ^ (q << 1 | q >> 7) ^ (q << 2 | q >> 6) ^ (q << 3 | q >> 5) ^ (q << 4 | q >> 4)
+        sbox[p] = (x ^ 0x63) & 0xFF
+        if p == 1:
+            return sbox
+
+
+_S = _sbox()
+# MixColumns of a substituted byte in the first column, the other tables are its rotations
+_T0 = [_double(s) << 24 | s << 16 | s << 8 | _double(s) ^ s for s in _S]
+_T1 = [(t >> 8 | t << 24) & 0xFFFFFFFF for t in _T0]
+_T2 = [(t >> 16 | t << 16) & 0xFFFFFFFF for t in _T0]
+_T3 = [(t >> 24 | t << 8) & 0xFFFFFFFF for t in _T0]
+
+
+class AES(object):
+    def __init__(self, key: bytes):
+        """
+        Pure Python AES block encryption (FIPS-197) with 32 bit table lookups, only the forward direction
+        is needed by CTR mode
+        :param key: bytes of 16, 24 or 32 bytes
+        """
+        if len(key) not in (16, 24, 32):
+            raise ValueError(f'AES key is {len(key)} bytes')
+        words = len(key)//4
+        self.rounds = words+6
+        keys = list(unpack(f'>{words}I', key))
+        rcon = 1
+        for index in range(words, 4*(self.rounds+1)):
+            temp = keys[-1]
+            if index % words == 0:
+                temp = (temp << 8 | temp >> 24) & 0xFFFFFFFF
+                temp = _S[temp >> 24] << 24 | _S[temp >> 16 & 255] << 16 | _S[temp >> 8 & 255] << 8 | _S[temp & 255]
+                temp ^= rcon << 24
+                rcon = _double(rcon)
+            elif words > 6 and index % words == 4:
+                temp = _S[temp >> 24] << 24 | _S[temp >> 16 & 255] << 16 | _S[temp >> 8 & 255] << 8 | _S[temp & 255]
+            keys.append(keys[-words] ^ temp)
+        self.keys = keys
+
+    def encrypt(self, block: int) -> bytes:
+        """
+        :param block: int 128 bit block, IE: a CTR counter
+        :return: bytes 16 bytes
+        """
+        keys = self.keys
+        s0 = (block >> 96) ^ keys[0]
+        s1 = (block >> 64 & 0xFFFFFFFF) ^ keys[1]
+        s2 = (block >> 32 & 0xFFFFFFFF) ^ keys[2]
+        s3 = (block & 0xFFFFFFFF) ^ keys[3]
+        for index in range(4, 4*self.rounds, 4):
+            s0, s1, s2, s3 = (
+                _T0[s0 >> 24] ^ _T1[s1 >> 16 & 255] ^ _T2[s2 >> 8 & 255] ^ _T3[s3 & 255] ^ keys[index],
+                _T0[s1 >> 24] ^ _T1[s2 >> 16 & 255] ^ _T2[s3 >> 8 & 255] ^ _T3[s0 & 255] ^ keys[index+1],
+                _T0[s2 >> 24] ^ _T1[s3 >> 16 & 255] ^ _T2[s0 >> 8 & 255] ^ _T3[s1 & 255] ^ keys[index+2],
+                _T0[s3 >> 24] ^ _T1[s0 >> 16 & 255] ^ _T2[s1 >> 8 & 255] ^ _T3[s2 & 255] ^ keys[index+3],
+            )
+        index = 4*self.rounds
+        return pack(
+            '>4I',
+            (_S[s0 >> 24] << 24 | _S[s1 >> 16 & 255] << 16 | _S[s2 >> 8 & 255] << 8 | _S[s3 & 255]) ^ keys[index],
+            (_S[s1 >> 24] << 24 | _S[s2 >> 16 & 255] << 16 | _S[s3 >> 8 & 255] << 8 | _S[s0 & 255]) ^ keys[index+1],
+            (_S[s2 >> 24] << 24 | _S[s3 >> 16 & 255] << 16 | _S[s0 >> 8 & 255] << 8 | _S[s1 & 255]) ^ keys[index+2],
+            (_S[s3 >> 24] << 24 | _S[s0 >> 16 & 255] << 16 | _S[s1 >> 8 & 255] << 8 | _S[s2 & 255]) ^ keys[index+3],
+        )
+
+    def __repr__(self):
+        return f'{self.__class__.__name__}(rounds={self.rounds})'
+
+
+def chacha20(key: bytes, nonce: bytes, counter: int, size: int) -> bytes:
+    """
+    Pure Python ChaCha20 keystream (RFC 7539 section 2.3) with the 64 bit counter and 64 bit nonce
+    of the original construction, as chacha20-poly1305@openssh.com uses it
+    :param key: bytes 32 bytes
+    :param nonce: bytes 8 bytes
+    :param counter: int first block
+    :param size: int bytes of keystream
+    :return: bytes
+    """
+    state = (0x61707865, 0x3320646E, 0x79622D32, 0x6B206574)+unpack('<8I', key)+(0, 0)+unpack('<2I', nonce)
+    output = list()
+    for block in range(counter, counter+(size+63)//64):
+        x = list(state)
+        x[12], x[13] = block & 0xFFFFFFFF, block >> 32 & 0xFFFFFFFF
+        initial = tuple(x)
+        for _ in range(10):
+            for a, b, c, d in ((0, 4, 8, 12), (1, 5, 9, 13), (2, 6, 10, 14), (3, 7, 11, 15),
+                               (0, 5, 10, 15), (1, 6, 11, 12), (2, 7, 8, 13), (3, 4, 9, 14)):
+                xa, xb, xc, xd = x[a], x[b], x[c], x[d]
+                xa = (xa+xb) & 0xFFFFFFFF
+                xd ^= xa
+                xd = (xd << 16 | xd >> 16) & 0xFFFFFFFF
+                xc = (xc+xd) & 0xFFFFFFFF
+                xb ^= xc
+                xb = (xb << 12 | xb >> 20) & 0xFFFFFFFF
+                xa = (xa+xb) & 0xFFFFFFFF
+                xd ^= xa
+                xd = (xd << 8 | xd >> 24) & 0xFFFFFFFF
+                xc = (xc+xd) & 0xFFFFFFFF
+                xb ^= xc
+                xb = (xb << 7 | xb >> 25) & 0xFFFFFFFF
+                x[a], x[b], x[c], x[d] = xa, xb, xc, xd
+        output.append(pack('<16I', *((word+start) & 0xFFFFFFFF for word, start in zip(x, initial))))
+    return b''.join(output)[:size]
+
+
+def poly1305(key: bytes, data: bytes) -> bytes:
+    """
+    Pure Python Poly1305 (RFC 7539 section 2.5)
+    :param key: bytes 32 byte one time key
+    :param data: bytes-like
+    :return: bytes 16 byte tag
+    """
+    data = bytes(data)
+    r = int.from_bytes(key[:16], 'little') & 0x0FFFFFFC0FFFFFFC0FFFFFFC0FFFFFFF
+    s = int.from_bytes(key[16:32], 'little')
+    prime = (1 << 130)-5
+    accumulator = 0
+    for index in range(0, len(data), 16):
+        accumulator = (accumulator+int.from_bytes(data[index:index+16]+b'\x01', 'little'))*r % prime
+    return ((accumulator+s) & ((1 << 128)-1)).to_bytes(16, 'little')
+
+
+class PythonBackend(object):
+    name = 'python'
+    block = 4 << 10
+
+    def aes_ctr(self, key: bytes, iv: bytes):
+        """
+        :param key: bytes
+        :param iv: bytes 16 byte initial counter
+        :return: callable (size) -> bytes of the next size bytes of keystream, size is a multiple of 16
+        """
+        aes = AES(key)
+        counter = int.from_bytes(iv, 'big')
+
+        def generate(size: int) -> bytes:
+            nonlocal counter
+            start, counter = counter, counter+size//16
+            return b''.join(aes.encrypt(block & (1 << 128)-1) for block in range(start, counter))
+        return generate
+
+    def chacha20(self, key: bytes, nonce: bytes, counter: int, size: int) -> bytes:
+        return chacha20(key, nonce, counter, size)
+
+    def poly1305(self, key: bytes, data: bytes) -> bytes:
+        return poly1305(key, data)
+
+    def __repr__(self):
+        return f'{self.__class__.__name__}(name={self.name})'
+
+
+class CryptographyBackend(PythonBackend):
+    name = 'cryptography'
+    block = 256 << 10
+
+    def aes_ctr(self, key: bytes, iv: bytes):
+        encryptor = Cipher(algorithms.AES(key), modes.CTR(iv)).encryptor()
+        return lambda size: encryptor.update(bytes(size))
+
+    def chacha20(self, key: bytes, nonce: bytes, counter: int, size: int) -> bytes:
+        # the 16 byte nonce of cryptography is the 64 bit block counter followed by the 64 bit nonce
+        encryptor = Cipher(algorithms.ChaCha20(key, counter.to_bytes(8, 'little')+nonce), None).encryptor()
+        return encryptor.update(bytes(size))
+
+    def poly1305(self, key: bytes, data: bytes) -> bytes:
+        return Poly1305.generate_tag(key, bytes(data))
+
+
+backends = {'python': PythonBackend()}
+if Cipher is not None:
+    backends['cryptography'] = CryptographyBackend()
+# the fastest backend that is installed
+default_backend = backends.get('cryptography', backends['python'])
+
+
+class Keystream(object):
+    def __init__(self, generate, block: int, lookahead: int):
+        """
+        CTR keystream generated ahead of use in blocks, kept from the oldest offset that may still be read.
+        Offsets count bytes from the start of the stream.
+        :param generate: callable (size) -> bytes of the next size bytes of keystream
+        :param block: int bytes generated at once
+        :param lookahead: int bytes prefetch keeps ready past the furthest read
+        """
+        self.generate = generate
+        self.block = block
+        self.lookahead = lookahead
+        self.buffer = bytearray()
+        self.start = 0
+        self.position = 0
+
+    def read(self, offset: int, size: int) -> bytes:
+        while offset+size > self.start+len(self.buffer):
+            self.buffer += self.generate(self.block)
+        self.position = max(self.position, offset+size)
+        return bytes(self.buffer[offset-self.start:offset-self.start+size])
+
+    def release(self, offset: int):
+        """
+        Drop the keystream before offset, it will not be read again
+        """
+        if offset > self.start:
+            del self.buffer[:offset-self.start]
+            self.start = offset
+
+    def prefetch(self) -> bool:
+        """
+        Generate one block if less than lookahead is ready
+        :return: bool False once lookahead is ready
+        """
+        if self.start+len(self.buffer) >= self.position+self.lookahead:
+            return False
+        self.buffer += self.generate(self.block)
+        return True
+
+    def __repr__(self):
+        return f'{self.__class__.__name__}(ready={self.start+len(self.buffer)-self.position})'
+
+
+class CTRCipher(object):
+    name = None
+    key_size = None
+    iv_size = 16
+    block_size = 16
+    header_size = 16
+    tag_size = 0
+    aad_size = 0
+    max_packet = 1 << 18
+
+    def __init__(self, key: bytes, iv: bytes, backend=None, lookahead: int = None):
+        """
+        AES in counter mode (RFC 4344 section 4). Packets are encrypted with an XOR against keystream
+        that prefetch generates ahead, while the connection is idle.
+        The keystream offset of a packet is fixed by its sequence number as it is framed or reserved,
+        so packets can be encrypted and decrypted out of order, IE: on a CryptoOffload.
+        :param key: bytes at least key_size bytes, only key_size are used
+        :param iv: bytes at least 16 bytes
+        :param backend: backend of the block cipher, defaults to the fastest one installed
+        :param lookahead: int bytes of keystream to keep ready, defaults to 4 blocks of the backend
+        """
+        if len(key) < self.key_size or len(iv) < self.iv_size:
+            raise ValueError(f'{self.name} needs a {self.key_size} byte key and a {self.iv_size} byte IV')
+        self.backend = backend or default_backend
+        self.keystream = Keystream(
+            self.backend.aes_ctr(key[:self.key_size], iv[:self.iv_size]), self.backend.block,
+            lookahead or 4*self.backend.block,
+        )
+        self.frames = dict()
+        self.next = 0
+        self.lock = Lock()
+
+    def reserve(self, sequence: int, size: int):
+        """
+        Fix the keystream of an outbound packet before it is encrypted, packets have to be reserved in order
+        :param sequence: int packet sequence number
+        :param size: int bytes of the packet
+        """
+        with self.lock:
+            self.frames[sequence] = (self.next, size)
+            self.next += size
+
+    def packet_length(self, sequence: int, header) -> int:
+        """
+        Decrypt the packet length from the first block of an inbound packet
+        :param sequence: int packet sequence number
+        :param header: bytes-like first header_size bytes of the packet
+        :return: int packet length
+        """
+        with self.lock:
+            offset = self.frames[sequence][0] if sequence in self.frames else self.next
+            length = int.from_bytes(xor(header[:4], self.keystream.read(offset, 4)), 'big')
+            if length > self.max_packet or (4+length) % self.block_size:
+                raise ValueError(f'packet {sequence} has an invalid length: {length}')
+            self.frames[sequence] = (offset, 4+length)
+            self.next = offset+4+length
+        return length
+
+    def take(self, sequence: int, size: int) -> bytes:
+        with self.lock:
+            if sequence in self.frames:
+                offset, size = self.frames.pop(sequence)
+            else:
+                offset = self.next
+                self.next += size
+            keystream = self.keystream.read(offset, size)
+            self.keystream.release(min((start for start, _ in self.frames.values()), default=self.next))
+        return keystream
+
+    def encrypt(self, sequence: int, data) -> bytes:
+        """
+        :param sequence: int packet sequence number
+        :param data: bytes-like packet
+        :return: bytes
+        """
+        return xor(data, self.take(sequence, len(data)))
+
+    def decrypt(self, sequence: int, frame) -> bytes:
+        """
+        :param sequence: int packet sequence number
+        :param frame: bytes-like packet followed by its MAC, framed with packet_length
+        :return: bytes packet followed by its MAC
+        """
+        keystream = self.take(sequence, len(frame))
+        return xor(frame[:len(keystream)], keystream)+bytes(frame[len(keystream):])
+
+    def prefetch(self) -> bool:
+        """
+        Generate one block of keystream ahead
+        :return: bool False once the lookahead is ready
+        """
+        with self.lock:
+            return self.keystream.prefetch()
+
+    def __repr__(self):
+        return f'{self.__class__.__name__}(backend={self.backend.name}, {self.keystream})'
+
+
+class AES128CTR(CTRCipher):
+    name = 'aes128-ctr'
+    key_size = 16
+
+
+class AES256CTR(CTRCipher):
+    name = 'aes256-ctr'
+    key_size = 32
+
+
+class ChaCha20Poly1305(object):
+    name = 'chacha20-poly1305@openssh.com'
+    key_size = 64
+    iv_size = 0
+    block_size = 8
+    header_size = 4
+    tag_size = 16
+    # the packet length is authenticated but not padded
+    aad_size = 4
+    max_packet = 1 << 18
+
+    def __init__(self, key: bytes, iv: bytes = b'', backend=None):
+        """
+        chacha20-poly1305@openssh.com (OpenSSH PROTOCOL.chacha20poly1305). The packet length is encrypted
+        with the second half of the key, the rest of the packet with the first half and a Poly1305 tag
+        covers both. The sequence number is the nonce, so there is no keystream to keep between packets.
+        :param key: bytes at least 64 bytes
+        :param iv: bytes unused
+        :param backend: backend of ChaCha20 and Poly1305, defaults to the fastest one installed
+        """
+        if len(key) < self.key_size:
+            raise ValueError(f'{self.name} needs a {self.key_size} byte key')
+        self.main_key, self.header_key = key[:32], key[32:64]
+        self.backend = backend or default_backend
+
+    def packet_length(self, sequence: int, header) -> int:
+        length = int.from_bytes(
+            xor(header[:4], self.backend.chacha20(self.header_key, pack('!Q', sequence), 0, 4)), 'big'
+        )
+        if length > self.max_packet or length % self.block_size:
+            raise ValueError(f'packet {sequence} has an invalid length: {length}')
+        return length
+
+    def reserve(self, sequence: int, size: int):
+        pass
+
+    def encrypt(self, sequence: int, data) -> bytes:
+        """
+        :param sequence: int packet sequence number
+        :param data: bytes-like packet
+        :return: bytes encrypted packet followed by its tag
+        """
+        nonce = pack('!Q', sequence)
+        keystream = self.backend.chacha20(self.main_key, nonce, 0, 64+len(data)-4)
+        body = xor(data[:4], self.backend.chacha20(self.header_key, nonce, 0, 4))+xor(data[4:], keystream[64:])
+        return body+self.backend.poly1305(keystream[:32], body)
+
+    def decrypt(self, sequence: int, frame) -> bytes:
+        """
+        :param sequence: int packet sequence number
+        :param frame: bytes-like encrypted packet followed by its tag
+        :return: bytes packet
+        """
+        nonce = pack('!Q', sequence)
+        body, tag = frame[:-self.tag_size], frame[-self.tag_size:]
+        keystream = self.backend.chacha20(self.main_key, nonce, 0, 64+len(body)-4)
+        if not compare_digest(self.backend.poly1305(keystream[:32], body), bytes(tag)):
+            raise ValueError(f'tag of packet {sequence} does not match')
+        return xor(body[:4], self.backend.chacha20(self.header_key, nonce, 0, 4))+xor(body[4:], keystream[64:])
+
+    def prefetch(self) -> bool:
+        return False
+
+    def __repr__(self):
+        return f'{self.__class__.__name__}(backend={self.backend.name})'
+
+
+ciphers = {cipher.name: cipher for cipher in (AES128CTR, AES256CTR, ChaCha20Poly1305)}
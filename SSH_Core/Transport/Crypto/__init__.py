@@ -0,0 +1,146 @@
+from concurrent.futures import ThreadPoolExecutor
+from collections import deque
+from hmac import new as hmac_new, compare_digest
+from os import cpu_count
+from struct import pack
+from threading import Lock
+
+
+class Mac(object):
+    algorithms = {
+        'hmac-sha2-256': 'sha256',
+        'hmac-sha2-512': 'sha512',
+        'hmac-sha1': 'sha1',
+    }
+
+    def __init__(self, name: str, key: bytes):
+        """
+        Message authentication of packets with a negotiated MAC algorithm (RFC 4253 section 6.4)
+        :param name: str algorithm name (IE: hmac-sha2-256)
+        :param key: bytes integrity key
+        """
+        if name not in self.algorithms:
+            raise ValueError(f'unsupported MAC algorithm: {name}')
+        self.name = name
+        self.keyed = hmac_new(key, digestmod=self.algorithms[name])
+        self.size = self.keyed.digest_size
+
+    def compute(self, sequence: int, data: bytes) -> bytes:
+        """
+        :param sequence: int packet sequence number
+        :param data: bytes unencrypted packet
+        :return: bytes MAC
+        """
+        mac = self.keyed.copy()
+        mac.update(pack('!I', sequence))
+        mac.update(data)
+        return mac.digest()
+
+    def sign(self, sequence: int, data: bytes) -> bytes:
+        """
+        Append the MAC to a packet
+        :param sequence: int packet sequence number
+        :param data: bytes packet
+        :return: bytes packet followed by its MAC
+        """
+        return data+self.compute(sequence, data)
+
+    def verify(self, sequence: int, data: bytes) -> bytes:
+        """
+        Check and remove the MAC at the end of a packet
+        :param sequence: int packet sequence number
+        :param data: bytes packet followed by its MAC
+        :return: bytes packet
+        """
+        packet, mac = data[:-self.size], data[-self.size:]
+        if not compare_digest(mac, self.compute(sequence, packet)):
+            raise ValueError(f'MAC of packet {sequence} does not match')
+        return packet
+
+    def __repr__(self):
+        return f'{self.__class__.__name__}(name={self.name})'
+
+
+class CryptoOffload(object):
+    def __init__(self, threshold: int = 16 << 10, workers: int = None, max_pending: int = None):
+        """
+        Run per packet crypto of large packets on a thread pool, hashlib and hmac release the GIL for large buffers.
+        Packets smaller than threshold are processed inline. Results always come back in the order they were submitted.
+        :param threshold: int packet size from which work goes to the pool
+        :param workers: int threads in the pool, defaults to the number of CPUs
+        :param max_pending: int submitted packets that may be waiting, defaults to twice the workers
+        """
+        self.threshold = threshold
+        self.workers = workers or cpu_count() or 1
+        self.max_pending = max_pending or 2*self.workers
+        self.executor = ThreadPoolExecutor(self.workers, thread_name_prefix='ssh-crypto')
+        self.pending = deque()
+        self.lock = Lock()
+
+    def submit(self, function, sequence: int, data: bytes, callback=None):
+        """
+        Queue function(sequence, data), collect the results in order with ready
+        :param function: callable
+        :param sequence: int packet sequence number
+        :param data: bytes
+        :param callback: callable called without arguments when work sent to the pool has finished
+        """
+        with self.lock:
+            if len(data) < self.threshold:
+                self.pending.append((True, function(sequence, data)))
+                return
+            future = self.executor.submit(function, sequence, data)
+            self.pending.append((False, future))
+        if callback is not None:
+            future.add_done_callback(lambda _: callback())
+
+    def ready(self, block: bool = False) -> list:
+        """
+        Remove the results at the front of the queue that are finished
+        :param block: bool wait for every submitted result
+        :return: list of results in submission order
+        """
+        output = list()
+        with self.lock:
+            while self.pending:
+                done, value = self.pending[0]
+                if not done:
+                    if not block and not value.done():
+                        break
+                    value = value.result()
+                self.pending.popleft()
+                output.append(value)
+        return output
+
+    def full(self) -> bool:
+        return len(self.pending) >= self.max_pending
+
+    def wait(self):
+        """
+        Wait until the oldest submitted work has finished
+        """
+        with self.lock:
+            head = self.pending[0][1] if self.pending and not self.pending[0][0] else None
+        if head is not None:
+            head.exception()
+
+    def map(self, function, items):
+        """
+        Run function(sequence, data) for every item, large items are submitted to the pool straight away.
+        An exception is raised when its result is reached, so results before it can still be used.
+        :param function: callable
+        :param items: iterable of (sequence, data) tuples
+        :return: generator of results in order
+        """
+        pending = [
+            self.executor.submit(function, sequence, data) if len(data) >= self.threshold else (sequence, data)
+            for sequence, data in items
+        ]
+        for item in pending:
+            yield function(*item) if isinstance(item, tuple) else item.result()
+
+    def shutdown(self):
+        self.executor.shutdown()
+
+    def __repr__(self):
+        return f'{self.__class__.__name__}(threshold={self.threshold}, workers={self.workers}, pending={len(self.pending)})'
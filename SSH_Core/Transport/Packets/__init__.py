@@ -6,6 +6,11 @@ from random import randint
 from os import urandom
 from struct import unpack
 
+
+# largest packet_len implementations must accept, RFC 4253 section 6.1, larger lengths are rejected
+MAX_PACKET_LENGTH = 35000
+
+
 @dataclass
 class Packet(object):
     packet_len: UInt32
@@ -27,6 +32,28 @@ class Packet(object):
                 output[key], data = data_type.decode(data)
         return cls(**output), data
 
+    @classmethod
+    def create(cls, payload: bytes, block_size: int = 8, aad_size: int = 0):
+        """
+        Wrap a payload in a packet with random padding bytes.
+        Padding is the shortest length of at least 4 bytes that makes the packet a multiple of block_size.
+        :param payload: bytes
+        :param block_size: int cipher block size, at least 8
+        :param aad_size: int leading bytes left out of the padded size, 4 when the cipher authenticates
+            the packet length without padding it (IE: chacha20-poly1305@openssh.com)
+        :return: Packet instance
+        """
+        padding_len = block_size-(len(payload)+5-aad_size) % block_size
+        if padding_len < 4:
+            padding_len += block_size
+        return cls(
+            UInt32(len(payload)+padding_len+1),
+            Byte(padding_len.to_bytes(1, 'big')),
+            Byte(payload),
+            Byte(urandom(padding_len)),
+            Byte(b''),
+        )
+
     def encode(self):
         output = b''
         for data in self.__dict__.values():
@@ -58,6 +85,79 @@ class AlgoNegotiation(object):
             output[key], data = data_cls.decode(data)
         return cls(**output)
 
+    def encode(self):
+        output = b''
+        for data in self.__dict__.values():
+            output = output+data.encode()
+        return output
+
+
+class MessageView(object):
+    """
+    Read only view over an encoded message that decodes each field the first time it is accessed.
+    Subclasses are made with MessageView.of(schema) from a dataclass whose fields can all be skipped,
+    so Packet, where the payload size depends on earlier fields, has no view.
+    """
+    __slots__ = ('data', 'offsets', 'values')
+    schema = None
+    fields = ()
+
+    def __init__(self, data: bytes):
+        """
+        Index the offset of every field in one pass over data
+        :param data: bytes
+        """
+        offsets = [0]
+        offset = 0
+        for _, data_cls in self.fields:
+            offset = data_cls.skip(data, offset)
+            offsets.append(offset)
+        self.data = data
+        self.offsets = offsets
+        self.values = [None]*len(self.fields)
+
+    @classmethod
+    def of(cls, schema):
+        """
+        Create a view class with a cached property for every field of schema
+        :param schema: dataclass with a decode classmethod
+        :return: MessageView subclass
+        """
+        fields = tuple(schema.__annotations__.items())
+        namespace = {'__slots__': (), 'schema': schema, 'fields': fields}
+        for index, (key, _) in enumerate(fields):
+            namespace[key] = property(lambda self, index=index: self.field(index))
+        return type(f'{schema.__name__}View', (cls, ), namespace)
+
+    def field(self, index: int):
+        """
+        Decode the field at index, or return it if it was decoded before
+        :param index: int
+        :return: Datatype or MessageNumber instance
+        """
+        value = self.values[index]
+        if value is None:
+            value, _ = self.fields[index][1].decode(self.data[self.offsets[index]:self.offsets[index+1]])
+            self.values[index] = value
+        return value
+
+    @property
+    def size(self) -> int:
+        return self.offsets[-1]
+
+    def materialize(self):
+        """
+        Decode every remaining field and return an instance of the schema
+        :return: schema instance
+        """
+        return self.schema(**{key: self.field(index) for index, (key, _) in enumerate(self.fields)})
+
+    def encode(self) -> bytes:
+        return self.data[:self.offsets[-1]]
 
+    def __repr__(self):
+        decoded = sum(value is not None for value in self.values)
+        return f'{self.__class__.__name__}(size={self.size}, decoded={decoded}/{len(self.fields)})'
 
 
+AlgoNegotiationView = MessageView.of(AlgoNegotiation)
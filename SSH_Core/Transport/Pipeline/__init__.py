@@ -0,0 +1,363 @@
+from SSH_Core import Byte
+from SSH_Core.Transport.Packets import Packet, MAX_PACKET_LENGTH
+from SSH_Core.Transport.Crypto import Mac
+from SSH_Core.Transport.Cipher import ciphers as cipher_engines
+
+from abc import ABC, abstractmethod
+from threading import Lock
+from time import perf_counter_ns
+from zlib import decompressobj
+
+
+class Stage(ABC):
+    name = None
+
+    def __init__(self):
+        """
+        One step of inbound packet processing, called with the sequence number and data of a packet.
+        Every stage counts its calls, input bytes and time, so it can be measured on its own.
+        """
+        self.calls = 0
+        self.bytes = 0
+        self.ns = 0
+        self.lock = Lock()
+
+    @abstractmethod
+    def process(self, sequence: int, data):
+        """
+        :param sequence: int packet sequence number
+        :param data: output of the previous stage
+        :return: input of the next stage
+        """
+
+    def size(self, data) -> int:
+        return len(data)
+
+    def __call__(self, sequence: int, data):
+        start = perf_counter_ns()
+        output = self.process(sequence, data)
+        duration = perf_counter_ns()-start
+        # crypto stages may run on several threads of a CryptoOffload at once
+        with self.lock:
+            self.calls += 1
+            self.bytes += self.size(data)
+            self.ns += duration
+        return output
+
+    def inherit(self, stage):
+        """
+        Carry over the counters of the stage this one replaces
+        :param stage: Stage or None
+        """
+        if stage is not None:
+            self.calls, self.bytes, self.ns = stage.calls, stage.bytes, stage.ns
+
+    def stats(self) -> dict:
+        return {
+            'calls': self.calls,
+            'bytes': self.bytes,
+            'ns': self.ns,
+            'ns_per_call': self.ns/self.calls if self.calls else 0,
+            'mb_per_second': self.bytes*1_000/self.ns if self.ns else 0,
+        }
+
+    def __repr__(self):
+        return f'{self.__class__.__name__}(calls={self.calls}, bytes={self.bytes})'
+
+
+class Framer(Stage):
+    name = 'framer'
+
+    def __init__(self, max_packet: int = MAX_PACKET_LENGTH):
+        """
+        Cut the received byte stream into frames of packet, MAC and cipher tag, and number them.
+        Frames are memoryviews over the received data, nothing is copied until a frame is decoded.
+        :param max_packet: int largest packet_len accepted, a larger one raises ValueError before its body is read
+        """
+        super().__init__()
+        self.buffer = b''
+        self.sequence = 0
+        self.cipher = None
+        self.mac_len = 0
+        self.max_packet = max_packet
+
+    def feed(self, data: bytes):
+        self.buffer = self.buffer + data
+
+    def process(self, sequence: int, data: bytes) -> list:
+        """
+        Add received data and remove every complete frame, frames are numbered by the framer so sequence is unused
+        :return: list of (sequence, memoryview) tuples
+        """
+        self.feed(data)
+        return self.frames()
+
+    def length(self, data) -> int:
+        """
+        :param data: bytes-like starting at a frame
+        :return: int size of the frame, 0 if more data is needed to tell
+        """
+        if self.cipher is None:
+            if len(data) < 4:
+                return 0
+            length = int.from_bytes(data[:4], 'big')
+        else:
+            if len(data) < self.cipher.header_size:
+                return 0
+            length = self.cipher.packet_length(self.sequence, data[:self.cipher.header_size])
+        if length > self.max_packet:
+            raise ValueError(f'packet {self.sequence} has packet_len {length}, more than {self.max_packet}')
+        return 4+length+self.mac_len
+
+    def needed(self) -> int:
+        """
+        :return: int bytes the buffer has to hold for the next frame to be complete
+        """
+        return self.length(self.buffer) or (self.cipher.header_size if self.cipher is not None else 4)
+
+    def frames(self) -> list:
+        """
+        Remove every complete frame from the buffer
+        :return: list of (sequence, memoryview) tuples
+        """
+        start = perf_counter_ns()
+        output = list()
+        view = memoryview(self.buffer)
+        position = 0
+        while size := self.length(view[position:]):
+            if len(view)-position < size:
+                break
+            output.append((self.sequence, view[position:position+size]))
+            self.sequence = (self.sequence+1) & 0xFFFFFFFF
+            position += size
+        self.buffer = self.buffer[position:]
+        with self.lock:
+            self.calls += len(output)
+            self.bytes += position
+            self.ns += perf_counter_ns()-start
+        return output
+
+    def unread(self, frames: list):
+        """
+        Put frames back at the front of the buffer, to be framed again under new keys
+        :param frames: list of (sequence, memoryview) tuples returned by frames
+        """
+        if frames:
+            self.buffer = b''.join(frame for _, frame in frames)+self.buffer
+            self.sequence = frames[0][0]
+
+
+class Decryptor(Stage):
+    name = 'decrypt'
+
+    def __init__(self, cipher):
+        """
+        :param cipher: object with header_size, tag_size, packet_length(sequence, header) and decrypt(sequence, frame),
+            IE: a cipher of SSH_Core.Transport.Cipher
+        """
+        super().__init__()
+        self.cipher = cipher
+
+    def process(self, sequence: int, data):
+        return self.cipher.decrypt(sequence, data)
+
+
+class Verifier(Stage):
+    name = 'verify'
+
+    def __init__(self, mac: Mac):
+        super().__init__()
+        self.mac = mac
+
+    def process(self, sequence: int, data):
+        return self.mac.verify(sequence, data)
+
+
+class Decoder(Stage):
+    name = 'decode'
+
+    def process(self, sequence: int, data) -> Packet:
+        packet, _ = Packet.decode(bytes(data))
+        return packet
+
+
+class Decompressor(Stage):
+    name = 'decompress'
+    max_payload = 1 << 18
+
+    def __init__(self):
+        """
+        Inflate payloads compressed with zlib (RFC 4253 section 6.2), one stream for the whole connection
+        """
+        super().__init__()
+        self.zlib = decompressobj()
+
+    def size(self, data: Packet) -> int:
+        return len(data.payload.data)
+
+    def process(self, sequence: int, data: Packet) -> Packet:
+        payload = self.zlib.decompress(data.payload.data, self.max_payload)
+        if self.zlib.unconsumed_tail:
+            raise ValueError(f'payload of packet {sequence} inflates to more than {self.max_payload} bytes')
+        data.payload = Byte(payload)
+        return data
+
+
+class Dispatcher(Stage):
+    name = 'dispatch'
+
+    def __init__(self):
+        """
+        Call the handler registered for the message number of a packet
+        """
+        super().__init__()
+        self.handlers = dict()
+
+    def register(self, message: int, handler):
+        """
+        :param message: int message number
+        :param handler: callable called with the Packet
+        """
+        self.handlers[message] = handler
+
+    def size(self, data: Packet) -> int:
+        return len(data.payload.data)
+
+    def process(self, sequence: int, data: Packet) -> Packet:
+        if data.payload.data:
+            handler = self.handlers.get(data.payload.data[0])
+            if handler is not None:
+                handler(data)
+        return data
+
+
+ciphers = {'none': None, **cipher_engines}
+compressions = {'none': None, 'zlib': Decompressor, 'zlib@openssh.com': Decompressor}
+
+
+class InboundPipeline(object):
+    def __init__(self, cipher=None, mac: Mac = None, compression: str = 'none', max_packet: int = MAX_PACKET_LENGTH):
+        """
+        Inbound packet processing as a chain of stages:
+        framer -> decrypt -> verify -> decode -> decompress -> dispatch.
+        Stages that the negotiated algorithms do not need are left out of the chain.
+        The crypto stages only depend on the sequence number and data of a frame, so they can run out of order
+        on a CryptoOffload, everything after them runs in order.
+        :param cipher: cipher for Decryptor, None for no encryption
+        :param mac: Mac, None for no MAC
+        :param compression: str compression algorithm name
+        :param max_packet: int largest packet_len accepted from the peer, at least 35000 (RFC 4253 section 6.1)
+        """
+        self.framer = Framer(max_packet)
+        self.decryptor = None
+        self.verifier = None
+        self.decoder = Decoder()
+        self.decompressor = None
+        self.dispatcher = Dispatcher()
+        self.compression = 'none'
+        self.install(cipher, mac, compression)
+
+    @classmethod
+    def from_algorithms(cls, algorithms: dict, encryption_key: bytes = b'', iv: bytes = b'', integrity_key: bytes = b'',
+                        direction: str = 'client_to_server'):
+        """
+        Build the pipeline for the algorithms chosen by negotiate and the keys derived for them
+        :param algorithms: dict of AlgoNegotiation field to algorithm name
+        :param encryption_key: bytes
+        :param iv: bytes
+        :param integrity_key: bytes
+        :param direction: str 'client_to_server' for data a server receives
+        :return: InboundPipeline
+        """
+        cipher_name = algorithms[f'encryption_algorithms_{direction}']
+        mac_name = algorithms[f'mac_algorithms_{direction}']
+        compression = algorithms[f'compression_algorithms_{direction}']
+        if cipher_name not in ciphers:
+            raise ValueError(f'unsupported cipher: {cipher_name}')
+        if compression not in compressions:
+            raise ValueError(f'unsupported compression: {compression}')
+        cipher = ciphers[cipher_name]
+        cipher = cipher(encryption_key, iv) if cipher is not None else None
+        # an AEAD cipher authenticates packets itself, the negotiated MAC is not used
+        aead = cipher is not None and cipher.tag_size
+        mac = Mac(mac_name, integrity_key) if mac_name != 'none' and not aead else None
+        return cls(cipher, mac, compression)
+
+    def install(self, cipher=None, mac: Mac = None, compression: str = 'none'):
+        """
+        Replace the stages for new keys. Counters carry over to the stages that replace a stage of the same kind,
+        the zlib stream is kept while compression stays the same.
+        """
+        decryptor = Decryptor(cipher) if cipher is not None else None
+        if decryptor is not None:
+            decryptor.inherit(self.decryptor)
+        verifier = Verifier(mac) if mac is not None else None
+        if verifier is not None:
+            verifier.inherit(self.verifier)
+        self.decryptor, self.verifier = decryptor, verifier
+
+        if compression != self.compression:
+            decompressor = compressions[compression]
+            decompressor = decompressor() if decompressor is not None else None
+            if decompressor is not None:
+                decompressor.inherit(self.decompressor)
+            self.decompressor = decompressor
+            self.compression = compression
+
+        self.framer.cipher = cipher
+        self.framer.mac_len = (mac.size if mac is not None else 0)+(cipher.tag_size if cipher is not None else 0)
+        self.crypto = tuple(stage for stage in (self.decryptor, self.verifier) if stage is not None)
+        self.packet = tuple(stage for stage in (self.decoder, self.decompressor) if stage is not None)
+
+    @property
+    def mac(self):
+        return self.verifier.mac if self.verifier is not None else None
+
+    @property
+    def cipher(self):
+        return self.decryptor.cipher if self.decryptor is not None else None
+
+    def open(self, sequence: int, data):
+        """
+        Run the crypto stages on a frame
+        :return: bytes-like packet without MAC
+        """
+        for stage in self.crypto:
+            data = stage(sequence, data)
+        return data
+
+    def decode(self, sequence: int, data) -> Packet:
+        """
+        Run the stages from the decoder up to the dispatcher on an opened frame
+        """
+        for stage in self.packet:
+            data = stage(sequence, data)
+        return data
+
+    def dispatch(self, sequence: int, packet: Packet) -> Packet:
+        return self.dispatcher(sequence, packet)
+
+    def run(self, data: bytes) -> list:
+        """
+        Feed data and take every complete packet through the whole chain, in order
+        :param data: bytes
+        :return: list of Packet
+        """
+        self.framer.feed(data)
+        return [
+            self.dispatch(sequence, self.decode(sequence, self.open(sequence, frame)))
+            for sequence, frame in self.framer.frames()
+        ]
+
+    @property
+    def stages(self) -> tuple:
+        return (self.framer, ) + self.crypto + self.packet + (self.dispatcher, )
+
+    def stats(self) -> dict:
+        """
+        :return: dict of stage name to its counters
+        """
+        return {stage.name: stage.stats() for stage in self.stages}
+
+    def __repr__(self):
+        return f'{self.__class__.__name__}({" -> ".join(stage.name for stage in self.stages)})'
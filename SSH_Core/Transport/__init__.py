@@ -1,35 +1,556 @@
 from socket import socket
 from .Packets import *
+from SSH_Core.Numbers import TransportMessage
+from SSH_Core.Tracing import NULL_TRACER
+from SSH_Core.Metrics import REGISTRY
+from .Pipeline import InboundPipeline
+
+from select import select
+from time import perf_counter_ns, monotonic
+from threading import Lock, RLock, Event, Thread
+from collections import deque
+
+
+negotiated_algorithms = (
+    'kex_algorithms',
+    'server_host_key_algorithms',
+    'encryption_algorithms_client_to_server',
+    'encryption_algorithms_server_to_client',
+    'mac_algorithms_client_to_server',
+    'mac_algorithms_server_to_client',
+    'compression_algorithms_client_to_server',
+    'compression_algorithms_server_to_client',
+)
+
+
+def negotiate(client, server) -> dict:
+    """
+    Pick the first algorithm of every client list that the server also supports (RFC 4253 section 7.1)
+    :param client: AlgoNegotiation or AlgoNegotiationView sent by the client
+    :param server: AlgoNegotiation or AlgoNegotiationView sent by the server
+    :return: dict of AlgoNegotiation field to the chosen algorithm name
+    """
+    output = dict()
+    for key in negotiated_algorithms:
+        supported = set(getattr(server, key).data)
+        for name in getattr(client, key).data:
+            if name in supported:
+                output[key] = name
+                break
+        else:
+            raise ValueError(f'no matching algorithm for {key}')
+    return output
+
+
+def guessed_right(client, server) -> bool:
+    """
+    A first kex packet guess is right when both sides prefer the same kex and host key algorithm
+    :param client: AlgoNegotiation or AlgoNegotiationView sent by the client
+    :param server: AlgoNegotiation or AlgoNegotiationView sent by the server
+    :return: bool
+    """
+    for key in ('kex_algorithms', 'server_host_key_algorithms'):
+        client_names, server_names = getattr(client, key).data, getattr(server, key).data
+        if not client_names or not server_names or client_names[0] != server_names[0]:
+            return False
+    return True
+
+
+def kex_allowed(message: int) -> bool:
+    """
+    Messages that may be sent while a key exchange is in progress (RFC 4253 section 7.1)
+    :param message: int message number
+    :return: bool
+    """
+    return 1 <= message <= 49 and message not in (5, 6)
+
+
+class RekeyScheduler(object):
+    def __init__(self, bytes_limit: int = 1 << 30, packets_limit: int = 1 << 31, seconds_limit: float = 3600,
+                 queue_limit: int = 256 << 10):
+        """
+        Decide when keys have been used long enough to start a new key exchange (RFC 4253 section 9)
+        :param bytes_limit: int bytes sent and received since the last exchange
+        :param packets_limit: int packets sent and received since the last exchange
+        :param seconds_limit: float seconds since the last exchange
+        :param queue_limit: int payload bytes that may be queued while an exchange is in progress.
+            It only has to cover one round trip of the exchange, a bigger queue turns into a burst when it is flushed.
+        """
+        self.bytes_limit = bytes_limit
+        self.packets_limit = packets_limit
+        self.seconds_limit = seconds_limit
+        self.queue_limit = queue_limit
+        # packets are counted by the reader, the producers and the offload pool threads
+        self.lock = Lock()
+        self.reset()
+
+    def reset(self):
+        with self.lock:
+            self.bytes = 0
+            self.packets = 0
+            self.started = monotonic()
+
+    def count(self, size: int):
+        with self.lock:
+            self.bytes += size
+            self.packets += 1
+
+    def due(self) -> bool:
+        return self.bytes >= self.bytes_limit or self.packets >= self.packets_limit or \
+            monotonic()-self.started >= self.seconds_limit
+
+    def __repr__(self):
+        return f'{self.__class__.__name__}(bytes={self.bytes}/{self.bytes_limit}, ' \
+               f'packets={self.packets}/{self.packets_limit})'
+
+
+class VersionReader(object):
+    max_line = 255
+    max_banner = 8192
+
+    def __init__(self):
+        """
+        Parse the identification string of the peer from data as it arrives.
+        Lines before the one starting with SSH- are kept as the banner (RFC 4253 section 4.2),
+        bytes after it are kept as leftover for the packet framer.
+        """
+        self.data = b''
+        self.banner = list()
+        self.banner_size = 0
+        self.version = None
+        self.leftover = b''
+
+    def feed(self, data: bytes):
+        """
+        Add received data
+        :param data: bytes
+        :return: str identification string without CR LF once it is complete, otherwise None
+        """
+        if self.version is not None:
+            self.leftover = self.leftover + data
+            return self.version
+        self.data = self.data + data
+        while self.version is None:
+            end = self.data.find(b'\n')
+            if end == -1:
+                if len(self.data) > self.max_line:
+                    raise ValueError(f'identification line longer than {self.max_line} bytes')
+                return None
+            line, self.data = self.data[:end+1], self.data[end+1:]
+            if len(line) > self.max_line:
+                raise ValueError(f'identification line longer than {self.max_line} bytes')
+            line = line.rstrip(b'\r\n').decode(errors='replace')
+            if line.startswith('SSH-'):
+                if not line.startswith(('SSH-2.0-', 'SSH-1.99-')):
+                    raise ValueError(f'unsupported protocol version: {line}')
+                self.version, self.leftover, self.data = line, self.data, b''
+            else:
+                self.banner.append(line)
+                self.banner_size += end+1
+                if self.banner_size > self.max_banner:
+                    raise ValueError(f'more than {self.max_banner} bytes before the identification line')
+        return self.version
+
+    def __repr__(self):
+        return f'{self.__class__.__name__}(version={self.version}, banner={len(self.banner)} lines)'
 
 
 class TransportHandler(object):
-    def __init__(self, server: socket, client: socket):
+    def __init__(self, server: socket, client: socket, tracer=None, registry=None, recorder=None, rekey=None,
+                 offload=None, accounting=None):
 
         self.server = server
+        if recorder is not None:
+            # Recording imports Packets from this package, so import it only when it is used
+            from SSH_Core.Recording import RecordingSocket
+            client = RecordingSocket(client, recorder)
         self.client = client
+        self.tracer = tracer or NULL_TRACER
+        self.registry = registry or REGISTRY
+        self.metrics = self.registry.connection()
+        self.rekey = rekey
+        self.offload = offload
+
+        self.send_sequence = 0
+        self.outbound_mac = None
+        self.outbound_cipher = None
+        self.receive_sequence = None
+        self.pipeline = InboundPipeline()
+        self.received = deque()
 
-        self.get_client_version()
+        self.algorithms = None
+        self.kex_in_progress = False
+        self.discard_guess = False
+        self.queue = deque()
+        self.queued_bytes = 0
+        self.send_lock = RLock()
+        self.write_lock = Lock()
+        self.keys_ready = Event()
+        self.keys_ready.set()
+        # packets sealed on the crypto offload are written by this thread, pool threads never block on the socket
+        self.writer = None
+        self.sealed = Event()
+        self.closing = False
 
-        self.buffer = b''
+        self.accounting = accounting
+        self.memory = None
+        if accounting is not None:
+            self.memory = accounting.connection(self.metrics.name)
+            self.memory.track('transport', 'receive_buffer', lambda: len(self.pipeline.framer.buffer))
+            self.memory.track('transport', 'received', self.received_bytes)
+            self.memory.track('transport', 'send_queue', lambda: self.queued_bytes)
 
+        try:
+            self.send_version()
+            self.get_client_version()
+        except BaseException:
+            self.close()
+            raise
+
+    def send_version(self):
+        """
+        Write the identification string, KEXINIT and any guessed first kex packet in a single write,
+        without waiting for the client.
+        """
+        preferred = self.server.algorithms['kex_algorithms'][0]
+        self.server_guess_packet = self.server.first_kex_packet(preferred)
+        self.server_protocols = self.server.kexinit(self.server_guess_packet is not None)
+
+        data = self.server.version_exchange.encode()+self.encode_packet(self.create_packet(self.server_protocols.encode()))
+        if self.server_guess_packet is not None:
+            data = data+self.encode_packet(self.create_packet(self.server_guess_packet))
+        with self.tracer.phase('send_version'):
+            self.client.sendall(data)
 
     def get_client_version(self):
-        # TODO: handle preamble comments
-        self.client_version = self.client.recv(255).decode()
-        self.client.send(self.server.version_exchange.encode())
+        """
+        Read the client identification string, skipping any lines before it.
+        Bytes the client sent after it are kept for get_packet.
+        """
+        reader = VersionReader()
+        with self.tracer.phase('version_exchange'):
+            while reader.version is None:
+                data = self.client.recv(4096)
+                if not data:
+                    raise ConnectionError('connection closed by client')
+                reader.feed(data)
+        self.client_version = reader.version
+        self.client_banner = reader.banner
+        self.pipeline.framer.feed(reader.leftover)
+
+    def read_packet(self):
+        if not self.received:
+            self.receive_packets()
+        self.receive_sequence, packet = self.received.popleft()
+        return packet
+
+    def receive_packets(self):
+        """
+        Frame every complete packet in the buffer, reading until there is at least one, and take them through
+        the crypto stages of the inbound pipeline, on the crypto offload when there is one.
+        Packets after SSH_MSG_NEWKEYS are protected by the new keys, so they are put back to be framed again.
+        """
+        framer = self.pipeline.framer
+        while len(framer.buffer) < (needed := framer.needed()):
+            self.prefetch()
+            data = self.client.recv(max(2048, needed-len(framer.buffer)))
+            if not data:
+                raise ConnectionError('connection closed by client')
+            framer.feed(data)
+
+        frames = framer.frames()
+        if self.offload is not None and self.pipeline.crypto:
+            packets = self.offload.map(self.pipeline.open, frames)
+        else:
+            packets = (self.pipeline.open(*frame) for frame in frames)
+
+        newkeys = TransportMessage.SSH_MSG_NEWKEYS.encode()
+        for index, data in enumerate(packets):
+            sequence, frame = frames[index]
+            with self.tracer.phase('packet_decode'):
+                start = perf_counter_ns()
+                packet = self.pipeline.decode(sequence, data)
+                duration = perf_counter_ns()-start
+            message = packet.payload.data[0] if packet.payload.data else 0
+            self.metrics.packet_in(len(frame), message, duration)
+            if self.rekey is not None:
+                self.rekey.count(len(frame))
+            self.received.append((sequence, packet))
+            if packet.payload.data[:1] == newkeys:
+                framer.unread(frames[index+1:])
+                break
+        self.metrics.receive_buffer = len(framer.buffer)
+
+    def received_bytes(self) -> int:
+        """
+        :return: int payload bytes of packets that have been decoded but not read yet
+        """
+        return sum(len(packet.payload.data) for _, packet in list(self.received))
+
+    def prefetch(self):
+        """
+        Generate keystream of the ciphers ahead, a block at a time for as long as nothing arrives from the client
+        """
+        ciphers = [cipher for cipher in (self.outbound_cipher, self.pipeline.cipher) if cipher is not None]
+        while ciphers and not select((self.client, ), (), (), 0)[0]:
+            ciphers = [cipher for cipher in ciphers if cipher.prefetch()]
 
     def get_packet(self):
-        data = self.buffer + self.client.recv(2048)
-        packet, self.buffer = Packet.decode(data)
+        """
+        Return the next packet from the client.
+        After the first exchange, SSH_MSG_KEXINIT and SSH_MSG_NEWKEYS drive a key re-exchange before being returned.
+        """
+        packet = self.read_packet()
+        if self.discard_guess:
+            self.discard_guess = False
+            with self.tracer.phase('discard_kex_guess'):
+                packet = self.read_packet()
+
+        self.pipeline.dispatch(self.receive_sequence, packet)
+        if self.rekey is not None and not self.kex_in_progress and self.rekey.due():
+            self.start_rekey()
         return packet
 
+    def create_packet(self, payload: bytes) -> Packet:
+        """
+        Wrap a payload in a packet padded for the outbound cipher
+        :param payload: bytes
+        :return: Packet
+        """
+        cipher = self.outbound_cipher
+        if cipher is None:
+            return Packet.create(payload)
+        return Packet.create(payload, cipher.block_size, cipher.aad_size)
+
+    def encode_packet(self, packet: Packet, sign: bool = True) -> bytes:
+        """
+        Encode a packet and give it the next sequence number.
+        A packet that is not padded for the outbound cipher, IE: queued before NEWKEYS, is padded again.
+        :param packet: Packet
+        :param sign: bool encrypt and append the MAC, pass False when seal runs on the crypto offload
+        :return: bytes
+        """
+        start = perf_counter_ns()
+        cipher = self.outbound_cipher
+        if cipher is not None and (packet.packet_len.data+4-cipher.aad_size) % cipher.block_size:
+            packet = self.create_packet(packet.payload.data)
+        data = packet.encode()
+        if cipher is not None:
+            if not sign:
+                cipher.reserve(self.send_sequence, len(data))
+        if sign:
+            data = self.seal(self.send_sequence, data)
+        duration = perf_counter_ns()-start
+        self.send_sequence = (self.send_sequence+1) & 0xFFFFFFFF
+        message = packet.payload.data[0] if packet.payload.data else 0
+        self.metrics.packet_out(len(data), message, duration)
+        return data
+
+    def seal(self, sequence: int, data: bytes) -> bytes:
+        """
+        Encrypt an encoded packet and append its MAC, computed over the unencrypted packet
+        :param sequence: int packet sequence number
+        :param data: bytes
+        :return: bytes
+        """
+        mac = self.outbound_mac.compute(sequence, data) if self.outbound_mac is not None else b''
+        if self.outbound_cipher is not None:
+            data = self.outbound_cipher.encrypt(sequence, data)
+        return data+mac
+
     def send_packet(self, packet: Packet):
-        print(packet.encode())
-        self.client.send(packet.encode())
+        """
+        Send a packet to the client.
+        While a key exchange is in progress packets that are not allowed during it are queued in order
+        and sent once it completes. BufferError is raised when the queue is over the limit of the RekeyScheduler,
+        producers can then wait on keys_ready before sending again.
+        """
+        with self.send_lock:
+            message = packet.payload.data[0] if packet.payload.data else 0
+            if self.kex_in_progress and not kex_allowed(message):
+                size = len(packet.payload.data)
+                if self.rekey is not None and self.queued_bytes+size > self.rekey.queue_limit:
+                    raise BufferError(f'{self.queued_bytes} bytes queued while keys are exchanged')
+                self.queue.append(packet)
+                self.queued_bytes += size
+                self.metrics.queue_depth = len(self.queue)
+                return
+
+            self.write_packets((packet, ))
+            if self.rekey is not None and not self.kex_in_progress and self.rekey.due():
+                self.start_rekey()
+
+    def write_packets(self, packets):
+        """
+        Encode and send packets in order. Without a crypto offload they go out in a single write,
+        with one large packets are encrypted and their MACs computed on its pool, packets are written as they complete.
+        :param packets: iterable of Packet
+        """
+        with self.send_lock:
+            if self.offload is None or (self.outbound_mac is None and self.outbound_cipher is None):
+                data = b''.join(self.encode_packet(packet) for packet in packets)
+                if data:
+                    self.write(data)
+                return
+            if self.writer is None:
+                self.writer = Thread(target=self.write_sealed, name=f'ssh-writer:{self.metrics.name}', daemon=True)
+                self.writer.start()
+            for packet in packets:
+                sequence = self.send_sequence
+                data = self.encode_packet(packet, sign=False)
+                self.offload.submit(self.seal, sequence, data, self.offload_done)
+                if self.offload.full():
+                    self.offload.wait()
+                self.flush()
+
+    def flush(self, block: bool = False):
+        """
+        Write the packets at the front of the crypto offload that are finished.
+        The writer thread calls it when the pool finishes a packet, so it must not wait on the pool
+        while holding write_lock.
+        :param block: bool wait for every packet that has been submitted
+        """
+        if self.offload is None:
+            return
+        while True:
+            with self.write_lock:
+                data = b''.join(self.offload.ready())
+                if data:
+                    self.write(data)
+            if not block or not self.offload.pending:
+                return
+            self.offload.wait()
+
+    def offload_done(self):
+        """
+        Called on a pool thread when a packet is sealed. The same pool opens inbound packets, so a pool thread
+        blocked on a full socket could starve the reader and stall both ends, the writer thread writes instead.
+        """
+        self.sealed.set()
+
+    def write_sealed(self):
+        while True:
+            self.sealed.wait()
+            self.sealed.clear()
+            if self.closing:
+                return
+            try:
+                self.flush()
+            except OSError:
+                # the connection is gone, the next send_packet raises it to the producer
+                return
+
+    def write(self, data: bytes):
+        with self.tracer.phase('packet_send'):
+            self.client.sendall(data)
+        if self.rekey is not None:
+            self.rekey.count(len(data))
+
+    def set_mac(self, outbound=None, inbound=None):
+        """
+        Protect the packets sent and received from now on with MACs.
+        The next packets have to be sent and received with the matching sequence numbers.
+        :param outbound: Mac for packets sent to the client
+        :param inbound: Mac for packets received from the client
+        """
+        with self.send_lock:
+            self.flush(block=True)
+            self.outbound_mac = outbound
+        self.pipeline.install(self.pipeline.cipher, inbound, self.pipeline.compression)
+
+    def set_cipher(self, outbound=None, inbound=None):
+        """
+        Encrypt the packets sent and received from now on, IE: with a cipher of SSH_Core.Transport.Cipher.
+        With an AEAD cipher like chacha20-poly1305@openssh.com the MAC of that direction has to be None.
+        :param outbound: cipher for packets sent to the client
+        :param inbound: cipher for packets received from the client
+        """
+        with self.send_lock:
+            self.flush(block=True)
+            self.outbound_cipher = outbound
+        self.pipeline.install(inbound, self.pipeline.mac, self.pipeline.compression)
 
     def exchange_protocols(self):
-        # TODO: Send server acceptable protocols
-        self.client_protocols = self.client.recv(2048)
+        """
+        Receive the SSH_MSG_KEXINIT of the client, the server sent its own with the identification string,
+        and negotiate algorithms.
+        """
+        with self.tracer.phase('kexinit'):
+            self.receive_kexinit(self.read_packet())
+        self.pipeline.dispatcher.register(TransportMessage.SSH_MSG_KEXINIT.value, self.receive_kexinit)
+        self.pipeline.dispatcher.register(TransportMessage.SSH_MSG_NEWKEYS.value, lambda packet: self.finish_rekey())
+
+    def receive_kexinit(self, packet: Packet):
+        """
+        Negotiate algorithms with a SSH_MSG_KEXINIT from the client.
+        When the client sends a guessed first kex packet it is kept for the key exchange if the guess was
+        right and discarded otherwise. The server sends its own guess right after its KEXINIT when
+        Server.first_kex_packet returns one for its preferred kex algorithm.
+        A KEXINIT after the first exchange starts a re-exchange, answered with our KEXINIT if the client started it.
+        """
+        rekey = self.algorithms is not None
+        if rekey and not self.kex_in_progress:
+            self.start_rekey()
+
+        self.client_protocols = AlgoNegotiationView(packet.payload.data)
+        self.algorithms = negotiate(self.client_protocols, self.server_protocols)
+
+        right = guessed_right(self.client_protocols, self.server_protocols)
+        # the client ignores a wrong guess from the server, so kex has to start over from its side
+        self.server_guess = None if self.server_guess_packet is None else right
+        self.client_guess = None
+        if self.client_protocols.first_kex_packet_follows.data:
+            self.client_guess = right
+            self.discard_guess = not right
+
+        if rekey:
+            # no key exchange method is implemented yet, the current keys stay in use
+            self.send_packet(self.create_packet(TransportMessage.SSH_MSG_NEWKEYS.encode()))
+
+    def start_rekey(self):
+        """
+        Send a new SSH_MSG_KEXINIT. Packets sent until the client answers with SSH_MSG_NEWKEYS are queued.
+        """
+        with self.send_lock:
+            self.kex_in_progress = True
+            self.keys_ready.clear()
+            self.server_guess_packet = None
+            self.server_protocols = self.server.kexinit()
+            self.rekey_started = perf_counter_ns()
+            self.send_packet(self.create_packet(self.server_protocols.encode()))
+
+    def finish_rekey(self):
+        """
+        Complete a key re-exchange and flush the queued packets in the order they were sent
+        """
+        with self.send_lock:
+            if not self.kex_in_progress:
+                return
+            self.kex_in_progress = False
+            if self.rekey is not None:
+                self.rekey.reset()
+            self.metrics.rekeys += 1
+            self.tracer.record('rekey', self.rekey_started, perf_counter_ns())
+
+            queue, self.queue = self.queue, deque()
+            self.queued_bytes = 0
+            self.metrics.queue_depth = 0
+            self.write_packets(queue)
+            self.keys_ready.set()
+
+    def close(self):
+        try:
+            self.flush(block=True)
+        except OSError:
+            pass
+        if self.writer is not None:
+            self.closing = True
+            self.sealed.set()
+            self.writer.join()
+        self.registry.close(self.metrics)
+        if self.memory is not None:
+            self.accounting.close(self.memory)
+        self.client.close()
 
     def __repr__(self):
         out = f'Client Version: {self.client_version}'
@@ -1,15 +1,94 @@
 from struct import pack, unpack, error
-from typing import Any
+from array import array
+from sys import byteorder
+from operator import attrgetter
+from functools import lru_cache
+
+try:
+    import numpy
+except ImportError:
+    numpy = None
 
 # TODO: add unit tests for math operations
 
 
+def _typecode(size: int) -> str:
+    for typecode in 'BHILQ':
+        if array(typecode).itemsize == size:
+            return typecode
+    raise error(f'no array typecode with {size} bytes')
+
+
+_typecodes = {size: _typecode(size) for size in (4, 8)}
+
+
+def _decode_many(data: bytes, count: int, size: int, typecode: str):
+    """
+    Unpack count big endian unsigned integers of size bytes in a single call
+    :param data: bytes
+    :param count: int, None to unpack as many whole values as data holds
+    :param size: int bytes per value
+    :param typecode: str array typecode with an itemsize of size
+    :return: list of int, remaining bytes
+    """
+    if count is None:
+        count = len(data)//size
+    elif type(count) is not int:
+        raise TypeError(f'count is not int, is {type(count)}')
+    elif count < 0:
+        raise ValueError(f'count is less than 0: {count}')
+    end = count*size
+    if end > len(data):
+        raise error(f'{count} values need {end} bytes, data is {len(data)} bytes')
+    if numpy is not None:
+        values = numpy.frombuffer(data, f'>u{size}', count).tolist()
+    else:
+        values = array(typecode)
+        values.frombytes(data[:end])
+        if byteorder == 'little':
+            values.byteswap()
+        values = values.tolist()
+    return values, data[end:]
+
+
+def _encode_many(values, size: int, typecode: str) -> bytes:
+    """
+    Pack a sequence of unsigned integers as big endian values of size bytes in a single call.
+    Values are checked like the scalar codecs check them, only int, not bool or float, from 0 to size*8 bits.
+    :param values: sequence of int or a NumPy integer array
+    :param size: int bytes per value
+    :param typecode: str array typecode with an itemsize of size
+    :return: bytes
+    """
+    if numpy is not None and isinstance(values, numpy.ndarray):
+        if values.dtype.kind not in 'ui':
+            raise TypeError(f'values are not integers, are {values.dtype}')
+        if values.size and (values.min() < 0 or int(values.max()).bit_length() > size*8):
+            raise ValueError(f'values do not fit in {size*8} bits')
+        return values.astype(f'>u{size}').tobytes()
+    if type(values) is not list and type(values) is not tuple:
+        values = list(values)
+    # array takes anything with __index__, IE: bool, the scalar codecs only take int
+    types = list(map(type, values))
+    if types.count(int) != len(types):
+        raise TypeError(f'values are not all int, found {next(value for value in types if value is not int)}')
+    try:
+        packed = array(typecode, values)
+    except OverflowError as exc:
+        raise ValueError(f'values do not fit in {size*8} bits: {exc}')
+    if byteorder == 'little':
+        packed.byteswap()
+    return packed.tobytes()
+
+
 class Datatype(object):
     """
-    Base class representation of a datatype used by ssh protocol
+    Base class representation of a datatype used by ssh protocol.
+    Values are immutable, data is a read only view of the value set by the constructor.
     """
+    __slots__ = ('_data', '_hash')
 
-    data: Any
+    data = property(attrgetter('_data'), doc='natural value, IE: int for UInt32 and a tuple of str for NameList')
 
     def encode(self) -> bytes:
         """
@@ -27,6 +106,17 @@ class Datatype(object):
         """
         pass
 
+    @classmethod
+    def skip(cls, data: bytes, offset: int = 0) -> int:
+        """
+        Find where a value starting at offset ends without keeping the decoded value
+        :param data: bytes
+        :param offset: int
+        :return: int offset of the first byte after the value
+        """
+        _, remaining = cls.decode(data[offset:])
+        return len(data)-len(remaining)
+
     def hex(self) -> str:
         """
         Return hex representation of the data in a string
@@ -40,7 +130,7 @@ class Datatype(object):
         Return a string representation of the data
         :return: "Dataclass(data=self.data, len=self.size)"
         """
-        out = f'{self.__class__.__name__}(data={self.data})'
+        out = f'{self.__class__.__name__}(data={self._data})'
         return out
 
     def __int__(self):
@@ -53,13 +143,29 @@ class Datatype(object):
         return int(self)+int(other)
 
     def __eq__(self, other):
-        return int(self) == int(other)
+        """
+        Compare by type and natural value without encoding either side
+        :return: bool, NotImplemented for objects that are not a Datatype
+        """
+        if isinstance(other, Datatype):
+            return type(self) is type(other) and self._data == other._data
+        return NotImplemented
 
     def __hash__(self):
-        return int(self)
+        """
+        Hash of the type and natural value, computed on first use and cached
+        :return: int
+        """
+        try:
+            return self._hash
+        except AttributeError:
+            value = self._hash = hash((self.__class__, self._data))
+            return value
 
 
 class Byte(Datatype):
+    __slots__ = ()
+
     def __init__(self, data: bytes):
         """
         Create a Byte representation for ssh protocol.
@@ -67,7 +173,7 @@ class Byte(Datatype):
         :param data: bytes Required
         """
         if type(data) is bytes:
-            self.data = data
+            self._data = data
         else:
             raise TypeError(f'data is not bytes, is {type(data)}')
 
@@ -89,25 +195,51 @@ class Byte(Datatype):
         else:
             raise TypeError(f'type of data is not bytes, is {type(data)}')
 
+    @classmethod
+    def skip(cls, data: bytes, offset: int = 0, size: int = 1) -> int:
+        """
+        Find where size bytes starting at offset end without copying them
+        :param data: bytes
+        :param offset: int
+        :param size: int, -1 to consume the rest of data
+        :return: int offset of the first byte after the value
+        """
+        if size == -1:
+            return len(data)
+        if offset+size > len(data):
+            raise error(f'Byte needs {size} bytes at offset {offset}, data is {len(data)} bytes')
+        return offset+size
+
     def encode(self) -> bytes:
         """
         Encode the data into a bytes object for transmission
         :return: bytes
         """
-        if type(self.data) is bytes:
-            return pack(f'!{len(self.data)}s', self.data)
-        raise error(f'data is not bytes, is {type(self.data)}')
+        if type(self._data) is bytes:
+            return pack(f'!{len(self._data)}s', self._data)
+        raise error(f'data is not bytes, is {type(self._data)}')
 
     @classmethod
+    @lru_cache(maxsize=None)
     def __class_getitem__(cls, size):
+        # one class per size, values compare equal only when their types are the same
         class SizedByte(cls):
+            __slots__ = ()
+
             @classmethod
             def decode(sub_cls, data: bytes):
                 return cls.decode(data, size)
 
+            @classmethod
+            def skip(sub_cls, data: bytes, offset: int = 0):
+                return cls.skip(data, offset, size)
+
         return SizedByte
 
+
 class Boolean(Datatype):
+    __slots__ = ()
+
     def __init__(self, data: bool):
         """
         Create a Boolean representation for ssh protocol.
@@ -115,7 +247,7 @@ class Boolean(Datatype):
         :param data: bool Required
         """
         if type(data) is bool:
-            self.data = data
+            self._data = data
         else:
             raise TypeError(f'data is not bool, is {type(data)}')
 
@@ -129,18 +261,32 @@ class Boolean(Datatype):
         bool_data = unpack('!?', data[0:1])
         return cls(*bool_data), data[1:]
 
+    @classmethod
+    def skip(cls, data: bytes, offset: int = 0) -> int:
+        """
+        Find where a Boolean starting at offset ends without decoding it
+        :param data: bytes
+        :param offset: int
+        :return: int offset of the first byte after the value
+        """
+        if offset+1 > len(data):
+            raise error(f'Boolean needs 1 bytes at offset {offset}, data is {len(data)} bytes')
+        return offset+1
+
     def encode(self) -> bytes:
         """
         Encode the data into a bytes object for transmission
         Booleans can only ever be encoded as b'\x00' or b'\x01' for False an True respectively.
         :return: bytes
         """
-        if type(self.data) is bool:
-            return b'\x01' if self.data else b'\x00'
-        raise error(f'data is not bool, is {type(self.data)}')
+        if type(self._data) is bool:
+            return b'\x01' if self._data else b'\x00'
+        raise error(f'data is not bool, is {type(self._data)}')
 
 
 class UInt32(Datatype):
+    __slots__ = ()
+
     def __init__(self, data: int):
         """
         Create a UInt32 representation for ssh protocol.
@@ -152,7 +298,7 @@ class UInt32(Datatype):
                 raise ValueError(f'data is less than 0: {data}')
             if data.bit_length() > 32:
                 raise ValueError(f'data is more than 32 bits: {data} Bits: {data.bit_length()}')
-            self.data = data
+            self._data = data
         else:
             raise TypeError(f'data is not int, is {type(data)}')
 
@@ -167,21 +313,55 @@ class UInt32(Datatype):
         uint_data = unpack('!I', data[:4])
         return cls(*uint_data), data[4:]
 
+    @classmethod
+    def skip(cls, data: bytes, offset: int = 0) -> int:
+        """
+        Find where a UInt32 starting at offset ends without decoding it
+        :param data: bytes
+        :param offset: int
+        :return: int offset of the first byte after the value
+        """
+        if offset+4 > len(data):
+            raise error(f'UInt32 needs 4 bytes at offset {offset}, data is {len(data)} bytes')
+        return offset+4
+
+    @classmethod
+    def decode_many(cls, data: bytes, count: int = None):
+        """
+        unpack count UInt32 values at once as int objects without creating UInt32 instances
+        Uses NumPy when it is installed, otherwise array with byteswap.
+        :param data: bytes
+        :param count: int, None to unpack as many whole values as data holds
+        :return: list of int, remaining bytes
+        """
+        return _decode_many(data, count, 4, _typecodes[4])
+
+    @classmethod
+    def encode_many(cls, values) -> bytes:
+        """
+        Encode a sequence of ints as UInt32 values in a single call
+        :param values: sequence of int or a NumPy integer array, each at most 32 bits
+        :return: bytes
+        """
+        return _encode_many(values, 4, _typecodes[4])
+
     def encode(self) -> bytes:
         """
         Encode the data into a bytes object for transmission
         :return: bytes
         """
-        if type(self.data) is int:
-            return pack('!I', self.data)
+        if type(self._data) is int:
+            return pack('!I', self._data)
         else:
-            raise error(f'data is not int, is {type(self.data)}')
+            raise error(f'data is not int, is {type(self._data)}')
 
     def __int__(self):
-        return self.data
+        return self._data
 
 
 class UInt64(Datatype):
+    __slots__ = ()
+
     def __init__(self, data: int):
         """
         Create a UInt64 representation for ssh protocol.
@@ -193,7 +373,7 @@ class UInt64(Datatype):
                 raise ValueError(f'data is less than 0: {data}')
             if data.bit_length() > 64:
                 raise ValueError(f'data is more than 64 bits: {data} Bits: {data.bit_length()}')
-            self.data = data
+            self._data = data
         else:
             raise TypeError(f'data is not int, is {type(data)}')
 
@@ -208,21 +388,55 @@ class UInt64(Datatype):
         uint_data = unpack('!Q', data[:8])
         return cls(*uint_data), data[8:]
 
+    @classmethod
+    def skip(cls, data: bytes, offset: int = 0) -> int:
+        """
+        Find where a UInt64 starting at offset ends without decoding it
+        :param data: bytes
+        :param offset: int
+        :return: int offset of the first byte after the value
+        """
+        if offset+8 > len(data):
+            raise error(f'UInt64 needs 8 bytes at offset {offset}, data is {len(data)} bytes')
+        return offset+8
+
+    @classmethod
+    def decode_many(cls, data: bytes, count: int = None):
+        """
+        unpack count UInt64 values at once as int objects without creating UInt64 instances
+        Uses NumPy when it is installed, otherwise array with byteswap.
+        :param data: bytes
+        :param count: int, None to unpack as many whole values as data holds
+        :return: list of int, remaining bytes
+        """
+        return _decode_many(data, count, 8, _typecodes[8])
+
+    @classmethod
+    def encode_many(cls, values) -> bytes:
+        """
+        Encode a sequence of ints as UInt64 values in a single call
+        :param values: sequence of int or a NumPy integer array, each at most 64 bits
+        :return: bytes
+        """
+        return _encode_many(values, 8, _typecodes[8])
+
     def encode(self) -> bytes:
         """
         Encode the data into a bytes object for transmission
         :return: bytes
         """
-        if type(self.data) is int:
-            return pack('!Q', self.data)
+        if type(self._data) is int:
+            return pack('!Q', self._data)
         else:
-            raise error(f'data is not int, is {type(self.data)}')
+            raise error(f'data is not int, is {type(self._data)}')
 
     def __int__(self):
-        return self.data
+        return self._data
 
 
 class String(Datatype):
+    __slots__ = ()
+
     def __init__(self, data: str):
         """
         Create a String representation for ssh protocol.
@@ -230,7 +444,7 @@ class String(Datatype):
         :param data: str Required
         """
         if type(data) is str:
-            self.data = data
+            self._data = data
         else:
             raise TypeError(f'data is not str, is {type(data)}')
 
@@ -248,18 +462,33 @@ class String(Datatype):
         string_data = unpack(f'!{size[0]}s', data[4:4+size[0]])
         return cls(string_data[0].decode()), data[4+size[0]:]
 
+    @classmethod
+    def skip(cls, data: bytes, offset: int = 0) -> int:
+        """
+        Find where a String starting at offset ends by reading only its length
+        :param data: bytes
+        :param offset: int
+        :return: int offset of the first byte after the value
+        """
+        end = offset+4+unpack('!I', data[offset:offset+4])[0]
+        if end > len(data):
+            raise error(f'String ends at offset {end}, data is {len(data)} bytes')
+        return end
+
     def encode(self) -> bytes:
         """
         Encode the data into a bytes object for transmission
         :return: bytes
         """
-        if type(self.data) is str:
-            data_size = len(self.data)
-            return pack(f'!I{data_size}s', data_size, self.data.encode())
-        raise error(f'data is not str, is {type(self.data)}')
+        if type(self._data) is str:
+            data_size = len(self._data)
+            return pack(f'!I{data_size}s', data_size, self._data.encode())
+        raise error(f'data is not str, is {type(self._data)}')
 
 
 class MPInt(Datatype):
+    __slots__ = ()
+
     def __init__(self, data: int):
         """
         Create a MPInt representation for ssh protocol.
@@ -268,7 +497,7 @@ class MPInt(Datatype):
         :param data: str Required
         """
         if type(data) is int:
-            self.data = data
+            self._data = data
         else:
             raise TypeError(f'data is not int, is {type(data)}')
 
@@ -286,31 +515,46 @@ class MPInt(Datatype):
         mpint_data = int.from_bytes(str_data[0], 'big', signed=True)
         return cls(mpint_data), data[4+size[0]:]
 
+    @classmethod
+    def skip(cls, data: bytes, offset: int = 0) -> int:
+        """
+        Find where a MPInt starting at offset ends by reading only its length
+        :param data: bytes
+        :param offset: int
+        :return: int offset of the first byte after the value
+        """
+        end = offset+4+unpack('!I', data[offset:offset+4])[0]
+        if end > len(data):
+            raise error(f'MPInt ends at offset {end}, data is {len(data)} bytes')
+        return end
+
     def encode(self) -> bytes:
         """
         Encode the data into a bytes object for transmission
         :return: bytes
         """
 
-        if type(self.data) is int:
+        if type(self._data) is int:
 
-            data_size = (self.data.bit_length()+7)//8
-            if self.data.bit_length() % 8 == 0:
+            data_size = (self._data.bit_length()+7)//8
+            if self._data.bit_length() % 8 == 0:
                 data_size = data_size+1
 
             return pack(
                 f'!I{data_size}s',
                 data_size,
-                self.data.to_bytes(data_size, 'big', signed=True)
+                self._data.to_bytes(data_size, 'big', signed=True)
             )
         else:
-            raise error(f'data is not int, is {type(self.data)}')
+            raise error(f'data is not int, is {type(self._data)}')
 
     def __int__(self):
-        return self.data
+        return self._data
 
 
 class NameList(Datatype):
+    __slots__ = ()
+
     def __init__(self, *data):
         """
         Create a NameList representation for ssh protocol.
@@ -322,7 +566,7 @@ class NameList(Datatype):
         for index, str_data in enumerate(data):
             if type(str_data) is not str:
                 raise TypeError(f'data[{index}] is not str, is {type(str_data)}')
-        self.data = data
+        self._data = data
 
     @classmethod
     def decode(cls, data):
@@ -341,13 +585,26 @@ class NameList(Datatype):
             return cls(*unpacked_list_data), data[4+size[0]:]
         return cls(), data[4:]
 
+    @classmethod
+    def skip(cls, data: bytes, offset: int = 0) -> int:
+        """
+        Find where a NameList starting at offset ends by reading only its length
+        :param data: bytes
+        :param offset: int
+        :return: int offset of the first byte after the value
+        """
+        end = offset+4+unpack('!I', data[offset:offset+4])[0]
+        if end > len(data):
+            raise error(f'NameList ends at offset {end}, data is {len(data)} bytes')
+        return end
+
     def encode(self) -> bytes:
         """
         Encode the data into a bytes object for transmission
         :return: bytes
         """
         try:
-            data = ','.join(self.data).encode()
+            data = ','.join(self._data).encode()
             data_size = len(data)
             return pack(f'!I{data_size}s', data_size, data)
         except: